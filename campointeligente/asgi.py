@@ -7,10 +7,57 @@ For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
 
+import logging
 import os
 
+from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.security.websocket import AllowedHostsOriginValidator
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'campointeligente.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Importado depois do get_asgi_application() para que os apps já estejam carregados.
+from chatbot.routing import websocket_urlpatterns  # noqa: E402
+from chatbot.views import chatbot_service  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+
+async def lifespan(scope, receive, send):
+    """
+    Trata o protocolo 'lifespan' do ASGI (uvicorn). O Django não o implementa,
+    então aquecemos aqui o ChatbotService no startup e, no shutdown, esperamos os
+    turnos em andamento antes de fechar os pools de conexões.
+    Um aquecimento com falha não derruba o worker: ele sobe sem se declarar pronto
+    (ver /api/v1/chatbot/ready) e tenta de novo na próxima sonda.
+    """
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await chatbot_service.warmup()
+            except Exception:
+                logger.exception("Erro ao aquecer o ChatbotService.")
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            try:
+                await chatbot_service.shutdown()
+            except Exception:
+                logger.exception("Erro ao encerrar o ChatbotService.")
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+protocol_router = ProtocolTypeRouter({
+    'http': django_application,
+    'websocket': AllowedHostsOriginValidator(URLRouter(websocket_urlpatterns)),
+})
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(scope, receive, send)
+    else:
+        await protocol_router(scope, receive, send)
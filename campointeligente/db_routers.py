@@ -0,0 +1,148 @@
+# campointeligente/db_routers.py
+"""
+Roteamento entre o banco primário e a réplica de leitura.
+
+Tudo vai para o primário (alias 'default'), exceto as leituras dos modelos do painel
+(REPLICA_MODELS) feitas dentro de use_replica() / @replica_reads: listagens, exportações
+e relatórios, que toleram alguns segundos de atraso da replicação. Sessões e usuários
+(autenticação) e o chatbot nunca usam a réplica.
+
+Read-your-writes: depois de uma escrita num desses modelos, as leituras da mesma
+requisição voltam ao primário, e o ReplicaPinMiddleware grava um cookie que mantém as
+leituras daquele cliente no primário por REPLICA_PIN_SECONDS (tempo para a réplica
+alcançar a escrita). Escritas de sessão, last_login etc. não fixam nada.
+Sem DB_REPLICA_HOST (alias 'replica' ausente), o roteador não faz nada.
+"""
+
+import functools
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+REPLICA_ALIAS = 'replica'
+PIN_COOKIE = 'db_pin_primary'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class _RoutingState:
+    __slots__ = ('replica', 'pinned', 'wrote')
+
+    def __init__(self, pinned: bool = False):
+        self.replica = False
+        self.pinned = pinned
+        self.wrote = False
+
+
+# Estado da requisição (ou do bloco use_replica) atual. Objeto mutável, para que uma
+# escrita feita numa thread do sync_to_async seja vista pelo middleware no event loop.
+_routing: ContextVar[Optional[_RoutingState]] = ContextVar('db_routing', default=None)
+
+
+def replica_available() -> bool:
+    return REPLICA_ALIAS in connections.databases
+
+
+@contextmanager
+def use_replica():
+    """Envia para a réplica as leituras do bloco (salvo se a requisição já escreveu ou está fixada)."""
+    state = _routing.get()
+    token = None
+    if state is None:
+        state = _RoutingState()
+        token = _routing.set(state)
+    previous, state.replica = state.replica, True
+    try:
+        yield
+    finally:
+        state.replica = previous
+        if token is not None:
+            _routing.reset(token)
+
+
+def replica_reads(view):
+    """
+    Decorator para views de leitura do painel: requisições GET/HEAD/OPTIONS leem da réplica;
+    os demais métodos (que escrevem) ficam no primário. Use logo acima da função,
+    abaixo dos decorators do DRF.
+    """
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in SAFE_METHODS:
+            return view(request, *args, **kwargs)
+        with use_replica():
+            return view(request, *args, **kwargs)
+    return wrapper
+
+
+class PrimaryReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        state = _routing.get()
+        if state is None or not state.replica or state.pinned or state.wrote:
+            return DEFAULT_DB_ALIAS
+        if model._meta.label not in settings.REPLICA_MODELS:
+            return DEFAULT_DB_ALIAS
+        return REPLICA_ALIAS if replica_available() else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        state = _routing.get()
+        if state is not None and model._meta.label in settings.REPLICA_MODELS:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Primário e réplica têm os mesmos dados.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # A réplica recebe o schema pela replicação, nunca por migrate.
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaPinMiddleware:
+    """
+    Abre o estado de roteamento de cada requisição e aplica o read-your-writes:
+    se a requisição escreveu no banco, o cliente recebe um cookie que fixa as suas
+    leituras no primário pelos próximos REPLICA_PIN_SECONDS.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = _routing.set(_RoutingState(pinned=PIN_COOKIE in request.COOKIES))
+        try:
+            response = self.get_response(request)
+            return self._finish(response)
+        finally:
+            _routing.reset(token)
+
+    async def __acall__(self, request):
+        token = _routing.set(_RoutingState(pinned=PIN_COOKIE in request.COOKIES))
+        try:
+            response = await self.get_response(request)
+            return self._finish(response)
+        finally:
+            _routing.reset(token)
+
+    @staticmethod
+    def _finish(response):
+        state = _routing.get()
+        if state is not None and state.wrote and replica_available():
+            response.set_cookie(
+                PIN_COOKIE, '1',
+                max_age=settings.REPLICA_PIN_SECONDS,
+                httponly=True,
+                samesite='Lax',
+            )
+        return response
@@ -40,7 +40,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'corsheaders.middleware.CorsMiddleware'
+    'corsheaders.middleware.CorsMiddleware',
+    'campointeligente.db_routers.ReplicaPinMiddleware',
 ]
 
 ROOT_URLCONF = 'campointeligente.urls'
@@ -65,6 +66,20 @@ WSGI_APPLICATION = 'campointeligente.wsgi.application'
 
 
 # --- Banco de Dados ---
+# DB_POOL=True usa o pool de conexões do psycopg 3 (pip install "psycopg[binary,pool]"),
+# um pool por worker: é o modo indicado para o ASGI, onde cada requisição roda numa thread nova.
+# Sem pool, a conexão é mantida por DB_CONN_MAX_AGE segundos (útil no process_webhook_jobs).
+DB_POOL = os.getenv('DB_POOL') == 'True'
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '2'))
+# Deixe folga para as USER_LOCK_SHARDS conexões dos advisory locks, que ficam presas aos shards.
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '20'))
+# Espera máxima (segundos) por uma conexão livre; esgotada, a requisição recebe 503 em vez de travar.
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '5'))
+# Conexões do pool são recicladas após este tempo (segundos).
+DB_POOL_MAX_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', '1800'))
+DB_CONN_MAX_AGE = int(os.getenv('DB_CONN_MAX_AGE', '0'))
+DB_CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', '5'))
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql',
@@ -73,12 +88,47 @@ DATABASES = {
         'PASSWORD': os.getenv('DB_PASSWORD'),
         'HOST': os.getenv('DB_HOST'),
         'PORT': os.getenv('DB_PORT'),
+        # O pool do Django não aceita conexões persistentes: com pool, CONN_MAX_AGE fica 0.
+        'CONN_MAX_AGE': 0 if DB_POOL else DB_CONN_MAX_AGE,
+        # Testa a conexão reaproveitada antes de usá-la (descarta as quebradas).
+        'CONN_HEALTH_CHECKS': True,
         'OPTIONS': {
-            'client_encoding': 'UTF8'
+            'client_encoding': 'UTF8',
+            'connect_timeout': DB_CONNECT_TIMEOUT,
+            **({'pool': {
+                'min_size': DB_POOL_MIN_SIZE,
+                'max_size': DB_POOL_MAX_SIZE,
+                'timeout': DB_POOL_TIMEOUT,
+                'max_lifetime': DB_POOL_MAX_LIFETIME,
+                'name': 'campointeligente',
+            }} if DB_POOL else {}),
         },
     }
 }
 
+# --- Réplica de leitura ---
+# Com DB_REPLICA_HOST definido, leituras do painel e relatórios vão para a réplica
+# (ver campointeligente/db_routers.py). As demais credenciais são as do primário.
+DB_REPLICA_HOST = os.getenv('DB_REPLICA_HOST')
+if DB_REPLICA_HOST:
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'HOST': DB_REPLICA_HOST,
+        'PORT': os.getenv('DB_REPLICA_PORT', DATABASES['default']['PORT']),
+        'OPTIONS': {
+            **DATABASES['default']['OPTIONS'],
+            **({'pool': {**DATABASES['default']['OPTIONS']['pool'], 'name': 'campointeligente-replica'}} if DB_POOL else {}),
+        },
+        # Nos testes, a "réplica" é o próprio banco de teste do primário.
+        'TEST': {'MIRROR': 'default'},
+    }
+DATABASE_ROUTERS = ['campointeligente.db_routers.PrimaryReplicaRouter']
+# Depois de uma escrita, as leituras do cliente ficam no primário por X segundos.
+REPLICA_PIN_SECONDS = int(os.getenv('REPLICA_PIN_SECONDS', '5'))
+# Modelos (app_label.Modelo) que o painel lê da réplica; só as escritas neles fixam o cliente no
+# primário. Sessões e usuários (autenticação) ficam sempre no primário.
+REPLICA_MODELS = ['chatbot.Organizacao', 'chatbot.Administrador']
+
 
 # --- Validação de Senha ---
 AUTH_PASSWORD_VALIDATORS = [
@@ -119,6 +169,138 @@ EVOLUTION_API_URL = os.getenv('EVOLUTION_API_URL')
 EVOLUTION_INSTANCE_NAME = os.getenv('EVOLUTION_INSTANCE_NAME')
 CORS_ALLOW_ALL_ORIGINS = True # Mantenha esta linha se estiver usando django-cors-headers
 
+# --- Clientes HTTP para serviços externos (Evolution, OpenWeather, OpenAI) ---
+# Cada serviço tem um pool de conexões próprio, reaproveitado entre mensagens.
+HTTP_CLIENT_HTTP2 = os.getenv('HTTP_CLIENT_HTTP2') == 'True'  # requer o pacote 'h2'
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', '20'))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('HTTP_MAX_KEEPALIVE_CONNECTIONS', '10'))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv('HTTP_KEEPALIVE_EXPIRY', '30'))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '10'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_POOL_TIMEOUT = float(os.getenv('HTTP_POOL_TIMEOUT', '5'))
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', '60'))
+
+# --- Consultor agrícola (LLM) ---
+# OPENAI_BASE_URL aponta o cliente para outro servidor compatível com a API da OpenAI
+# (ex.: um servidor falso local nos testes). Vazio usa a API oficial.
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL') or None
+OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4o-mini')
+LLM_MAX_TOKENS = int(os.getenv('LLM_MAX_TOKENS', '600'))
+# Gerações simultâneas por worker e espera máxima (segundos) por uma vaga.
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '8'))
+LLM_QUEUE_TIMEOUT = float(os.getenv('LLM_QUEUE_TIMEOUT', '5'))
+# Chamadas esperando vaga por worker; com a fila cheia, a mensagem recebe o prompt 'llm_busy_retry' na hora.
+LLM_MAX_QUEUE = int(os.getenv('LLM_MAX_QUEUE', '100'))
+# Orçamento de tokens por organização na janela deslizante de LLM_ORG_TOKEN_WINDOW segundos (0 = sem limite).
+# A conta fica no cache LLM_BUDGET_CACHE_ALIAS; use um cache de rede (Redis) para somar todos os workers.
+LLM_ORG_TOKEN_BUDGET = int(os.getenv('LLM_ORG_TOKEN_BUDGET', '0'))
+LLM_ORG_TOKEN_WINDOW = int(os.getenv('LLM_ORG_TOKEN_WINDOW', '3600'))
+LLM_BUDGET_CACHE_ALIAS = os.getenv('LLM_BUDGET_CACHE_ALIAS', 'default')
+# Tempo máximo (segundos) até o primeiro token e para a geração inteira.
+LLM_FIRST_TOKEN_TIMEOUT = float(os.getenv('LLM_FIRST_TOKEN_TIMEOUT', '10'))
+LLM_TOTAL_TIMEOUT = float(os.getenv('LLM_TOTAL_TIMEOUT', '45'))
+# Máximo de idas e voltas modelo -> ferramentas -> modelo por mensagem.
+LLM_MAX_TOOL_ROUNDS = int(os.getenv('LLM_MAX_TOOL_ROUNDS', '3'))
+# Tempo máximo (segundos) de cada ferramenta; estourado, ela é cancelada.
+TOOL_TIMEOUT = float(os.getenv('TOOL_TIMEOUT', '8'))
+# Histórico enviado ao modelo: as últimas LLM_HISTORY_TURNS interações na íntegra e, antes delas,
+# o resumo da conversa; tudo em até LLM_HISTORY_TOKEN_BUDGET tokens (estimados).
+LLM_HISTORY_TURNS = int(os.getenv('LLM_HISTORY_TURNS', '6'))
+LLM_HISTORY_TOKEN_BUDGET = int(os.getenv('LLM_HISTORY_TOKEN_BUDGET', '1500'))
+# Interações fora da janela que disparam a atualização do resumo (em segundo plano) e tamanho dele.
+LLM_HISTORY_SUMMARY_BATCH = int(os.getenv('LLM_HISTORY_SUMMARY_BATCH', '6'))
+LLM_HISTORY_SUMMARY_MAX_TOKENS = int(os.getenv('LLM_HISTORY_SUMMARY_MAX_TOKENS', '300'))
+# Serviço Node.js de consulta ao Preço da Hora (precodahora_service). Vazio desativa as ferramentas de preço.
+PRECODAHORA_SERVICE_URL = os.getenv('PRECODAHORA_SERVICE_URL')
+
+# --- Caches em memória de tabelas de configuração (Prompt, ...) ---
+# Intervalo, em segundos, entre verificações de versão feitas por cada processo
+# para detectar edições realizadas em outro worker.
+SNAPSHOT_VERSION_CHECK_INTERVAL = float(os.getenv('SNAPSHOT_VERSION_CHECK_INTERVAL', '5'))
+
+# --- Cache de clima (OpenWeather) ---
+WEATHER_CACHE_TTL = float(os.getenv('WEATHER_CACHE_TTL', '600'))
+# Por quanto tempo, após o TTL, o valor antigo ainda é servido enquanto é atualizado em segundo plano.
+WEATHER_CACHE_STALE_TTL = float(os.getenv('WEATHER_CACHE_STALE_TTL', '1800'))
+WEATHER_CACHE_MAX_SIZE = int(os.getenv('WEATHER_CACHE_MAX_SIZE', '1000'))
+
+# --- Cache de respostas do consultor agrícola (perguntas parecidas, por UF) ---
+# TTL (segundos) de cada resposta; 0 desativa o cache.
+LLM_ANSWER_CACHE_TTL = float(os.getenv('LLM_ANSWER_CACHE_TTL', str(24 * 3600)))
+LLM_ANSWER_CACHE_MAX_SIZE = int(os.getenv('LLM_ANSWER_CACHE_MAX_SIZE', '2000'))
+# Similaridade mínima (Jaccard dos termos da pergunta, 0 a 1) para reaproveitar uma resposta.
+LLM_ANSWER_CACHE_THRESHOLD = float(os.getenv('LLM_ANSWER_CACHE_THRESHOLD', '0.65'))
+
+# --- Cache de geocodificação (tb_geocode_cache + memória) ---
+# Tamanho da grade, em graus, usada para agrupar coordenadas próximas (0.01° ≈ 1,1 km).
+GEOCODE_GRID_DEGREES = float(os.getenv('GEOCODE_GRID_DEGREES', '0.01'))
+# Buscas sem resultado são repetidas depois deste tempo (segundos).
+GEOCODE_NEGATIVE_TTL = float(os.getenv('GEOCODE_NEGATIVE_TTL', '86400'))
+GEOCODE_MEMORY_TTL = float(os.getenv('GEOCODE_MEMORY_TTL', '86400'))
+GEOCODE_MEMORY_MAX_SIZE = int(os.getenv('GEOCODE_MEMORY_MAX_SIZE', '5000'))
+
+# --- Gazetteer de municípios (IBGE) ---
+# CSV com codigo_ibge, nome, uf, latitude e longitude da sede de cada município.
+GAZETTEER_PATH = os.getenv('GAZETTEER_PATH', str(BASE_DIR / 'chatbot' / 'data' / 'municipios.csv'))
+# Geocodificação reversa offline: pontos a mais de X km de qualquer sede municipal
+# (ex.: fora do país) são resolvidos pela API externa.
+GAZETTEER_NEAREST_MAX_KM = float(os.getenv('GAZETTEER_NEAREST_MAX_KM', '100'))
+
+# --- Fila de Webhooks (modo fast-ack) ---
+# Com WEBHOOK_FAST_ACK=True o webhook apenas valida e persiste o evento em tb_webhook_jobs,
+# respondendo 200 de imediato. O processamento fica a cargo de 'manage.py process_webhook_jobs'.
+WEBHOOK_FAST_ACK = os.getenv('WEBHOOK_FAST_ACK') == 'True'
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '4'))
+WEBHOOK_WORKER_POLL_INTERVAL = float(os.getenv('WEBHOOK_WORKER_POLL_INTERVAL', '1.0'))
+WEBHOOK_JOB_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_JOB_MAX_ATTEMPTS', '5'))
+WEBHOOK_JOB_RETRY_BASE_SECONDS = float(os.getenv('WEBHOOK_JOB_RETRY_BASE_SECONDS', '2'))
+WEBHOOK_JOB_RETRY_MAX_SECONDS = float(os.getenv('WEBHOOK_JOB_RETRY_MAX_SECONDS', '300'))
+# Tempo após o qual uma tarefa em 'processando' é considerada abandonada (worker morreu).
+WEBHOOK_JOB_VISIBILITY_TIMEOUT = int(os.getenv('WEBHOOK_JOB_VISIBILITY_TIMEOUT', '300'))
+
+# --- Agrupamento de mensagens do WhatsApp (debounce) ---
+# Mensagens do mesmo usuário com menos de WHATSAPP_DEBOUNCE_SECONDS entre elas viram um só turno
+# (uma resposta), esperando no máximo WHATSAPP_DEBOUNCE_MAX_SECONDS desde a primeira. 0 desativa.
+WHATSAPP_DEBOUNCE_SECONDS = float(os.getenv('WHATSAPP_DEBOUNCE_SECONDS', '0'))
+WHATSAPP_DEBOUNCE_MAX_SECONDS = float(os.getenv('WHATSAPP_DEBOUNCE_MAX_SECONDS', '5'))
+
+# --- Registro de interações (write-behind) ---
+# As interações são gravadas em lote: ao juntar BATCH_SIZE linhas ou a cada FLUSH_INTERVAL segundos.
+INTERACTION_LOG_BATCH_SIZE = int(os.getenv('INTERACTION_LOG_BATCH_SIZE', '200'))
+INTERACTION_LOG_FLUSH_INTERVAL = float(os.getenv('INTERACTION_LOG_FLUSH_INTERVAL', '1.0'))
+# Acima deste número de linhas pendentes em memória, as mais antigas vão para o disco.
+INTERACTION_LOG_MAX_BUFFER = int(os.getenv('INTERACTION_LOG_MAX_BUFFER', '10000'))
+# Arquivo de contingência usado quando o banco está indisponível, e seu tamanho máximo.
+INTERACTION_LOG_SPILL_PATH = os.getenv('INTERACTION_LOG_SPILL_PATH', str(BASE_DIR / 'spool' / 'interacoes_pendentes.jsonl'))
+INTERACTION_LOG_SPILL_MAX_BYTES = int(os.getenv('INTERACTION_LOG_SPILL_MAX_BYTES', str(50 * 1024 * 1024)))
+
+# --- Estado das conversas (sessão do usuário fora do banco) ---
+# 'cache': um cache do Django (CACHES[CONVERSATION_STATE_CACHE_ALIAS]); com vários workers, use um cache de rede (Redis).
+# 'locmem': LRU na memória do processo (só com um único worker).
+CONVERSATION_STATE_BACKEND = os.getenv('CONVERSATION_STATE_BACKEND', 'cache')
+CONVERSATION_STATE_CACHE_ALIAS = os.getenv('CONVERSATION_STATE_CACHE_ALIAS', 'default')
+CONVERSATION_STATE_MAX_SIZE = int(os.getenv('CONVERSATION_STATE_MAX_SIZE', '10000'))
+CONVERSATION_STATE_TTL = int(os.getenv('CONVERSATION_STATE_TTL', str(7 * 24 * 3600)))
+# Intervalo (segundos) para gravar no Usuario as colunas alteradas pelos turnos (nome, cidade, contexto...).
+CONVERSATION_STATE_FLUSH_INTERVAL = float(os.getenv('CONVERSATION_STATE_FLUSH_INTERVAL', '1.0'))
+# Número de processos do servidor ASGI (o uvicorn lê a mesma variável para --workers).
+# Acima de 1, um estado guardado só na memória do processo é recusado no startup.
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', '1'))
+
+# --- Ordem de processamento por usuário ---
+# Em PostgreSQL, advisory locks garantem a ordem também entre workers e máquinas.
+USER_LOCK_USE_DB = os.getenv('USER_LOCK_USE_DB', 'True') == 'True'
+# Threads (cada uma com sua conexão) usadas para obter e liberar os advisory locks.
+USER_LOCK_SHARDS = int(os.getenv('USER_LOCK_SHARDS', '8'))
+# Espera máxima (segundos) pelo lock de um usuário ocupado em outro processo; esgotada, a
+# tarefa da fila é reagendada e o webhook/webchat recebe 503 (a mensagem não sai fora de ordem).
+USER_LOCK_TIMEOUT = float(os.getenv('USER_LOCK_TIMEOUT', '30'))
+
+# --- Ciclo de vida dos workers ASGI ---
+# No shutdown, tempo máximo (segundos) para os turnos em andamento terminarem antes de
+# fechar pools e gravar o que estiver pendente. Mantenha abaixo do timeout do uvicorn/orquestrador.
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv('SHUTDOWN_DRAIN_TIMEOUT', '20'))
+
 # CONFIGURAÇÕES DE ENVIO DE EMAIL
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = 'smtp.gmail.com'
@@ -0,0 +1,214 @@
+# chatbot/admission.py
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Prioridades da fila de admissão (menor passa na frente).
+# Interativo: um agricultor esperando a resposta (WhatsApp, webchat, 1ª tentativa da fila de webhooks).
+PRIORITY_INTERACTIVE = 0
+# Segundo plano: ninguém esperando na hora (retentativas da fila de webhooks, resumos, etc.).
+PRIORITY_BACKGROUND = 1
+
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_BACKGROUND: 'background'}
+
+
+class AdmissionRejected(Exception):
+    """A chamada ao modelo não foi admitida. 'reason': 'busy' (sem vaga a tempo) ou 'budget'."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class TokenBudget:
+    """
+    Tokens gastos por organização numa janela deslizante de LLM_ORG_TOKEN_WINDOW segundos,
+    guardados em BUCKETS fatias no cache do Django (CACHES[alias]). Com um cache de rede
+    (Redis, Memcached) a conta soma todos os workers; com o LocMemCache, só o processo.
+    """
+    BUCKETS = 12
+
+    def __init__(self, alias: str):
+        self.cache = caches[alias]
+
+    def _keys(self, organizacao_id: int) -> List[str]:
+        size = max(1, settings.LLM_ORG_TOKEN_WINDOW // self.BUCKETS)
+        current = int(time.time() // size)
+        return [f"llm:tokens:{organizacao_id}:{bucket}" for bucket in range(current - self.BUCKETS + 1, current + 1)]
+
+    async def spent(self, organizacao_id: int) -> int:
+        values = await self.cache.aget_many(self._keys(organizacao_id))
+        return sum(values.values())
+
+    async def exceeded(self, organizacao_id: int) -> bool:
+        if settings.LLM_ORG_TOKEN_BUDGET <= 0:
+            return False
+        try:
+            return await self.spent(organizacao_id) >= settings.LLM_ORG_TOKEN_BUDGET
+        except Exception as e:
+            # Sem o cache, a conversa não pode parar: a chamada é admitida.
+            logger.warning(f"AVISO: Falha ao consultar o orçamento de tokens da organização {organizacao_id}. Erro: {e}")
+            return False
+
+    async def record(self, organizacao_id: int, tokens: int):
+        key = self._keys(organizacao_id)[-1]
+        timeout = settings.LLM_ORG_TOKEN_WINDOW + settings.LLM_ORG_TOKEN_WINDOW // self.BUCKETS
+        try:
+            if not await self.cache.aadd(key, tokens, timeout=timeout):
+                await self.cache.aincr(key, tokens)
+        except ValueError:
+            # A fatia expirou entre o add e o incr.
+            await self.cache.aset(key, tokens, timeout=timeout)
+        except Exception as e:
+            logger.warning(f"AVISO: Falha ao registrar {tokens} tokens da organização {organizacao_id}. Erro: {e}")
+
+
+class AdmissionController:
+    """
+    Porta de entrada de todas as chamadas ao modelo.
+
+    - No máximo LLM_MAX_CONCURRENCY chamadas em andamento por worker. As demais esperam
+      numa fila de prioridade: turnos interativos passam na frente dos de segundo plano
+      e, dentro da mesma prioridade, vale a ordem de chegada.
+    - Quem não consegue vaga em LLM_QUEUE_TIMEOUT segundos, ou encontra a fila com
+      LLM_MAX_QUEUE chamadas, é recusado na hora (AdmissionRejected('busy')).
+    - Organizações que gastaram LLM_ORG_TOKEN_BUDGET tokens na janela deslizante são
+      recusadas até a janela andar (AdmissionRejected('budget')).
+    Quem chama decide o que responder ao agricultor (o prompt 'llm_busy_retry').
+    """
+
+    def __init__(self, budget: TokenBudget = None):
+        self.budget = budget or TokenBudget(settings.LLM_BUDGET_CACHE_ALIAS)
+        # (prioridade, ordem de chegada, future) de quem espera uma vaga
+        self._waiters: List[tuple] = []
+        self._arrivals = itertools.count()
+        self._loop = None
+        self.in_flight = 0
+        self.queued = 0
+        # Métricas
+        self.admitted = 0
+        self.shed_busy = 0
+        self.shed_budget = 0
+        self._waits: Dict[int, list] = {}
+        self._spend: Dict[int, list] = {}
+        metrics.register('llm_admission', self.stats)
+
+    @asynccontextmanager
+    async def admit(self, priority: int = PRIORITY_INTERACTIVE, organizacao_id: Optional[int] = None):
+        """Segura uma vaga durante o bloco. Levanta AdmissionRejected se a chamada for recusada."""
+        if organizacao_id is not None and await self.budget.exceeded(organizacao_id):
+            self.shed_budget += 1
+            logger.warning(f"AVISO: Organização {organizacao_id} atingiu o orçamento de {settings.LLM_ORG_TOKEN_BUDGET} tokens; chamada ao LLM recusada.")
+            raise AdmissionRejected('budget')
+        started = time.perf_counter()
+        await self._acquire(priority)
+        self._record_wait(priority, time.perf_counter() - started)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def charge(self, organizacao_id: Optional[int], tokens: int):
+        """Debita os tokens de uma chamada já feita no orçamento da organização."""
+        spend = self._spend.setdefault(organizacao_id, [0, 0])
+        spend[0] += 1
+        spend[1] += tokens
+        if organizacao_id is not None and tokens:
+            await self.budget.record(organizacao_id, tokens)
+
+    async def _acquire(self, priority: int):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._waiters = []
+            self.in_flight = 0
+            self.queued = 0
+        if self.in_flight < settings.LLM_MAX_CONCURRENCY and not self.queued:
+            self.in_flight += 1
+            return
+        if self.queued >= settings.LLM_MAX_QUEUE:
+            self._shed_busy(priority)
+        future = loop.create_future()
+        heapq.heappush(self._waiters, (priority, next(self._arrivals), future))
+        self.queued += 1
+        try:
+            async with asyncio.timeout(settings.LLM_QUEUE_TIMEOUT):
+                await future
+        except TimeoutError:
+            self._abandon(future)
+            self._shed_busy(priority)
+        except asyncio.CancelledError:
+            self._abandon(future)
+            raise
+        finally:
+            self.queued -= 1
+
+    def _abandon(self, future: asyncio.Future):
+        if future.done() and not future.cancelled():
+            # A vaga chegou junto com o cancelamento: passa para o próximo da fila.
+            self._release()
+        else:
+            future.cancel()
+
+    def _release(self):
+        # A vaga passa direto para o primeiro da fila; 'in_flight' só cai se ninguém espera.
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def _shed_busy(self, priority: int):
+        self.shed_busy += 1
+        logger.warning(
+            f"AVISO: Chamada ao LLM recusada ({PRIORITY_NAMES.get(priority, priority)}): "
+            f"{self.in_flight} em andamento, {self.queued} na fila."
+        )
+        raise AdmissionRejected('busy')
+
+    def _record_wait(self, priority: int, waited: float):
+        self.admitted += 1
+        # [admitidas, espera total, maior espera]
+        wait = self._waits.setdefault(priority, [0, 0.0, 0.0])
+        wait[0] += 1
+        wait[1] += waited
+        wait[2] = max(wait[2], waited)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "max_concurrency": settings.LLM_MAX_CONCURRENCY,
+            "queued": self.queued,
+            "max_queue": settings.LLM_MAX_QUEUE,
+            "admitted": self.admitted,
+            "shed_busy": self.shed_busy,
+            "shed_budget": self.shed_budget,
+            "queue_wait": {
+                PRIORITY_NAMES.get(priority, str(priority)): {
+                    "admitted": count,
+                    "avg_ms": round(total / count * 1000, 1) if count else 0.0,
+                    "max_ms": round(longest * 1000, 1),
+                }
+                for priority, (count, total, longest) in sorted(self._waits.items())
+            },
+            "org_token_budget": settings.LLM_ORG_TOKEN_BUDGET,
+            "org_token_window_seconds": settings.LLM_ORG_TOKEN_WINDOW,
+            # Gasto deste worker desde o início (o orçamento em si soma todos, via cache).
+            "tokens_by_org": {
+                str(organizacao_id): {"calls": calls, "tokens": tokens}
+                for organizacao_id, (calls, tokens) in self._spend.items()
+            },
+        }
@@ -0,0 +1,157 @@
+# chatbot/answer_cache.py
+
+import itertools
+import math
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Hashable, Iterable, NamedTuple, Optional, Set, Tuple
+
+from . import metrics
+from .text import normalize_text, question_terms
+
+_WORDS = re.compile(r'[a-z0-9]+')
+
+
+def _words(text: str) -> str:
+    return f" {' '.join(_WORDS.findall(normalize_text(text)))} "
+
+
+class _Entry(NamedTuple):
+    scope: Hashable
+    terms: FrozenSet[str]
+    answer: str
+    expires_at: float
+
+
+class SimilarAnswerCache:
+    """
+    Respostas do consultor agrícola reaproveitadas entre perguntas quase iguais
+    ('quando plantar milho' ~ 'qual a melhor época pra plantar milho?').
+
+    - A pergunta vira um conjunto de termos (sem acentos, stopwords e sufixos; ver
+      text.question_terms) e é comparada às já respondidas pela similaridade de Jaccard.
+      Os candidatos vêm de um índice invertido termo -> respostas, consultado só nos termos
+      mais raros da pergunta (prefix filtering): tudo em memória e sem serviço externo.
+    - Respostas só valem dentro do mesmo escopo (UF do agricultor + prompt de sistema):
+      uma edição do prompt no painel deixa as antigas de lado.
+    - TTL por resposta e no máximo 'max_size' respostas por worker, com despejo LRU.
+    Perguntas com menos de 'min_terms' termos (ex.: 'e o feijão?') não passam pelo cache.
+    """
+
+    def __init__(self, ttl: float, max_size: int, threshold: float, min_terms: int = 2):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.threshold = threshold
+        self.min_terms = min_terms
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._index: Dict[Tuple[Hashable, str], Set[int]] = {}
+        self._ids = itertools.count()
+        # Métricas
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expired = 0
+        metrics.register('llm_answer_cache', self.stats)
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_size > 0
+
+    def lookup(self, scope: Hashable, question: str) -> Optional[str]:
+        """Resposta guardada para uma pergunta parecida o bastante no mesmo escopo, ou None."""
+        if not self.enabled:
+            return None
+        terms = question_terms(question)
+        if len(terms) < self.min_terms:
+            self.skipped += 1
+            return None
+        now = time.monotonic()
+        best_id, best_score = None, 0.0
+        for entry_id in self._candidates(scope, terms, self._prefix_size(len(terms))):
+            entry = self._entries[entry_id]
+            if entry.expires_at <= now:
+                self._remove(entry_id)
+                self.expired += 1
+                continue
+            score = len(terms & entry.terms) / len(terms | entry.terms)
+            if score > best_score:
+                best_id, best_score = entry_id, score
+        if best_id is None or best_score < self.threshold:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(best_id)
+        return self._entries[best_id].answer
+
+    def store(self, scope: Hashable, question: str, answer: str, personal: Iterable[str] = ()):
+        """
+        Guarda a resposta da pergunta. Respostas que citam dados do agricultor ('personal':
+        nome, cidade) não são compartilhadas com os demais.
+        """
+        if not self.enabled or not answer:
+            return
+        terms = question_terms(question)
+        if len(terms) < self.min_terms:
+            return
+        words = _words(answer)
+        for value in personal:
+            needle = _words(value or '')
+            if needle.strip() and needle in words:
+                return
+        # A mesma pergunta (mesmos termos) fica só com a resposta mais recente.
+        for entry_id in list(self._candidates(scope, terms)):
+            if self._entries[entry_id].terms == terms:
+                self._remove(entry_id)
+        entry_id = next(self._ids)
+        self._entries[entry_id] = _Entry(scope, terms, answer, time.monotonic() + self.ttl)
+        for term in terms:
+            self._index.setdefault((scope, term), set()).add(entry_id)
+        self.stores += 1
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._index.clear()
+
+    def _prefix_size(self, size: int) -> int:
+        # Jaccard >= threshold exige ao menos ceil(threshold * size) termos em comum, então
+        # qualquer resposta parecida tem um dos (size - esse mínimo + 1) termos mais raros.
+        return size - math.ceil(self.threshold * size) + 1
+
+    def _candidates(self, scope: Hashable, terms: FrozenSet[str], prefix: int = None) -> Set[int]:
+        postings = [self._index.get((scope, term), ()) for term in terms]
+        if prefix is not None:
+            postings = sorted(postings, key=len)[:max(1, prefix)]
+        found: Set[int] = set()
+        for ids in postings:
+            found.update(ids)
+        return found
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        for term in entry.terms:
+            ids = self._index.get((entry.scope, term))
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del self._index[(entry.scope, term)]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "skipped": self.skipped,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "expired": self.expired,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
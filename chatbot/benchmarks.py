@@ -0,0 +1,300 @@
+# chatbot/benchmarks.py
+
+import asyncio
+import random
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+from unittest import mock
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.test import AsyncClient
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from .debounce import InboundMessage, MessageDebouncer
+from .gazetteer import Gazetteer
+from .intents import IntentMatcher
+from .models import IntentKeyword, Interacao, Usuario
+from .services import ChatbotService
+
+# Medições reproduzíveis (sem rede nem LLM) dos componentes de desempenho do chatbot.
+# Rodam com `python manage.py benchmark <nome>`; os testes rodam versões pequenas.
+BENCHMARKS: Dict[str, Callable[..., dict]] = {}
+
+
+def benchmark(name: str):
+    """Registra uma medição com o nome usado pelo comando `benchmark`."""
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def burst_trace(users: int, bursts: int, seed: int) -> List[tuple]:
+    """
+    Tráfego sintético do WhatsApp: cada usuário manda `bursts` rajadas de 1 a 4 mensagens
+    (0,3 a 2,5 s entre elas), com 20 a 60 s entre as rajadas. Lista de (segundo, usuário).
+    """
+    rng = random.Random(seed)
+    trace = []
+    for user in range(users):
+        at = rng.uniform(0, 30)
+        for _ in range(bursts):
+            for _ in range(rng.choice((1, 1, 2, 2, 3, 4))):
+                trace.append((at, user))
+                at += rng.uniform(0.3, 2.5)
+            at += rng.uniform(20, 60)
+    trace.sort()
+    return trace
+
+
+# Mensagens de menu típicas, usadas quando tb_interacoes ainda está vazia.
+SYNTHETIC_MENU_MESSAGES = [
+    '1', '[2]', 'clima', 'quero ver o clima', 'opção 3 por favor', 'Preços', 'relatorios',
+    'quero ver 10 hectares', 'plantei 25 sacas de milho', 'bom dia', 'safra 2024/2025',
+    'como está a chuva em Sorriso?', 'oi tudo bem', 'minha cidade', 'outra',
+]
+
+
+def message_corpus(limit: int) -> List[str]:
+    """Últimas mensagens reais dos agricultores (tb_interacoes) ou, sem elas, o corpus sintético."""
+    messages = list(
+        Interacao.objects.exclude(mensagem_usuario__isnull=True).exclude(mensagem_usuario='')
+        .order_by('-timestamp').values_list('mensagem_usuario', flat=True)[:limit]
+    )
+    return messages or SYNTHETIC_MENU_MESSAGES
+
+
+@benchmark('intents')
+def intent_corpus(scope='menu', limit=5000, rounds=20) -> dict:
+    """
+    Passa o corpus de mensagens pelo IntentMatcher e pela regra antiga dos handlers (a
+    primeira palavra-chave, por prioridade, contida em qualquer lugar do texto). Mede o
+    custo por mensagem de cada um e conta as mensagens em que as intenções divergem.
+    """
+    corpus = message_corpus(limit)
+    keywords = sorted(IntentKeyword.objects.filter(scope=scope, is_regex=False), key=lambda k: -k.priority)
+    matcher = IntentMatcher()
+    matcher.reload()
+
+    def substring(text):
+        lowered = text.lower()
+        return next((k.intent for k in keywords if k.pattern.lower() in lowered), None)
+
+    def timed(match):
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for text in corpus:
+                match(text)
+        return (time.perf_counter() - started) / (rounds * len(corpus)) * 1e6
+
+    differ = [text for text in corpus if matcher.match(scope, text) != substring(text)]
+    return {
+        "messages": len(corpus),
+        "keywords": len(keywords),
+        "matcher_us_per_message": round(timed(lambda text: matcher.match(scope, text)), 2),
+        "substring_us_per_message": round(timed(substring), 2),
+        "differ_from_substring": len(differ),
+        "differ_examples": differ[:5],
+    }
+
+
+@benchmark('debounce')
+def debounce_replay(users=40, bursts=5, window=1.5, max_window=5.0, speedup=10.0, seed=7) -> dict:
+    """
+    Reproduz burst_trace num MessageDebouncer e mede quantos turnos sobram e quanto cada
+    webhook fica preso esperando a janela. Tempos na escala do tráfego original; `speedup`
+    só acelera a reprodução.
+    """
+    trace = burst_trace(users, bursts, seed)
+    waits = []
+
+    async def deliver(debouncer, at, user):
+        await asyncio.sleep(at / speedup)
+        started = time.perf_counter()
+        await debouncer.submit(user, InboundMessage('oi', None, timezone.now()))
+        waits.append((time.perf_counter() - started) * speedup)
+
+    async def replay():
+        debouncer = MessageDebouncer()
+        await asyncio.gather(*(deliver(debouncer, at, user) for at, user in trace))
+        return debouncer.stats()
+
+    with override_settings(
+        WHATSAPP_DEBOUNCE_SECONDS=window / speedup, WHATSAPP_DEBOUNCE_MAX_SECONDS=max_window / speedup,
+    ):
+        stats = asyncio.run(replay())
+    return {
+        "messages": len(trace),
+        "turns": stats["turns_out"],
+        "reduction": stats["reduction"],
+        "max_window_size": stats["max_window_size"],
+        "webhook_wait_p50_s": round(percentile(waits, 0.5), 3),
+        "webhook_wait_p95_s": round(percentile(waits, 0.95), 3),
+        "webhook_wait_max_s": round(max(waits, default=0.0), 3),
+    }
+
+
+# Cidades como os agricultores escrevem: exatas, com UF, sem acento e com erro de digitação.
+GAZETTEER_QUERIES = {
+    "exact": ['Feira de Santana - BA', 'São Paulo', 'Juazeiro do Norte', 'Vitória da Conquista/BA'],
+    "unaccented": ['sao paulo sp', 'Mossoro', 'brasilia'],
+    "typo": ['Feira de Santanna', 'Salvadr', 'Campina Grand'],
+    "miss": ['xyzabc', 'minha fazenda'],
+}
+
+
+@benchmark('gazetteer')
+def gazetteer_lookups(rounds=200, points=2000, seed=7) -> dict:
+    """
+    Carrega um Gazetteer novo e mede o tempo de carga, a memória do índice (memory_bytes(),
+    conferida com o tracemalloc) e a latência de resolve() por tipo de consulta e de
+    nearest() para pontos aleatórios no território brasileiro.
+    """
+    started = time.perf_counter()
+    index = Gazetteer()
+    index.ensure_loaded()
+    load_ms = (time.perf_counter() - started) * 1e3
+    # Segunda carga só para a memória: o tracemalloc deixa a carga bem mais lenta.
+    tracemalloc.start()
+    try:
+        traced_index = Gazetteer()
+        traced_index.ensure_loaded()
+        traced = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    result = {
+        "municipios": len(index.names),
+        "load_ms": round(load_ms, 1),
+        "memory_kib": index.memory_bytes() // 1024,
+        "traced_kib": traced // 1024,
+    }
+    for kind, queries in GAZETTEER_QUERIES.items():
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for query in queries:
+                index.resolve(query)
+        result[f"resolve_{kind}_us"] = round((time.perf_counter() - started) / (rounds * len(queries)) * 1e6, 2)
+
+    rng = random.Random(seed)
+    coords = [(rng.uniform(-33.7, 5.2), rng.uniform(-73.9, -34.8)) for _ in range(points)]
+    started = time.perf_counter()
+    for lat, lon in coords:
+        index.nearest(lat, lon)
+    result["nearest_us"] = round((time.perf_counter() - started) / points * 1e6, 2)
+    return result
+
+
+@benchmark('views')
+def view_concurrency(levels=(1, 8, 32, 128), upstream_ms=100) -> dict:
+    """
+    Quantas conversas um worker mantém em andamento ao mesmo tempo. Para cada nível, N POSTs
+    simultâneos no webchat (view assíncrona, pelo ASGI) cujo turno só espera 'upstream_ms'
+    (OpenWeather, Evolution, LLM). Compara com a forma antiga, uma view síncrona com
+    async_to_sync: sob ASGI, o Django roda views síncronas em sync_to_async(thread_sensitive=True),
+    ou seja, uma de cada vez na mesma thread.
+    """
+    from . import views
+
+    async def level(concurrency, bridged):
+        in_flight = peak = 0
+
+        async def turn(*args, **kwargs):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            try:
+                await asyncio.sleep(upstream_ms / 1000)
+                return 'ok'
+            finally:
+                in_flight -= 1
+
+        client = AsyncClient()
+
+        async def request(number):
+            if bridged:
+                return await sync_to_async(async_to_sync(turn), thread_sensitive=True)()
+            response = await client.post(
+                '/api/v1/chatbot/webchat/', {'session_id': f'benchmark-{number}', 'message': 'oi'},
+                content_type='application/json',
+            )
+            assert response.status_code == 200, response.status_code
+
+        with mock.patch.object(views.chatbot_service, 'handle_message', side_effect=turn):
+            started = time.perf_counter()
+            await asyncio.gather(*(request(number) for number in range(concurrency)))
+            elapsed = time.perf_counter() - started
+        return {"in_flight_peak": peak, "seconds": round(elapsed, 3), "requests_per_second": round(concurrency / elapsed, 1)}
+
+    results = {}
+    with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+        for concurrency in levels:
+            results[f"concurrency_{concurrency}"] = {
+                "async_view": async_to_sync(level)(concurrency, bridged=False),
+                "sync_bridge": async_to_sync(level)(concurrency, bridged=True),
+            }
+    return results
+
+
+# Cadastro, cidade e opções do menu: nenhum turno chama o LLM ou a rede.
+BENCHMARK_SCRIPT = ['oi', 'Maria', 'Feira de Santana - BA', '2', '3', '4', '5']
+
+
+@benchmark('turns')
+def turn_latency(levels=(1, 16, 64)) -> dict:
+    """
+    Latência por turno de N conversas simultâneas (BENCHMARK_SCRIPT) num ChatbotService novo,
+    contra o banco configurado, e a espera de uma chamada vazia no thread pool do
+    sync_to_async durante a carga: a disputa pelo pool que o ORM assíncrono ainda usa.
+    Os usuários 'benchmark_*' são apagados no fim.
+    """
+    async def conversation(service, whatsapp_id, latencies):
+        for text in BENCHMARK_SCRIPT:
+            started = time.perf_counter()
+            await service.handle_message(whatsapp_id, text, 'Visitante', 'webchat')
+            latencies.append(time.perf_counter() - started)
+
+    async def probe(waits, done):
+        while not done.is_set():
+            started = time.perf_counter()
+            await sync_to_async(lambda: None)()
+            waits.append(time.perf_counter() - started)
+            await asyncio.sleep(0.002)
+
+    async def level(users):
+        service = ChatbotService()
+        latencies, waits, done = [], [], asyncio.Event()
+        try:
+            # Primeira conversa fora da conta: carrega prompts, intenções e municípios.
+            await conversation(service, f'benchmark_{users}_aquecimento', [])
+            probing = asyncio.create_task(probe(waits, done))
+            started = time.perf_counter()
+            await asyncio.gather(*(conversation(service, f'benchmark_{users}_{n}', latencies) for n in range(users)))
+            elapsed = time.perf_counter() - started
+            done.set()
+            await probing
+        finally:
+            await service.aclose()
+        return {
+            "turns": len(latencies),
+            "turns_per_second": round(len(latencies) / elapsed, 1),
+            "turn_p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+            "turn_p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+            "thread_pool_wait_p50_ms": round(percentile(waits, 0.5) * 1000, 2),
+            "thread_pool_wait_p95_ms": round(percentile(waits, 0.95) * 1000, 2),
+        }
+
+    try:
+        return {f"users_{users}": async_to_sync(level)(users) for users in levels}
+    finally:
+        Usuario.objects.filter(whatsapp_id__startswith='benchmark_').delete()
@@ -0,0 +1,133 @@
+# chatbot/cache.py
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncTTLCache:
+    """
+    Cache em memória para respostas de APIs externas.
+
+    - TTL configurável e tamanho máximo com despejo LRU.
+    - Single-flight: pedidos simultâneos para a mesma chave ausente compartilham
+      uma única chamada ao serviço externo.
+    - Stale-while-revalidate: depois do TTL, o valor antigo continua a ser servido
+      (até 'stale_ttl' segundos a mais) enquanto uma atualização roda em segundo plano.
+    As métricas aparecem como '<name>_cache', a não ser que o dono do cache já as inclua
+    nas suas (register_metrics=False).
+    """
+
+    def __init__(self, name: str, ttl: float, max_size: int, stale_ttl: float = 0, register_metrics: bool = True):
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.refresh_errors = 0
+        if register_metrics:
+            metrics.register(f'{name}_cache', self.stats)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.stale_hits + self.misses + self.coalesced
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "refresh_errors": self.refresh_errors,
+            "hit_rate": round((self.hits + self.stale_hits) / lookups, 4) if lookups else 0.0,
+        }
+
+    def peek(self, key: Hashable) -> Optional[Any]:
+        """Valor ainda dentro do TTL, sem carregar nem contar estatísticas."""
+        entry = self._entries.get(key)
+        if entry and time.monotonic() - entry[1] < entry[2]:
+            return entry[0]
+        return None
+
+    def set(self, key: Hashable, value: Any, ttl: float = None):
+        self._entries[key] = (value, time.monotonic(), self.ttl if ttl is None else ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    async def get_or_load(
+        self,
+        key: Hashable,
+        loader: Callable[[], Awaitable[Any]],
+        cacheable: Callable[[Any], bool] = lambda value: True,
+        ttl_for: Optional[Callable[[Any], float]] = None,
+    ) -> Any:
+        """
+        Devolve o valor da chave, chamando 'loader' apenas quando necessário.
+        'cacheable' decide se o resultado deve ser guardado e 'ttl_for' permite
+        um TTL por valor (ex.: resultados negativos expiram mais cedo).
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, stored_at, ttl = entry
+            age = time.monotonic() - stored_at
+            if age < ttl:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return value
+            if age < ttl + self.stale_ttl:
+                self.stale_hits += 1
+                self._entries.move_to_end(key)
+                if key not in self._inflight:
+                    self._start_load(key, loader, cacheable, ttl_for, background=True)
+                return value
+            del self._entries[key]
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = self._start_load(key, loader, cacheable, ttl_for)
+        # shield: se quem pediu primeiro for cancelado, os demais continuam esperando a mesma carga.
+        return await asyncio.shield(task)
+
+    def _start_load(self, key, loader, cacheable, ttl_for, background: bool = False) -> asyncio.Task:
+        task = asyncio.create_task(self._load(key, loader, cacheable, ttl_for, background))
+        self._inflight[key] = task
+        return task
+
+    async def _load(self, key, loader, cacheable, ttl_for, background: bool):
+        try:
+            value = await loader()
+            if cacheable(value):
+                self.set(key, value, ttl=ttl_for(value) if ttl_for else None)
+            return value
+        except Exception:
+            if background:
+                # Falha na atualização em segundo plano: mantém o valor antigo.
+                self.refresh_errors += 1
+                logger.exception(f"Cache '{self.name}': erro ao atualizar a chave {key!r}.")
+                return None
+            raise
+        finally:
+            self._inflight.pop(key, None)
@@ -0,0 +1,63 @@
+# chatbot/consumers.py
+
+import logging
+
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+
+from .serializers import WebchatPayloadSerializer
+from .views import chatbot_service
+
+logger = logging.getLogger(__name__)
+
+
+class WebchatConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Webchat por WebSocket: uma conexão por sessão do site (ws/webchat/<session_id>/).
+
+    O cliente envia {"message": "...", "latitude": ..., "longitude": ...} (coordenadas opcionais)
+    e recebe, para cada mensagem:
+        {"type": "chunk", "text": "..."}   zero ou mais trechos, à medida que são gerados
+        {"type": "done", "response": "...", "session_id": "..."}   a resposta completa
+    ou {"type": "error", ...}.
+
+    O Usuario é buscado uma vez, na primeira mensagem, e reaproveitado enquanto a conexão
+    durar. Uma conexão ociosa não ocupa thread nem conexão com o banco, só o socket.
+    O endpoint POST /webchat/ continua disponível.
+    """
+
+    async def connect(self):
+        self.session_id = self.scope['url_route']['kwargs']['session_id']
+        self.user_id = f"webchat_{self.session_id}"
+        self.user = None
+        await self.accept()
+
+    async def receive_json(self, content, **kwargs):
+        if not isinstance(content, dict):
+            await self.send_json({"type": "error", "errors": {"non_field_errors": ["Envie um objeto JSON."]}})
+            return
+        serializer = WebchatPayloadSerializer(data={**content, "session_id": self.session_id})
+        if not serializer.is_valid():
+            await self.send_json({"type": "error", "errors": serializer.errors})
+            return
+
+        data = serializer.validated_data
+        location_data = {"latitude": data['latitude'], "longitude": data['longitude']} if 'latitude' in data and 'longitude' in data else None
+        try:
+            created = False
+            if self.user is None:
+                self.user, created = await chatbot_service.get_or_create_user(self.user_id, "Visitante", 'webchat')
+            response_text = await chatbot_service.handle_message(
+                self.user_id, data['message'], "Visitante", 'webchat', location_data,
+                user=self.user, created=created, on_chunk=self._send_chunk,
+            )
+        except Exception:
+            logger.exception(f"Erro ao processar webchat (WebSocket) para user_id: {self.user_id}")
+            # O turno pode ter alterado o Usuario em memória sem gravar (ex.: 'reiniciar' limpa o nome):
+            # a próxima mensagem o relê do banco.
+            self.user = None
+            await self.send_json({"type": "error", "response": "Desculpe, ocorreu um erro no nosso servidor."})
+            return
+        await self.send_json({"type": "done", "response": response_text, "session_id": self.session_id})
+
+    async def _send_chunk(self, text: str):
+        await self.send_json({"type": "chunk", "text": text})
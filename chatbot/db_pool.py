@@ -0,0 +1,109 @@
+# chatbot/db_pool.py
+
+import logging
+import threading
+import time
+import weakref
+
+from django.db import connections
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Mensagens do PostgreSQL quando o servidor não aceita mais conexões.
+_SERVER_FULL_MESSAGES = ('too many clients', 'remaining connection slots')
+
+
+def pool_saturated(exc: BaseException) -> bool:
+    """
+    True se o erro (ou a sua causa) indica falta de conexões: o pool do psycopg esgotou
+    o DB_POOL_TIMEOUT sem conexão livre, ou o servidor recusou novas conexões.
+    """
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        if type(exc).__name__ == 'PoolTimeout':
+            return True
+        if any(message in str(exc) for message in _SERVER_FULL_MESSAGES):
+            return True
+        exc = exc.__cause__ or exc.__context__
+    return False
+
+
+def _existing_pool(alias: str):
+    """Pool já criado para o alias (sem criá-lo só para ler métricas), ou None."""
+    wrapper = connections[alias]
+    return getattr(type(wrapper), '_connection_pools', {}).get(alias)
+
+
+class DatabaseMonitor:
+    """
+    Métricas das conexões com o banco neste processo.
+
+    - Conexões abertas pelo Django (sinal connection_created) e a idade das que estão
+      em uso. Com pool, uma conexão "aberta" pelo Django é uma conexão emprestada do pool.
+    - Com DB_POOL, as estatísticas do psycopg_pool: tamanho, livres, em uso, requisições
+      esperando por uma conexão e erros.
+    - Erros de saturação (pool esgotado ou servidor cheio) reportados pelas views.
+    """
+
+    def __init__(self, alias: str = 'default'):
+        self.alias = alias
+        self.connections_opened = 0
+        self.saturation_errors = 0
+        self._open = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def connection_opened(self, connection):
+        if connection.alias != self.alias:
+            return
+        with self._lock:
+            self.connections_opened += 1
+            self._open[connection] = time.monotonic()
+
+    def record_saturation(self):
+        self.saturation_errors += 1
+        logger.warning(f"AVISO: Banco saturado: nenhuma conexão livre ({self.saturation_errors} ocorrência(s)).")
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            ages = [now - opened for wrapper, opened in list(self._open.items()) if wrapper.connection is not None]
+        result = {
+            "mode": "pool" if connections[self.alias].settings_dict['OPTIONS'].get('pool') else "persistent",
+            "connections_opened": self.connections_opened,
+            "in_use": len(ages),
+            "oldest_connection_s": round(max(ages), 1) if ages else 0.0,
+            "avg_connection_age_s": round(sum(ages) / len(ages), 1) if ages else 0.0,
+            "saturation_errors": self.saturation_errors,
+        }
+        pool = _existing_pool(self.alias)
+        if pool is not None:
+            pool_stats = pool.get_stats()
+            size, available = pool_stats.get('pool_size', 0), pool_stats.get('pool_available', 0)
+            result["pool"] = {
+                "min_size": pool_stats.get('pool_min'),
+                "max_size": pool_stats.get('pool_max'),
+                "size": size,
+                "available": available,
+                "checked_out": size - available,
+                "waiting": pool_stats.get('requests_waiting', 0),
+                "requests": pool_stats.get('requests_num', 0),
+                "avg_wait_ms": round(pool_stats.get('requests_wait_ms', 0) / pool_stats['requests_queued'], 1)
+                if pool_stats.get('requests_queued') else 0.0,
+                "request_errors": pool_stats.get('requests_errors', 0),
+                "connection_errors": pool_stats.get('connections_errors', 0),
+                "connections_lost": pool_stats.get('connections_lost', 0),
+            }
+        return result
+
+    def close_pools(self):
+        """Fecha o pool (se houver) no shutdown do worker."""
+        pool = _existing_pool(self.alias)
+        if pool is not None:
+            connections[self.alias].close_pool()
+
+
+db_monitor = DatabaseMonitor()
+metrics.register('database', db_monitor.stats)
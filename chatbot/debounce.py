@@ -0,0 +1,189 @@
+# chatbot/debounce.py
+
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Hashable, List, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Por quanto tempo (segundos) mensagens de um turno que falhou esperam a próxima mensagem do usuário.
+CARRY_OVER_SECONDS = 600
+
+
+class InboundMessage(NamedTuple):
+    text: str
+    location_data: Optional[dict]
+    received_at: datetime
+
+
+class _Window:
+    __slots__ = ('messages', 'arrived')
+
+    def __init__(self, message: InboundMessage):
+        self.messages = [message]
+        self.arrived = asyncio.Event()
+
+
+class MessageDebouncer:
+    """
+    Junta as mensagens que um usuário manda em sequência ('oi' / 'quero saber' / 'do milho')
+    num único turno de conversa.
+
+    A primeira mensagem abre uma janela de WHATSAPP_DEBOUNCE_SECONDS; cada nova mensagem do
+    mesmo usuário entra na janela e a reinicia, até WHATSAPP_DEBOUNCE_MAX_SECONDS desde a
+    primeira. Quem abriu a janela recebe as mensagens agrupadas em turnos (submit) e
+    responde por todas. As demais chamadas só esperam a janela fechar: recebem None assim
+    que a mensagem delas é entregue a um turno, sem esperar a resposta.
+    Se o turno falha, quem abriu a janela devolve as mensagens das outras chamadas
+    (carry_over): elas entram no começo da próxima janela do usuário, aberta quando a
+    Evolution API reenviar a mensagem que falhou (ou o usuário escrever de novo), se isso
+    acontecer em até CARRY_OVER_SECONDS.
+    Textos seguidos viram um turno só; uma localização é sempre um turno à parte.
+    Com WHATSAPP_DEBOUNCE_SECONDS=0, cada mensagem é um turno, sem espera.
+
+    As janelas ficam na memória do processo: só se juntam as mensagens que chegam ao
+    mesmo worker. Com vários workers, cada um agrupa as que recebe. As tarefas da fila
+    durável (WEBHOOK_FAST_ACK) não passam por aqui: cada uma é um turno.
+    """
+
+    def __init__(self):
+        self._open: Dict[Hashable, _Window] = {}
+        # Mensagens que entraram na janela de outra chamada -> fechamento da janela
+        self._waiting: Dict[int, asyncio.Future] = {}
+        # Mensagens de turnos que falharam, à espera da próxima janela do usuário (prazo, mensagens)
+        self._carried: Dict[Hashable, Tuple[float, List[InboundMessage]]] = {}
+        self._loop = None
+        # Métricas
+        self.messages_in = 0
+        self.turns_out = 0
+        self.windows = 0
+        self.max_window_size = 0
+        self.carried_over = 0
+        metrics.register('whatsapp_debounce', self.stats)
+
+    async def submit(self, key: Hashable, message: InboundMessage) -> Optional[List[List[InboundMessage]]]:
+        """
+        Turnos a processar (cada um, as mensagens originais), ou None se a mensagem entrou na
+        janela de outra chamada e foi entregue ao turno dela.
+        """
+        self.messages_in += 1
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._open = {}
+            self._waiting = {}
+            self._carried = {}
+        carried = self._take_carried(key, loop.time())
+        if settings.WHATSAPP_DEBOUNCE_SECONDS <= 0:
+            turns = self._group(carried + [message])
+            self.turns_out += len(turns)
+            return turns
+
+        window = self._open.get(key)
+        if window is not None:
+            window.messages.append(message)
+            window.arrived.set()
+            outcome = self._waiting[id(message)] = loop.create_future()
+            # Levanta RuntimeError se a janela foi cancelada antes de virar turno.
+            await outcome
+            return None
+
+        window = self._open[key] = _Window(message)
+        window.messages[:0] = carried
+        closes_at = loop.time() + settings.WHATSAPP_DEBOUNCE_MAX_SECONDS
+        try:
+            while True:
+                wait = min(settings.WHATSAPP_DEBOUNCE_SECONDS, closes_at - loop.time())
+                if wait <= 0:
+                    break
+                window.arrived.clear()
+                try:
+                    async with asyncio.timeout(wait):
+                        await window.arrived.wait()
+                except TimeoutError:
+                    break
+        except BaseException:
+            # Cancelado antes do turno: as chamadas que entraram na janela respondem erro.
+            self._release(window.messages, RuntimeError("Janela de agrupamento cancelada."))
+            if carried:
+                self._carried[key] = (loop.time() + CARRY_OVER_SECONDS, carried)
+            raise
+        finally:
+            # A próxima mensagem abre uma janela nova.
+            self._open.pop(key, None)
+
+        # As mensagens das outras chamadas já estão num turno: os webhooks delas podem responder.
+        self._release(window.messages)
+        turns = self._group(window.messages)
+        self.windows += 1
+        self.turns_out += len(turns)
+        self.max_window_size = max(self.max_window_size, len(window.messages))
+        if len(window.messages) > 1:
+            logger.info(f"{len(window.messages)} mensagens de {key} agrupadas em {len(turns)} turno(s).")
+        return turns
+
+    def carry_over(self, key: Hashable, messages: List[InboundMessage]):
+        """Guarda as mensagens de um turno que falhou para o começo da próxima janela do usuário."""
+        if not messages or self._loop is None:
+            return
+        _, previous = self._carried.get(key, (0.0, []))
+        self._carried[key] = (self._loop.time() + CARRY_OVER_SECONDS, previous + list(messages))
+        self.carried_over += len(messages)
+        logger.warning(f"AVISO: {len(messages)} mensagem(ns) de {key} voltaram para a próxima janela após um turno com erro.")
+
+    def _take_carried(self, key: Hashable, now: float) -> List[InboundMessage]:
+        expires_at, messages = self._carried.pop(key, (0.0, []))
+        if messages and expires_at < now:
+            logger.warning(f"AVISO: {len(messages)} mensagem(ns) de {key} descartadas: o usuário não escreveu de novo a tempo.")
+            return []
+        return messages
+
+    def _release(self, messages: List[InboundMessage], error: Exception = None):
+        for message in messages:
+            outcome = self._waiting.pop(id(message), None)
+            if outcome is None or outcome.done():
+                continue
+            if error is None:
+                outcome.set_result(None)
+            else:
+                outcome.set_exception(error)
+
+    @staticmethod
+    def _group(messages: List[InboundMessage]) -> List[List[InboundMessage]]:
+        turns: List[List[InboundMessage]] = []
+        texts: List[InboundMessage] = []
+        for message in messages:
+            if message.location_data is None:
+                texts.append(message)
+                continue
+            if texts:
+                turns.append(texts)
+                texts = []
+            turns.append([message])
+        if texts:
+            turns.append(texts)
+        return turns
+
+    @staticmethod
+    def merged_text(messages: List[InboundMessage]) -> str:
+        return ' '.join(message.text.strip() for message in messages if message.text and message.text.strip())
+
+    def stats(self) -> dict:
+        return {
+            "window_seconds": settings.WHATSAPP_DEBOUNCE_SECONDS,
+            "messages_in": self.messages_in,
+            "turns_out": self.turns_out,
+            "open_windows": len(self._open),
+            "windows": self.windows,
+            "max_window_size": self.max_window_size,
+            # Mensagens de turnos que falharam, levadas para a janela seguinte do usuário.
+            "carried_over": self.carried_over,
+            "waiting_carry_over": sum(len(messages) for _, messages in self._carried.values()),
+            # Fração de turnos (e chamadas a jusante) evitada pelo agrupamento.
+            "reduction": round(1 - self.turns_out / self.messages_in, 4) if self.messages_in else 0.0,
+        }
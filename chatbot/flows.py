@@ -0,0 +1,143 @@
+# chatbot/flows.py
+"""
+Estados da conversa do chatbot. Cada handler recebe um Turn, devolve o texto da
+resposta e indica o próximo estado com turn.goto(). Um handler que não chama goto()
+mantém a conversa no mesmo estado.
+"""
+
+from . import metrics
+from .fsm import MENU, StateMachine, Turn
+
+ASK_NAME = 'awaiting_initial_name'
+ASK_LOCATION = 'awaiting_location'
+WEATHER_CHOICE = 'awaiting_weather_location_choice'
+WEATHER_CITY = 'awaiting_weather_location'
+WEATHER_FOLLOWUP = 'awaiting_weather_followup'
+
+# Comandos aceitos em qualquer estado para recomeçar o cadastro.
+RESTART_COMMANDS = frozenset({'reiniciar', 'recomeçar', 'inicio'})
+
+# Opções do menu ainda sem fluxo próprio: intenção -> prompt de "em breve".
+MENU_FEATURE_PROMPTS = {
+    'plantio': 'feature_planting_wip',
+    'precos': 'feature_prices_wip',
+    'relatorios': 'feature_reports_wip',
+    'safra': 'feature_harvest_wip',
+}
+
+machine = StateMachine()
+metrics.register('fsm', machine.stats)
+
+
+def _with_menu(turn: Turn, text: str) -> str:
+    return f"{text}\n\n{turn.prompt('main_menu_v2')}"
+
+
+@machine.state(
+    MENU,
+    transitions={WEATHER_CHOICE},
+    prompts={'weather_submenu_choice', 'feature_planting_wip', 'feature_prices_wip',
+             'feature_reports_wip', 'feature_harvest_wip', 'default_fallback', 'main_menu_v2',
+             'system_prompt_tools', 'llm_busy_retry'},
+)
+async def main_menu(turn: Turn) -> str:
+    intent = turn.intent('menu')
+    if intent == 'clima':
+        turn.goto(WEATHER_CHOICE)
+        return turn.prompt('weather_submenu_choice')
+    if intent in MENU_FEATURE_PROMPTS:
+        return turn.prompt(MENU_FEATURE_PROMPTS[intent])
+    # Pergunta livre: o consultor agrícola responde; sem LLM, o menu é mostrado de novo.
+    answer = await turn.service.answer_with_llm(turn)
+    if answer:
+        return answer
+    return _with_menu(turn, turn.render('default_fallback', user_nome=turn.first_name))
+
+
+@machine.state(
+    ASK_NAME,
+    transitions={ASK_LOCATION},
+    prompts={'welcome_ask_location_whatsapp', 'welcome_ask_location_web'},
+)
+async def ask_name(turn: Turn) -> str:
+    turn.user.nome = turn.message_text.strip().title()
+    turn.goto(ASK_LOCATION)
+    prompt_key = 'welcome_ask_location_whatsapp' if turn.channel == 'whatsapp' else 'welcome_ask_location_web'
+    return turn.render(prompt_key, user_nome=turn.user.nome)
+
+
+@machine.state(
+    ASK_LOCATION,
+    transitions={MENU},
+    prompts={'location_received_whatsapp', 'location_received_web', 'location_not_found_web',
+             'location_error', 'main_menu_v2'},
+)
+async def ask_location(turn: Turn) -> str:
+    # Uma única tentativa: com ou sem sucesso, a conversa volta ao menu.
+    turn.goto(MENU)
+    service, user = turn.service, turn.user
+
+    if turn.channel == 'whatsapp' and turn.location_data:
+        lat, lon = turn.location_data['latitude'], turn.location_data['longitude']
+        details = await service.get_location_details_from_coords(lat, lon)
+        if details:
+            # O pino enviado é mais preciso que a sede do município.
+            service._apply_location(user, {**details, "lat": lat, "lon": lon})
+            return _with_menu(turn, turn.render('location_received_whatsapp', user_nome=user.nome))
+    elif turn.message_text:
+        details = await service.get_location_details_from_city(turn.message_text)
+        if details:
+            service._apply_location(user, details)
+            return _with_menu(turn, turn.render('location_received_web', cidade=user.cidade, user_nome=user.nome))
+        return turn.render('location_not_found_web', cidade=turn.message_text)
+
+    return turn.prompt('location_error')
+
+
+@machine.state(
+    WEATHER_CHOICE,
+    transitions={WEATHER_FOLLOWUP, ASK_LOCATION, WEATHER_CITY},
+    prompts={'weather_location_not_found', 'weather_ask_another_city', 'weather_choice_invalid'},
+)
+async def weather_choice(turn: Turn) -> str:
+    intent = turn.intent('weather_choice')
+    if intent == 'minha_cidade':
+        if turn.user.cidade:
+            turn.goto(WEATHER_FOLLOWUP)
+            text, _ = await turn.service._format_weather_response(turn.user.cidade)
+            return text
+        turn.goto(ASK_LOCATION)
+        return turn.prompt('weather_location_not_found')
+    if intent == 'outra_cidade':
+        turn.goto(WEATHER_CITY)
+        return turn.prompt('weather_ask_another_city')
+    return turn.prompt('weather_choice_invalid')
+
+
+@machine.state(
+    WEATHER_CITY,
+    transitions={WEATHER_FOLLOWUP},
+    prompts={'weather_city_not_found', 'weather_dynamic_response'},
+)
+async def weather_city(turn: Turn) -> str:
+    # Se a cidade não for encontrada, continua aguardando outro nome.
+    text, found = await turn.service._format_weather_response(turn.message_text)
+    if found:
+        turn.goto(WEATHER_FOLLOWUP)
+    return text
+
+
+@machine.state(
+    WEATHER_FOLLOWUP,
+    transitions={WEATHER_CITY, MENU},
+    prompts={'weather_ask_another_city', 'main_menu_v2'},
+)
+async def weather_followup(turn: Turn) -> str:
+    if turn.intent('weather_followup') == 'outra_cidade':
+        turn.goto(WEATHER_CITY)
+        return turn.prompt('weather_ask_another_city')
+    turn.goto(MENU)
+    return turn.prompt('main_menu_v2')
+
+
+machine.compile()
@@ -0,0 +1,191 @@
+# chatbot/fsm.py
+
+import logging
+import time
+from typing import Awaitable, Callable, Dict, FrozenSet, Iterable, NamedTuple, Optional
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .admission import PRIORITY_INTERACTIVE
+
+logger = logging.getLogger(__name__)
+
+# Chave do contexto que guarda o estado atual da conversa.
+STATE_KEY = 'estado'
+# Estado implícito quando a conversa não aguarda nada: o menu principal.
+MENU = 'menu'
+# Prefixo das flags usadas antes do motor de estados ({'awaiting_location': True}).
+LEGACY_PREFIX = 'awaiting_'
+
+
+class Turn:
+    """
+    Tudo o que um handler precisa para responder a uma mensagem.
+    O handler devolve o texto da resposta e, se for o caso, chama goto() com o próximo estado.
+    """
+
+    def __init__(self, service, user, context: dict, message_text: str, channel: str, location_data: dict = None,
+                 on_chunk: 'ChunkCallback' = None, priority: int = PRIORITY_INTERACTIVE):
+        self.service = service
+        self.user = user
+        self.context = context
+        self.message_text = message_text
+        self.message_lower = message_text.lower().strip()
+        self.channel = channel
+        self.location_data = location_data
+        self.on_chunk = on_chunk
+        # Prioridade das chamadas ao LLM deste turno na fila de admissão.
+        self.priority = priority
+        self.state = current_state(context)
+        self.next_state = self.state
+        self._allowed: FrozenSet[str] = frozenset()
+
+    def goto(self, state: str):
+        """Agenda a transição para 'state' (MENU volta ao menu principal)."""
+        if state not in self._allowed:
+            raise ImproperlyConfigured(
+                f"Transição não declarada: '{self.state}' -> '{state}'. Declare-a em transitions."
+            )
+        self.next_state = state
+
+    @property
+    def streaming(self) -> bool:
+        """True se o canal recebe a resposta em trechos (ex.: webchat por WebSocket)."""
+        return self.on_chunk is not None
+
+    async def emit(self, chunk: str):
+        """
+        Envia um trecho da resposta assim que ele fica pronto (sem efeito fora do streaming).
+        Os trechos emitidos devem formar o início do texto que o handler devolve.
+        """
+        if self.on_chunk is not None and chunk:
+            await self.on_chunk(chunk)
+
+    def intent(self, scope: str) -> Optional[str]:
+        """Intenção da mensagem segundo as palavras-chave do escopo (tabela IntentKeyword)."""
+        return self.service.intents.match(scope, self.message_text)
+
+    def prompt(self, key: str) -> str:
+        return self.service._get_prompt(key)
+
+    def render(self, key: str, **kwargs) -> str:
+        return self.service._render_prompt(key, **kwargs)
+
+    @property
+    def first_name(self) -> str:
+        return (self.user.nome or '').split(' ')[0]
+
+
+Handler = Callable[[Turn], Awaitable[str]]
+# Recebe cada trecho da resposta em streaming.
+ChunkCallback = Callable[[str], Awaitable[None]]
+
+
+class State(NamedTuple):
+    name: str
+    handler: Handler
+    transitions: FrozenSet[str]
+    prompts: FrozenSet[str]
+
+
+def current_state(context: dict) -> str:
+    """Estado salvo no contexto; aceita o formato antigo com flags 'awaiting_*'."""
+    state = context.get(STATE_KEY)
+    if state:
+        return state
+    return next((key for key in context if key.startswith(LEGACY_PREFIX) and context[key]), MENU)
+
+
+def set_state(context: dict, state: str):
+    """Grava o estado no contexto, removendo eventuais flags do formato antigo."""
+    for key in [key for key in context if key.startswith(LEGACY_PREFIX)]:
+        context.pop(key, None)
+    if state == MENU:
+        context.pop(STATE_KEY, None)
+    else:
+        context[STATE_KEY] = state
+
+
+class StateMachine:
+    """
+    Máquina de estados da conversa, declarada como tabela:
+
+        @machine.state('awaiting_location', transitions={MENU}, prompts={'location_error'})
+        async def awaiting_location(turn): ...
+
+    compile() valida a tabela uma vez (transições para estados existentes) e congela o
+    despacho num dicionário: cada mensagem custa um lookup, qualquer que seja o número
+    de estados. O tempo de cada handler é medido por estado.
+    """
+
+    def __init__(self):
+        self._declared: Dict[str, State] = {}
+        self._compiled: Optional[Dict[str, State]] = None
+        self._timings: Dict[str, list] = {}
+
+    def state(self, name: str, transitions: Iterable[str] = (), prompts: Iterable[str] = ()):
+        def register(handler: Handler) -> Handler:
+            if name in self._declared:
+                raise ImproperlyConfigured(f"Estado '{name}' declarado duas vezes.")
+            self._declared[name] = State(name, handler, frozenset(transitions) | {name}, frozenset(prompts))
+            self._compiled = None
+            return handler
+        return register
+
+    def compile(self) -> Dict[str, State]:
+        if MENU not in self._declared:
+            raise ImproperlyConfigured(f"A máquina de estados precisa do estado '{MENU}'.")
+        for state in self._declared.values():
+            unknown = state.transitions - set(self._declared)
+            if unknown:
+                raise ImproperlyConfigured(f"Estado '{state.name}' declara transições para estados inexistentes: {sorted(unknown)}.")
+        self._compiled = dict(self._declared)
+        self._timings = {name: [0, 0.0, 0.0, 0] for name in self._compiled}
+        return self._compiled
+
+    @property
+    def states(self) -> Dict[str, State]:
+        return self._compiled if self._compiled is not None else self.compile()
+
+    def prompt_keys(self) -> FrozenSet[str]:
+        """Todas as chaves de Prompt usadas pelos estados (para validação e warmup)."""
+        return frozenset().union(*(state.prompts for state in self.states.values()))
+
+    async def dispatch(self, turn: Turn) -> str:
+        states = self.states
+        state = states.get(turn.state)
+        if state is None:
+            # Estado salvo por uma versão que não existe mais: volta ao menu.
+            logger.warning(f"AVISO: Estado desconhecido '{turn.state}' no contexto. Voltando ao menu.")
+            turn.state = turn.next_state = MENU
+            state = states[MENU]
+        turn._allowed = state.transitions
+
+        started = time.perf_counter()
+        failed = True
+        try:
+            response = await state.handler(turn)
+            failed = False
+        finally:
+            self._record(state.name, time.perf_counter() - started, failed)
+
+        set_state(turn.context, turn.next_state)
+        return response
+
+    def _record(self, name: str, elapsed: float, failed: bool):
+        timing = self._timings[name]
+        timing[0] += 1
+        timing[1] += elapsed
+        timing[2] = max(timing[2], elapsed)
+        timing[3] += failed
+
+    def stats(self) -> dict:
+        return {
+            name: {
+                "count": count,
+                "avg_ms": round(total / count * 1000, 3) if count else 0.0,
+                "max_ms": round(longest * 1000, 3),
+                "errors": errors,
+            }
+            for name, (count, total, longest, errors) in self._timings.items()
+        }
@@ -0,0 +1,308 @@
+# chatbot/gazetteer.py
+"""
+Gazetteer local com os 5.570 municípios do IBGE, para resolver cidade e estado
+sem chamar a API de geocodificação.
+
+O arquivo chatbot/data/municipios.csv combina os códigos e nomes do IBGE
+(pacote brutils, licença MIT) com as coordenadas da sede municipal do GeoNames
+(CC BY 4.0). Alguns poucos municípios não têm coordenadas e só servem para
+busca por nome.
+"""
+
+import bisect
+import csv
+import logging
+import re
+import sys
+import threading
+from array import array
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+
+from . import metrics
+from .spatial import KDTree
+from .text import normalize_text
+
+logger = logging.getLogger(__name__)
+
+UF_NAMES = {
+    'AC': 'Acre', 'AL': 'Alagoas', 'AP': 'Amapá', 'AM': 'Amazonas', 'BA': 'Bahia',
+    'CE': 'Ceará', 'DF': 'Distrito Federal', 'ES': 'Espírito Santo', 'GO': 'Goiás',
+    'MA': 'Maranhão', 'MT': 'Mato Grosso', 'MS': 'Mato Grosso do Sul', 'MG': 'Minas Gerais',
+    'PA': 'Pará', 'PB': 'Paraíba', 'PR': 'Paraná', 'PE': 'Pernambuco', 'PI': 'Piauí',
+    'RJ': 'Rio de Janeiro', 'RN': 'Rio Grande do Norte', 'RS': 'Rio Grande do Sul',
+    'RO': 'Rondônia', 'RR': 'Roraima', 'SC': 'Santa Catarina', 'SP': 'São Paulo',
+    'SE': 'Sergipe', 'TO': 'Tocantins',
+}
+_UF_BY_NAME = {normalize_text(name): uf for uf, name in UF_NAMES.items()}
+# Hífen só separa o estado com espaços dos dois lados: 'Ji-Paraná' e 'Grão-Pará' são nomes.
+_SEPARATORS = re.compile(r"\s*[/,(]\s*|\s+-\s+")
+# Nomes mais curtos que isso não passam pela busca aproximada nem pelo prefixo: palavras
+# comuns ('milho', 'banana') ficam a uma edição de algum município (Milhã, Bananal).
+_FUZZY_MIN_LENGTH = 7
+_PUNCTUATION = re.compile(r"[^\w' ]+")
+
+
+class Municipio(NamedTuple):
+    codigo_ibge: int
+    nome: str
+    uf: str
+    latitude: Optional[float]
+    longitude: Optional[float]
+
+
+def _search_key(text: str) -> str:
+    """Normalização usada no índice: sem acentos, minúscula, hífens viram espaço."""
+    return normalize_text(_PUNCTUATION.sub(' ', (text or '').replace('-', ' ')))
+
+
+def split_state(text: str) -> Tuple[str, Optional[str]]:
+    """
+    Separa um eventual estado do final do texto.
+    'Feira de Santana - BA', 'feira de santana ba' e 'Feira de Santana, Bahia'
+    devolvem ('Feira de Santana', 'BA').
+    """
+    raw = (text or '').strip().rstrip(')').strip()
+    parts = _SEPARATORS.split(raw)
+    if len(parts) > 1:
+        tail = normalize_text(parts[-1])
+        uf = tail.upper() if tail.upper() in UF_NAMES else _UF_BY_NAME.get(tail)
+        if uf:
+            return ' '.join(parts[:-1]).strip(), uf
+    words = raw.split()
+    if len(words) > 1 and words[-1].upper() in UF_NAMES:
+        return ' '.join(words[:-1]), words[-1].upper()
+    return raw, None
+
+
+def _bounded_levenshtein(a: str, b: str, limit: int) -> int:
+    """Distância de edição com corte: devolve limit + 1 assim que passa do limite."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i] + [0] * len(b)
+        lo, hi = max(1, i - limit), min(len(b), i + limit)
+        if lo > 1:
+            current[lo - 1] = limit + 1
+        row_min = current[lo - 1] if lo > 1 else i
+        for j in range(lo, hi + 1):
+            cost = 0 if char_a == b[j - 1] else 1
+            value = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            current[j] = value
+            if value < row_min:
+                row_min = value
+        if hi < len(b):
+            current[hi + 1:] = [limit + 1] * (len(b) - hi)
+        if row_min > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def _trigrams(key: str) -> List[str]:
+    padded = f"  {key} "
+    return [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+
+class Gazetteer:
+    """
+    Índice compacto em memória sobre os municípios:
+    - busca exata e por prefixo, insensível a acentos (dicionário + lista ordenada com bisect);
+    - busca aproximada com distância de edição limitada, usando um índice de trigramas
+      para filtrar candidatos antes do cálculo de Levenshtein;
+    - município mais próximo de uma coordenada (KD-tree sobre as sedes municipais).
+    Códigos e coordenadas ficam em arrays compactos; NaN marca coordenada ausente.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._loaded = False
+        self.codes = array('l')
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+        self.names: List[str] = []
+        self.ufs: List[str] = []
+        self._exact: Dict[str, Tuple[int, ...]] = {}
+        self._sorted_keys: List[str] = []
+        self._key_lengths = array('B')
+        self._trigram_index: Dict[str, array] = {}
+        self._tree: Optional[KDTree] = None
+
+    # --- Carga ---
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def ensure_loaded(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._load()
+
+    def _load(self):
+        path = self.path or settings.GAZETTEER_PATH
+        exact = defaultdict(list)
+        with open(path, encoding='utf-8', newline='') as csv_file:
+            for row in csv.DictReader(csv_file):
+                position = len(self.names)
+                self.codes.append(int(row['codigo_ibge']))
+                self.names.append(row['nome'])
+                self.ufs.append(row['uf'])
+                self.latitudes.append(float(row['latitude']) if row['latitude'] else float('nan'))
+                self.longitudes.append(float(row['longitude']) if row['longitude'] else float('nan'))
+                exact[_search_key(row['nome'])].append(position)
+
+        self._exact = {key: tuple(positions) for key, positions in exact.items()}
+        self._sorted_keys = sorted(self._exact)
+        self._key_lengths = array('B', (min(len(key), 255) for key in self._sorted_keys))
+        trigram_index = defaultdict(lambda: array('H'))
+        for key_number, key in enumerate(self._sorted_keys):
+            for trigram in set(_trigrams(key)):
+                trigram_index[trigram].append(key_number)
+        self._trigram_index = dict(trigram_index)
+        self._tree = KDTree(zip(self.latitudes, self.longitudes))
+        self._loaded = True
+        logger.info(f"Gazetteer carregado: {len(self.names)} municípios ({self.memory_bytes() // 1024} KiB).")
+
+    # --- Consultas ---
+
+    def municipio(self, position: int) -> Municipio:
+        lat, lon = self.latitudes[position], self.longitudes[position]
+        return Municipio(
+            self.codes[position], self.names[position], self.ufs[position],
+            None if lat != lat else lat, None if lon != lon else lon,
+        )
+
+    def _filter(self, positions, uf: Optional[str]) -> List[int]:
+        return [p for p in positions if uf is None or self.ufs[p] == uf]
+
+    def exact(self, name: str, uf: Optional[str] = None) -> List[Municipio]:
+        self.ensure_loaded()
+        return [self.municipio(p) for p in self._filter(self._exact.get(_search_key(name), ()), uf)]
+
+    def prefix(self, name: str, uf: Optional[str] = None, limit: int = 10) -> List[Municipio]:
+        self.ensure_loaded()
+        key = _search_key(name)
+        found = []
+        position = bisect.bisect_left(self._sorted_keys, key)
+        while position < len(self._sorted_keys) and len(found) < limit:
+            candidate = self._sorted_keys[position]
+            if not candidate.startswith(key):
+                break
+            found.extend(self._filter(self._exact[candidate], uf))
+            position += 1
+        return [self.municipio(p) for p in found[:limit]]
+
+    def fuzzy(self, name: str, uf: Optional[str] = None, max_edits: int = None) -> List[Tuple[int, Municipio]]:
+        """Municípios a até 'max_edits' edições do nome, ordenados pela distância."""
+        self.ensure_loaded()
+        key = _search_key(name)
+        if max_edits is None:
+            max_edits = 0 if len(key) < _FUZZY_MIN_LENGTH else 1 if len(key) < 12 else 2
+        # Lema dos q-gramas: cada edição destrói no máximo 3 trigramas, então um candidato
+        # compartilha pelo menos 'needed' trigramas com a consulta. Basta olhar as listas
+        # dos (total - needed + 1) trigramas mais raros para não perder nenhum.
+        query_grams = set(_trigrams(key))
+        grams = sorted(query_grams, key=lambda gram: len(self._trigram_index.get(gram, ())))
+        needed = max(1, len(grams) - 3 * max_edits)
+        candidates = set()
+        for gram in grams[:len(grams) - needed + 1]:
+            candidates.update(self._trigram_index.get(gram, ()))
+
+        results = []
+        lengths = self._key_lengths
+        for key_number in candidates:
+            if abs(lengths[key_number] - len(key)) > max_edits:
+                continue
+            candidate = self._sorted_keys[key_number]
+            if len(query_grams.intersection(_trigrams(candidate))) < needed:
+                continue
+            distance = _bounded_levenshtein(key, candidate, max_edits)
+            if distance <= max_edits:
+                results.extend((distance, self.municipio(p)) for p in self._filter(self._exact[candidate], uf))
+        results.sort(key=lambda item: (item[0], item[1].nome))
+        return results
+
+    def resolve(self, text: str) -> Optional[Municipio]:
+        """
+        Resolve um texto livre ('Feira de Santana - BA', 'feira de santana', 'Feira de Santanna')
+        para um único município. Devolve None se não encontrar ou se a resposta for ambígua
+        (ex.: 'Bom Jesus' sem estado), deixando a decisão para a API externa.
+        """
+        name, uf = split_state(text)
+        key = _search_key(name)
+        if len(key) < 3:
+            return None
+
+        matches = self.exact(name, uf)
+        if len(matches) == 1:
+            return matches[0]
+        if matches:
+            return None
+
+        if len(key) < _FUZZY_MIN_LENGTH:
+            return None
+        close = self.fuzzy(name, uf)
+        if close:
+            if len(close) == 1 or close[0][0] < close[1][0]:
+                return close[0][1]
+            return None
+
+        # Nome incompleto ('Feira de San'): aceito só se houver um único município com o prefixo.
+        matches = self.prefix(name, uf, limit=2)
+        if len(matches) == 1:
+            return matches[0]
+        return None
+
+    def nearest(self, lat: float, lon: float, max_km: float = None) -> Optional[Tuple[Municipio, float]]:
+        """
+        Geocodificação reversa offline: município cuja sede é a mais próxima do ponto,
+        com a distância em km. Sem limites municipais, pontos perto de uma divisa podem
+        cair no vizinho; 'max_km' descarta pontos longe de qualquer sede (ex.: fora do Brasil).
+        """
+        self.ensure_loaded()
+        found = self._tree.nearest(float(lat), float(lon), max_km)
+        if found is None:
+            return None
+        position, distance = found
+        return self.municipio(position), distance
+
+    def nearest_many(self, points, max_km: float = None) -> List[Optional[Tuple[Municipio, float]]]:
+        """Versão em lote de nearest(), usada no backfill de usuários."""
+        self.ensure_loaded()
+        return [
+            None if found is None else (self.municipio(found[0]), found[1])
+            for found in self._tree.nearest_many(((float(lat), float(lon)) for lat, lon in points), max_km)
+        ]
+
+    # --- Diagnóstico ---
+
+    def memory_bytes(self) -> int:
+        """Estimativa do espaço ocupado pelo índice (estruturas + strings)."""
+        size = sum(sys.getsizeof(a) for a in (self.codes, self.latitudes, self.longitudes))
+        size += sys.getsizeof(self.names) + sum(sys.getsizeof(n) for n in self.names)
+        size += sys.getsizeof(self.ufs)
+        size += sys.getsizeof(self._exact) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in self._exact.items())
+        size += sys.getsizeof(self._sorted_keys)
+        size += sys.getsizeof(self._trigram_index) + sum(
+            sys.getsizeof(k) + sys.getsizeof(v) for k, v in self._trigram_index.items()
+        )
+        if self._tree is not None:
+            size += self._tree.memory_bytes()
+        return size
+
+    def stats(self) -> dict:
+        return {
+            "loaded": self._loaded,
+            "municipios": len(self.names),
+            "memory_kib": self.memory_bytes() // 1024 if self._loaded else 0,
+        }
+
+
+gazetteer = Gazetteer()
+metrics.register('gazetteer', gazetteer.stats)
@@ -0,0 +1,88 @@
+# chatbot/geocoding.py
+
+import logging
+from datetime import timedelta
+from typing import Awaitable, Callable, Optional
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import metrics
+from .cache import AsyncTTLCache
+from .models import GeocodeCacheEntry
+from .text import normalize_text
+
+logger = logging.getLogger(__name__)
+
+
+def forward_key(city: str) -> str:
+    return normalize_text(city)
+
+
+def reverse_key(lat: float, lon: float) -> str:
+    """
+    Arredonda as coordenadas para a grade GEOCODE_GRID_DEGREES, para que pinos
+    próximos (ex.: vários pontos da mesma fazenda) caiam na mesma entrada.
+    """
+    grid = settings.GEOCODE_GRID_DEGREES
+    snapped_lat = round(round(float(lat) / grid) * grid, 6)
+    snapped_lon = round(round(float(lon) / grid) * grid, 6)
+    return f"{snapped_lat:.6f},{snapped_lon:.6f}"
+
+
+class GeocodeCache:
+    """
+    Cache de geocodificação em duas camadas: memória (AsyncTTLCache) na frente
+    da tabela tb_geocode_cache. Municípios não mudam de lugar, então resultados
+    positivos não expiram no banco; resultados vazios expiram após GEOCODE_NEGATIVE_TTL.
+    """
+
+    def __init__(self):
+        self.memory = AsyncTTLCache(
+            'geocode',
+            ttl=settings.GEOCODE_MEMORY_TTL,
+            max_size=settings.GEOCODE_MEMORY_MAX_SIZE,
+            register_metrics=False,
+        )
+        self.db_hits = 0
+        self.api_calls = 0
+        metrics.register('geocode_cache', self.stats)
+
+    def stats(self) -> dict:
+        return {**self.memory.stats(), "db_hits": self.db_hits, "api_calls": self.api_calls}
+
+    async def lookup(self, tipo: str, chave: str, fetch: Callable[[], Awaitable[Optional[dict]]]) -> dict:
+        """
+        Resolve a chave pela memória, depois pelo banco e só então pela API ('fetch').
+        'fetch' deve levantar exceção em falhas de rede, para que erros
+        temporários não sejam guardados como resultado negativo.
+        """
+        result = await self.memory.get_or_load(
+            (tipo, chave),
+            lambda: self._load(tipo, chave, fetch),
+            ttl_for=lambda value: settings.GEOCODE_MEMORY_TTL if value else settings.GEOCODE_NEGATIVE_TTL,
+        )
+        return dict(result) if result else {}
+
+    async def _load(self, tipo: str, chave: str, fetch) -> Optional[dict]:
+        found, result = await self._read(tipo, chave)
+        if found:
+            self.db_hits += 1
+            return result
+
+        self.api_calls += 1
+        result = await fetch() or None
+        await self._write(tipo, chave, result)
+        return result
+
+    async def _read(self, tipo: str, chave: str):
+        entry = await GeocodeCacheEntry.objects.filter(tipo=tipo, chave=chave).afirst()
+        if entry is None or (entry.expira_em and entry.expira_em <= timezone.now()):
+            return False, None
+        return True, entry.resultado
+
+    async def _write(self, tipo: str, chave: str, result: Optional[dict]):
+        expira_em = None if result else timezone.now() + timedelta(seconds=settings.GEOCODE_NEGATIVE_TTL)
+        await GeocodeCacheEntry.objects.aupdate_or_create(
+            tipo=tipo, chave=chave, defaults={'resultado': result, 'expira_em': expira_em}
+        )
@@ -0,0 +1,224 @@
+# chatbot/history.py
+
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+from . import metrics
+from .admission import PRIORITY_BACKGROUND, AdmissionRejected
+from .llm import estimate_tokens
+from .models import Interacao, Usuario
+
+logger = logging.getLogger(__name__)
+
+# (horário, mensagem do agricultor, resposta do bot)
+HistoryRow = Tuple[datetime, str, str]
+
+# Colunas do resumo no Usuario. O usuário de uma sessão do ConversationStateStore não as
+# carrega: são lidas do banco na primeira vez que o turno precisa do histórico.
+SUMMARY_FIELDS = ['resumo_conversa', 'resumo_atualizado_ate']
+
+# Tamanho máximo de cada mensagem levada ao resumo: respostas longas (listas de preços,
+# explicações) não precisam entrar inteiras para serem resumidas.
+SUMMARY_MESSAGE_CHARS = 600
+
+
+class ConversationHistory:
+    """
+    Histórico da conversa (tb_interacoes) como contexto do LLM, com custo limitado.
+
+    - As últimas LLM_HISTORY_TURNS interações vão na íntegra; as anteriores chegam ao
+      modelo só pelo resumo guardado em Usuario.resumo_conversa.
+    - Resumo e interações cabem em LLM_HISTORY_TOKEN_BUDGET tokens: o resumo usa no máximo
+      metade, e as interações mais antigas saem primeiro quando o resto não basta.
+    - Quando LLM_HISTORY_SUMMARY_BATCH interações ficam para trás da janela sem estar no
+      resumo, uma tarefa em segundo plano as incorpora ao resumo atual (atualizado, não
+      refeito), com prioridade de segundo plano na fila do LLM. A resposta ao agricultor
+      nunca espera por ela.
+    Interações ainda no buffer do InteractionLogger também entram na janela.
+    """
+
+    SUMMARY_PROMPT_KEY = 'conversation_summary'
+
+    def __init__(self, llm, interaction_log, prompts):
+        self.llm = llm
+        self.interaction_log = interaction_log
+        self.prompts = prompts
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._warned_missing = False
+        # Métricas
+        self.builds = 0
+        self.trimmed = 0
+        self.max_context_tokens = 0
+        self._total_context_tokens = 0
+        self.summaries = 0
+        self.summary_failures = 0
+        self.summary_conflicts = 0
+        self.turns_folded = 0
+        self._total_summary_time = 0.0
+        metrics.register('conversation_history', self.stats)
+
+    async def build(self, user: Usuario) -> List[dict]:
+        """Mensagens de contexto (resumo + interações recentes), da mais antiga para a mais nova."""
+        if user.get_deferred_fields().intersection(SUMMARY_FIELDS):
+            await user.arefresh_from_db(fields=SUMMARY_FIELDS)
+        window = settings.LLM_HISTORY_TURNS
+        rows = await self._recent(user.pk, user.resumo_atualizado_ate, window + settings.LLM_HISTORY_SUMMARY_BATCH)
+        if len(rows) - window >= settings.LLM_HISTORY_SUMMARY_BATCH:
+            self.schedule_summary(user)
+        messages, tokens = self._fit(user.resumo_conversa, rows[-window:] if window > 0 else [])
+        self.builds += 1
+        self._total_context_tokens += tokens
+        self.max_context_tokens = max(self.max_context_tokens, tokens)
+        return messages
+
+    def _fit(self, summary: str, rows: List[HistoryRow]) -> Tuple[List[dict], int]:
+        budget = settings.LLM_HISTORY_TOKEN_BUDGET
+        head: List[dict] = []
+        used = 0
+        limit = budget // 2
+        if summary and limit > 1:
+            content = f"Resumo da conversa até aqui: {summary}"
+            if estimate_tokens(content) > limit:
+                content = content[:(limit - 1) * 4]
+                self.trimmed += 1
+            head.append({"role": "system", "content": content})
+            used += estimate_tokens(content)
+
+        turns: List[dict] = []
+        for _, question, answer in reversed(rows):
+            cost = estimate_tokens(question) + estimate_tokens(answer)
+            if used + cost > budget:
+                self.trimmed += 1
+                break
+            used += cost
+            # Mensagens agrupadas num turno só (MessageDebouncer) não têm resposta própria.
+            pair = [{"role": "user", "content": question or ''}]
+            if answer:
+                pair.append({"role": "assistant", "content": answer})
+            turns[:0] = pair
+        return head + turns, used
+
+    async def _recent(self, agricultor_id: int, since: Optional[datetime], limit: int) -> List[HistoryRow]:
+        """As 'limit' interações mais novas depois de 'since', em ordem cronológica."""
+        # Lidas antes do banco: uma linha gravada durante a consulta aparece em uma das duas.
+        pending = [
+            (row['timestamp'], row['mensagem_usuario'], row['resposta_chatbot'])
+            for row in self.interaction_log.pending(agricultor_id)
+            if since is None or row['timestamp'] > since
+        ]
+        queryset = Interacao.objects.filter(agricultor_id=agricultor_id)
+        if since is not None:
+            queryset = queryset.filter(timestamp__gt=since)
+        rows = [
+            row async for row in
+            queryset.order_by('-timestamp').values_list('timestamp', 'mensagem_usuario', 'resposta_chatbot')[:limit]
+        ]
+        stored = set(rows)
+        rows.extend(row for row in pending if row not in stored)
+        rows.sort(key=lambda row: row[0])
+        return rows[-limit:]
+
+    # --- Resumo em segundo plano ---
+
+    def schedule_summary(self, user: Usuario):
+        """Agenda a atualização do resumo do usuário (uma por vez por usuário)."""
+        if user.pk in self._tasks or not self.llm.available:
+            return
+        if not self.prompts.data.get(self.SUMMARY_PROMPT_KEY):
+            if not self._warned_missing:
+                self._warned_missing = True
+                logger.warning(f"AVISO: Prompt '{self.SUMMARY_PROMPT_KEY}' não configurado; o resumo da conversa não será atualizado.")
+            return
+        task = asyncio.create_task(self._summarize(user))
+        self._tasks[user.pk] = task
+        task.add_done_callback(lambda _: self._tasks.pop(user.pk, None))
+
+    async def _summarize(self, user: Usuario):
+        prompt = self.prompts.data.get(self.SUMMARY_PROMPT_KEY)
+        since = user.resumo_atualizado_ate
+        rows = await self._unsummarized(user.pk, since)
+        if not rows:
+            return
+
+        started = time.perf_counter()
+        transcript = "\n".join(
+            f"Agricultor: {(question or '')[:SUMMARY_MESSAGE_CHARS]}\nIagro: {(answer or '')[:SUMMARY_MESSAGE_CHARS]}"
+            for _, question, answer in rows
+        )
+        messages = [
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": f"Resumo atual: {user.resumo_conversa or '(vazio)'}\n\nTrechos novos da conversa:\n{transcript}"},
+        ]
+        try:
+            answer = await self.llm.stream(
+                messages, priority=PRIORITY_BACKGROUND, organizacao_id=user.organizacao_id,
+                max_tokens=settings.LLM_HISTORY_SUMMARY_MAX_TOKENS,
+            )
+        except AdmissionRejected:
+            # Sem vaga ou sem orçamento: as interações continuam pendentes e entram num próximo resumo.
+            self.summary_failures += 1
+            return
+        except Exception:
+            self.summary_failures += 1
+            logger.exception(f"Erro ao resumir a conversa do usuário {user.pk}.")
+            return
+        if answer is None or answer.truncated or not answer.text.strip():
+            self.summary_failures += 1
+            return
+
+        summary, until = answer.text.strip(), rows[-1][0]
+        # Só grava se ninguém (outro worker) atualizou o resumo nesse meio-tempo.
+        updated = await Usuario.objects.filter(pk=user.pk, resumo_atualizado_ate=since).aupdate(
+            resumo_conversa=summary, resumo_atualizado_ate=until,
+        )
+        if not updated:
+            # O resumo do banco é mais novo que o deste objeto (ex.: usuário mantido pela conexão WebSocket).
+            self.summary_conflicts += 1
+            await user.arefresh_from_db(fields=SUMMARY_FIELDS)
+            return
+        user.resumo_conversa, user.resumo_atualizado_ate = summary, until
+        self.summaries += 1
+        self.turns_folded += len(rows)
+        self._total_summary_time += time.perf_counter() - started
+
+    async def _unsummarized(self, agricultor_id: int, since: Optional[datetime]) -> List[HistoryRow]:
+        """Interações fora do resumo e anteriores à janela recente, das mais antigas, em lotes limitados."""
+        queryset = Interacao.objects.filter(agricultor_id=agricultor_id)
+        if since is not None:
+            queryset = queryset.filter(timestamp__gt=since)
+        window = [
+            timestamp async for timestamp in
+            queryset.order_by('-timestamp').values_list('timestamp', flat=True)[:max(settings.LLM_HISTORY_TURNS, 1)]
+        ]
+        if not window:
+            return []
+        older = queryset.filter(timestamp__lt=window[-1]).order_by('timestamp')
+        limit = settings.LLM_HISTORY_SUMMARY_BATCH * 4
+        return [row async for row in older.values_list('timestamp', 'mensagem_usuario', 'resposta_chatbot')[:limit]]
+
+    async def aclose(self):
+        """Cancela os resumos em andamento (shutdown): as interações ficam para um próximo resumo."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "builds": self.builds,
+            "avg_context_tokens": round(self._total_context_tokens / self.builds, 1) if self.builds else 0.0,
+            "max_context_tokens": self.max_context_tokens,
+            "token_budget": settings.LLM_HISTORY_TOKEN_BUDGET,
+            "trimmed": self.trimmed,
+            "summaries_running": len(self._tasks),
+            "summaries": self.summaries,
+            "summary_failures": self.summary_failures,
+            "summary_conflicts": self.summary_conflicts,
+            "turns_folded": self.turns_folded,
+            "avg_summary_ms": round(self._total_summary_time / self.summaries * 1000, 1) if self.summaries else 0.0,
+        }
@@ -0,0 +1,125 @@
+# chatbot/http_clients.py
+
+import logging
+from typing import Dict
+
+import httpx
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def build_async_client(timeout: float = None, **kwargs) -> httpx.AsyncClient:
+    """
+    Cria um httpx.AsyncClient com keep-alive, limites de conexão e timeouts
+    padronizados pelas configurações HTTP_* do settings.
+    """
+    http2 = settings.HTTP_CLIENT_HTTP2
+    if http2 and not _http2_available():
+        logger.warning("HTTP_CLIENT_HTTP2 está ativo, mas o pacote 'h2' não está instalado. Usando HTTP/1.1.")
+        http2 = False
+
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=settings.HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            timeout or settings.HTTP_TIMEOUT,
+            connect=settings.HTTP_CONNECT_TIMEOUT,
+            pool=settings.HTTP_POOL_TIMEOUT,
+        ),
+        **kwargs,
+    )
+
+
+def pool_stats(client: httpx.AsyncClient) -> dict:
+    """
+    Estatísticas do pool de conexões de um cliente: conexões em uso, ociosas
+    e requisições à espera de uma conexão livre.
+    O httpx não expõe isto publicamente, então lemos o pool do httpcore.
+    """
+    pool = getattr(getattr(client, '_transport', None), '_pool', None)
+    if pool is None or client.is_closed:
+        return {"in_use": 0, "idle": 0, "waiting": 0}
+
+    connections = list(getattr(pool, 'connections', []))
+    idle = sum(1 for conn in connections if conn.is_idle())
+    requests = list(getattr(pool, '_requests', []))
+    return {
+        "in_use": len(connections) - idle,
+        "idle": idle,
+        "waiting": sum(1 for request in requests if request.is_queued()),
+    }
+
+
+class UpstreamClients:
+    """
+    Um cliente HTTP de longa duração por serviço externo (Evolution, OpenWeather, OpenAI, Preço da Hora),
+    reaproveitando conexões TCP/TLS entre mensagens.
+    Os clientes são criados sob demanda e recriados se tiverem sido fechados.
+    """
+
+    def __init__(self):
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        metrics.register('http_pools', self.stats)
+
+    def _build(self, name: str) -> httpx.AsyncClient:
+        if name == 'evolution':
+            return build_async_client(
+                base_url=settings.EVOLUTION_API_URL or "",
+                headers={"apikey": settings.EVOLUTION_API_KEY or ""},
+            )
+        if name == 'openweather':
+            return build_async_client(base_url="http://api.openweathermap.org")
+        if name == 'precodahora':
+            return build_async_client(base_url=settings.PRECODAHORA_SERVICE_URL or "")
+        if name == 'openai':
+            # Respostas de LLM são bem mais lentas que as demais APIs.
+            return build_async_client(timeout=settings.OPENAI_TIMEOUT)
+        raise ValueError(f"Serviço externo desconhecido: '{name}'.")
+
+    def get(self, name: str) -> httpx.AsyncClient:
+        client = self._clients.get(name)
+        if client is None or client.is_closed:
+            client = self._clients[name] = self._build(name)
+        return client
+
+    @property
+    def evolution(self) -> httpx.AsyncClient:
+        return self.get('evolution')
+
+    @property
+    def openweather(self) -> httpx.AsyncClient:
+        return self.get('openweather')
+
+    @property
+    def precodahora(self) -> httpx.AsyncClient:
+        return self.get('precodahora')
+
+    @property
+    def openai(self) -> httpx.AsyncClient:
+        return self.get('openai')
+
+    def stats(self) -> dict:
+        return {name: pool_stats(client) for name, client in self._clients.items()}
+
+    async def aclose(self):
+        for name, client in list(self._clients.items()):
+            try:
+                await client.aclose()
+            except Exception:
+                logger.exception(f"Erro ao fechar o cliente HTTP de '{name}'.")
+        self._clients.clear()
@@ -0,0 +1,87 @@
+# chatbot/intents.py
+
+import logging
+import re
+from collections import defaultdict
+from typing import Dict, NamedTuple, Optional, Pattern, Tuple
+
+from .models import IntentKeyword
+from .snapshots import TableSnapshot
+from .text import normalize_text
+
+logger = logging.getLogger(__name__)
+
+
+class CompiledScope(NamedTuple):
+    pattern: Pattern
+    # nome do grupo no regex -> (intenção, prioridade)
+    groups: Dict[str, Tuple[str, int]]
+
+
+class IntentMatcher(TableSnapshot):
+    """
+    Reconhece a intenção de uma mensagem a partir da tabela IntentKeyword.
+
+    As palavras-chave de cada escopo viram uma única expressão regular (alternância com
+    um grupo nomeado por palavra), delimitada por fronteiras de palavra: '1' casa com
+    'opção 1', mas não com '10 hectares'. O texto é comparado sem acentos e em minúsculas.
+    Uma só passada pela mensagem encontra todas as ocorrências; vence a de maior prioridade
+    e, no empate, a que aparece primeiro.
+    """
+    model = IntentKeyword
+
+    def __init__(self):
+        super().__init__()
+        self._reported = set()
+
+    def build(self, rows):
+        by_scope = defaultdict(list)
+        for keyword in rows:
+            by_scope[keyword.scope].append(keyword)
+        return {scope: self._compile_scope(keywords) for scope, keywords in by_scope.items()}
+
+    def _compile_scope(self, keywords) -> CompiledScope:
+        parts, groups = [], {}
+        # Maior prioridade primeiro e, entre iguais, a palavra mais longa ('outra cidade' antes de 'outra').
+        for number, keyword in enumerate(sorted(keywords, key=lambda k: (-k.priority, -len(k.pattern)))):
+            body = keyword.pattern if keyword.is_regex else re.escape(normalize_text(keyword.pattern))
+            error = self._pattern_error(keyword, body)
+            if error:
+                if (keyword.scope, keyword.pattern) not in self._reported:
+                    self._reported.add((keyword.scope, keyword.pattern))
+                    logger.error(f"Palavra-chave '{keyword.pattern}' ({keyword.scope}) ignorada: {error}.")
+                continue
+            name = f"k{number}"
+            parts.append(f"(?P<{name}>{body})")
+            groups[name] = (keyword.intent, keyword.priority)
+        if not parts:
+            return CompiledScope(re.compile(r"(?!)"), {})
+        return CompiledScope(re.compile(r"(?<!\w)(?:" + "|".join(parts) + r")(?!\w)"), groups)
+
+    @staticmethod
+    def _pattern_error(keyword, body: str) -> str:
+        if not body:
+            return "padrão vazio"
+        if keyword.is_regex and '(?P<' in body:
+            return "grupos nomeados não são permitidos"
+        try:
+            if re.compile(body).match(''):
+                return "o padrão casa com texto vazio"
+        except re.error as e:
+            return f"expressão regular inválida ({e})"
+        return ''
+
+    def match(self, scope: str, text: str) -> Optional[str]:
+        """Intenção da mensagem no escopo, ou None se nenhuma palavra-chave aparecer."""
+        compiled = self.data.get(scope)
+        if compiled is None:
+            return None
+        best = None
+        for found in compiled.pattern.finditer(normalize_text(text)):
+            intent, priority = compiled.groups[found.lastgroup]
+            if best is None or priority > best[1]:
+                best = (intent, priority)
+        return best[0] if best else None
+
+
+intent_matcher = IntentMatcher()
@@ -0,0 +1,228 @@
+# chatbot/interaction_log.py
+
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+from django.conf import settings
+from django.utils import timezone
+from channels.db import database_sync_to_async
+
+from . import metrics
+from .models import Interacao
+
+logger = logging.getLogger(__name__)
+
+
+class InteractionLogger:
+    """
+    Registro de interações com escrita adiada (write-behind).
+
+    Cada turno apenas acrescenta a interação a um buffer em memória; o buffer vai para
+    o banco com bulk_create quando atinge INTERACTION_LOG_BATCH_SIZE linhas ou a cada
+    INTERACTION_LOG_FLUSH_INTERVAL segundos, e também no shutdown (aclose).
+
+    Se o banco estiver indisponível, as linhas vão para um arquivo JSONL
+    (INTERACTION_LOG_SPILL_PATH), limitado a INTERACTION_LOG_SPILL_MAX_BYTES; o que
+    não couber é descartado e contado. O arquivo é reprocessado no próximo flush bem-sucedido.
+    """
+
+    def __init__(self):
+        self._buffer: List[dict] = []
+        # Linhas tiradas do buffer por um flush e ainda não gravadas (continuam em pending()).
+        self._in_flight: List[dict] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._timer: Optional[asyncio.Task] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        # Métricas
+        self.flushes = 0
+        self.rows_written = 0
+        self.last_flush_size = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+        self.flush_errors = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.dropped = 0
+        metrics.register('interaction_log', self.stats)
+
+    # --- API usada pelo ChatbotService ---
+
+    def log(self, agricultor_id: int, user_message: str, bot_response: str, timestamp: datetime = None):
+        """Enfileira uma interação. Não bloqueia: a gravação acontece em segundo plano."""
+        self._buffer.append({
+            'agricultor_id': agricultor_id,
+            'mensagem_usuario': user_message,
+            'resposta_chatbot': bot_response,
+            'timestamp': timestamp or timezone.now(),
+        })
+        self._ensure_timer()
+
+        if len(self._buffer) >= settings.INTERACTION_LOG_MAX_BUFFER:
+            # O banco não está dando vazão: as linhas mais antigas vão para o disco.
+            overflow = self._buffer[:settings.INTERACTION_LOG_BATCH_SIZE]
+            del self._buffer[:len(overflow)]
+            self._spill(overflow)
+        if len(self._buffer) >= settings.INTERACTION_LOG_BATCH_SIZE and not self._flushing():
+            self._flush_task = asyncio.create_task(self.flush())
+
+    def pending(self, agricultor_id: int) -> List[dict]:
+        """Interações do agricultor ainda não gravadas (no buffer ou no flush em andamento), da mais antiga para a mais nova."""
+        return [row for row in (*self._in_flight, *self._buffer) if row['agricultor_id'] == agricultor_id]
+
+    async def flush(self):
+        """Grava tudo o que está no buffer (e o que estiver no arquivo de contingência)."""
+        async with self._get_lock():
+            rows, self._buffer = self._buffer, []
+            if rows:
+                started = time.perf_counter()
+                self._in_flight = rows
+                try:
+                    await database_sync_to_async(self._write)(rows)
+                except Exception as e:
+                    self.flush_errors += 1
+                    logger.error(f"ERRO DE BANCO: Falha ao gravar {len(rows)} interações. Enviando para o arquivo de contingência. Erro: {e}")
+                    self._spill(rows)
+                    return
+                finally:
+                    self._in_flight = []
+                self._record_flush(len(rows), (time.perf_counter() - started) * 1000)
+
+            if self._spill_path().exists():
+                await self._replay_spill()
+
+    async def aclose(self):
+        """Encerra o timer e grava o que restou no buffer (shutdown do ASGI ou dos workers)."""
+        if self._timer is not None and self._loop is asyncio.get_running_loop():
+            self._timer.cancel()
+        self._timer = None
+        if self._flushing():
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "buffered": len(self._buffer),
+            "in_flight": len(self._in_flight),
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "last_flush_size": self.last_flush_size,
+            "avg_flush_size": round(self.rows_written / self.flushes, 1) if self.flushes else 0.0,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "avg_flush_ms": round(self._total_flush_ms / self.flushes, 2) if self.flushes else 0.0,
+            "max_flush_ms": round(self.max_flush_ms, 2),
+            "flush_errors": self.flush_errors,
+            "spilled": self.spilled,
+            "replayed": self.replayed,
+            "dropped": self.dropped,
+        }
+
+    # --- Internos ---
+
+    def _get_lock(self) -> asyncio.Lock:
+        if self._flush_lock is None or self._loop is not asyncio.get_running_loop():
+            self._flush_lock = asyncio.Lock()
+        return self._flush_lock
+
+    def _flushing(self) -> bool:
+        return self._flush_task is not None and not self._flush_task.done()
+
+    def _ensure_timer(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._timer is None or self._timer.done():
+            # Novo event loop (ex.: asyncio.run em um comando de gerenciamento): recria o timer.
+            self._loop = loop
+            self._flush_lock = None
+            self._flush_task = None
+            self._timer = loop.create_task(self._periodic_flush())
+
+    async def _periodic_flush(self):
+        while True:
+            await asyncio.sleep(settings.INTERACTION_LOG_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Erro inesperado no flush periódico das interações.")
+
+    def _record_flush(self, size: int, elapsed_ms: float):
+        self.flushes += 1
+        self.rows_written += size
+        self.last_flush_size = size
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+        self._total_flush_ms += elapsed_ms
+
+    @staticmethod
+    def _write(rows: List[dict]):
+        Interacao.objects.bulk_create(
+            [Interacao(**row) for row in rows],
+            batch_size=settings.INTERACTION_LOG_BATCH_SIZE,
+        )
+
+    # --- Arquivo de contingência ---
+
+    @staticmethod
+    def _spill_path() -> Path:
+        return Path(settings.INTERACTION_LOG_SPILL_PATH)
+
+    def _spill(self, rows: List[dict]):
+        path = self._spill_path()
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            size = path.stat().st_size if path.exists() else 0
+            lines = []
+            for row in rows:
+                line = json.dumps({**row, 'timestamp': row['timestamp'].isoformat()}, ensure_ascii=False) + '\n'
+                line_size = len(line.encode('utf-8'))
+                if size + line_size > settings.INTERACTION_LOG_SPILL_MAX_BYTES:
+                    break
+                size += line_size
+                lines.append(line)
+            with open(path, 'a', encoding='utf-8') as spill_file:
+                spill_file.writelines(lines)
+        except OSError as e:
+            logger.error(f"ERRO: Não foi possível gravar o arquivo de contingência '{path}'. Erro: {e}")
+            lines = []
+        self.spilled += len(lines)
+        if len(lines) < len(rows):
+            self.dropped += len(rows) - len(lines)
+            logger.error(f"ERRO: {len(rows) - len(lines)} interações descartadas (arquivo de contingência cheio ou inacessível).")
+
+    async def _replay_spill(self):
+        # Renomear é atômico: se vários processos dividem o arquivo, só um o reprocessa.
+        path = self._spill_path()
+        claimed = path.with_name(f"{path.name}.{os.getpid()}.replay")
+        try:
+            os.replace(path, claimed)
+        except FileNotFoundError:
+            return
+
+        rows = []
+        with open(claimed, encoding='utf-8') as spill_file:
+            for line in spill_file:
+                try:
+                    row = json.loads(line)
+                    row['timestamp'] = datetime.fromisoformat(row['timestamp'])
+                except (ValueError, KeyError, TypeError):
+                    # Linha truncada (ex.: processo morto no meio da escrita).
+                    self.dropped += 1
+                    continue
+                rows.append(row)
+
+        try:
+            await database_sync_to_async(self._write)(rows)
+        except Exception as e:
+            logger.error(f"ERRO DE BANCO: Falha ao reprocessar o arquivo de contingência. Erro: {e}")
+            self.spilled -= len(rows)
+            self._spill(rows)
+        else:
+            self.replayed += len(rows)
+            logger.info(f"{len(rows)} interações do arquivo de contingência gravadas no banco.")
+        claimed.unlink(missing_ok=True)
@@ -0,0 +1,273 @@
+# chatbot/jobs.py
+
+import asyncio
+import logging
+import random
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Avg, Count, DurationField, Exists, ExpressionWrapper, F, Min, OuterRef, Q
+from django.utils import timezone
+from channels.db import database_sync_to_async
+
+from . import metrics
+from .admission import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+from .llm import ParagraphStream
+from .models import WebhookJob
+from .serializers import extract_message_fields
+
+logger = logging.getLogger(__name__)
+
+
+# ===========================
+# OPERAÇÕES SOBRE A FILA
+# ===========================
+
+def enqueue_webhook_job(data_payload: dict) -> bool:
+    """
+    Persiste o evento validado na fila.
+    Retorna False se o mesmo evento (mesmo ID de mensagem) já estava enfileirado,
+    o que acontece quando a Evolution API reenvia um webhook.
+    """
+    user_id = data_payload.get('key', {}).get('remoteJid')
+    message_id = data_payload.get('key', {}).get('id') or None
+    try:
+        with transaction.atomic():
+            WebhookJob.objects.create(message_id=message_id, whatsapp_id=user_id, payload=data_payload)
+    except IntegrityError:
+        logger.info(f"Webhook duplicado ignorado (message_id={message_id}).")
+        return False
+    return True
+
+
+def claim_webhook_jobs(limit: int = 1):
+    """
+    Reserva até 'limit' tarefas prontas para execução.
+    Usa SELECT ... FOR UPDATE SKIP LOCKED para que vários workers (e processos)
+    possam drenar a fila sem disputar as mesmas linhas. Tarefas presas em
+    'processando' além do tempo de visibilidade (worker que morreu) voltam a ser elegíveis.
+
+    Cada usuário tem no máximo uma tarefa em andamento, e sempre a mais antiga: uma
+    tarefa só é elegível se não há outra do mesmo usuário em 'processando' nem uma mais
+    antiga ainda em aberto (inclusive aguardando nova tentativa). Assim as mensagens são
+    processadas na ordem em que chegaram, mesmo com workers em processos diferentes.
+    """
+    now = timezone.now()
+    stale_before = now - timedelta(seconds=settings.WEBHOOK_JOB_VISIBILITY_TIMEOUT)
+    same_user = WebhookJob.objects.filter(whatsapp_id=OuterRef('whatsapp_id')).exclude(pk=OuterRef('pk'))
+    earlier_open = same_user.filter(
+        pk__lt=OuterRef('pk'), status__in=[WebhookJob.STATUS_PENDENTE, WebhookJob.STATUS_PROCESSANDO],
+    )
+    running = same_user.filter(status=WebhookJob.STATUS_PROCESSANDO, inicio_processamento__gte=stale_before)
+    with transaction.atomic():
+        jobs = list(
+            WebhookJob.objects.select_for_update(skip_locked=True)
+            .filter(
+                Q(status=WebhookJob.STATUS_PENDENTE, proxima_tentativa__lte=now)
+                | Q(status=WebhookJob.STATUS_PROCESSANDO, inicio_processamento__lt=stale_before)
+            )
+            .filter(~Exists(earlier_open), ~Exists(running))
+            .order_by('proxima_tentativa', 'id')[:limit]
+        )
+        if jobs:
+            WebhookJob.objects.filter(pk__in=[job.pk for job in jobs]).update(
+                status=WebhookJob.STATUS_PROCESSANDO,
+                inicio_processamento=now,
+                tentativas=F('tentativas') + 1,
+            )
+    for job in jobs:
+        job.status = WebhookJob.STATUS_PROCESSANDO
+        job.inicio_processamento = now
+        job.tentativas += 1
+    return jobs
+
+
+def save_job_response(job: WebhookJob, response_text: str):
+    WebhookJob.objects.filter(pk=job.pk).update(resposta=response_text, data_atualizacao=timezone.now())
+
+
+def save_job_progress(job: WebhookJob, sent_paragraphs: int):
+    WebhookJob.objects.filter(pk=job.pk).update(paragrafos_enviados=sent_paragraphs, data_atualizacao=timezone.now())
+
+
+def complete_webhook_job(job: WebhookJob):
+    WebhookJob.objects.filter(pk=job.pk).update(
+        status=WebhookJob.STATUS_CONCLUIDO, ultimo_erro=None, data_atualizacao=timezone.now()
+    )
+
+
+def retry_delay(attempt: int) -> float:
+    """Backoff exponencial com jitter: base * 2^(n-1), limitado ao máximo configurado."""
+    delay = min(
+        settings.WEBHOOK_JOB_RETRY_BASE_SECONDS * (2 ** max(attempt - 1, 0)),
+        settings.WEBHOOK_JOB_RETRY_MAX_SECONDS,
+    )
+    return delay * random.uniform(0.8, 1.2)
+
+
+def fail_webhook_job(job: WebhookJob, error: str) -> bool:
+    """
+    Registra a falha. Reagenda com backoff ou, esgotadas as tentativas,
+    move a tarefa para o estado de dead-letter. Retorna True se foi descartada.
+    """
+    dead = job.tentativas >= settings.WEBHOOK_JOB_MAX_ATTEMPTS
+    updates = {'ultimo_erro': error, 'data_atualizacao': timezone.now()}
+    if dead:
+        updates['status'] = WebhookJob.STATUS_FALHOU
+    else:
+        updates['status'] = WebhookJob.STATUS_PENDENTE
+        updates['proxima_tentativa'] = timezone.now() + timedelta(seconds=retry_delay(job.tentativas))
+    WebhookJob.objects.filter(pk=job.pk).update(**updates)
+    return dead
+
+
+def webhook_queue_stats() -> dict:
+    """
+    Fila e workers vistos pelo banco, valendo para workers em qualquer processo: profundidade
+    por status, atraso (lag) da tarefa pronta mais antiga, tarefas aguardando nova tentativa
+    e, na última hora, as concluídas e a duração média da tentativa que as concluiu.
+    """
+    now = timezone.now()
+    counts = {
+        status: (total, retrying)
+        for status, total, retrying in WebhookJob.objects.exclude(status=WebhookJob.STATUS_CONCLUIDO)
+        .values_list('status')
+        .annotate(total=Count('id'), retrying=Count('id', filter=Q(tentativas__gt=0)))
+    }
+    oldest = WebhookJob.objects.filter(
+        status=WebhookJob.STATUS_PENDENTE, proxima_tentativa__lte=now
+    ).aggregate(oldest=Min('data_criacao'))['oldest']
+    recent = WebhookJob.objects.filter(
+        status=WebhookJob.STATUS_CONCLUIDO, data_atualizacao__gte=now - timedelta(hours=1)
+    ).aggregate(
+        processed=Count('id'),
+        duration=Avg(ExpressionWrapper(F('data_atualizacao') - F('inicio_processamento'), output_field=DurationField())),
+    )
+    pending = counts.get(WebhookJob.STATUS_PENDENTE, (0, 0))
+    return {
+        "pending": pending[0],
+        "retrying": pending[1],
+        "processing": counts.get(WebhookJob.STATUS_PROCESSANDO, (0, 0))[0],
+        "dead_letter": counts.get(WebhookJob.STATUS_FALHOU, (0, 0))[0],
+        "lag_seconds": round((now - oldest).total_seconds(), 3) if oldest else 0.0,
+        "processed_last_hour": recent['processed'],
+        "avg_duration_seconds": round(recent['duration'].total_seconds(), 3) if recent['duration'] else 0.0,
+    }
+
+
+metrics.register('webhook_queue', webhook_queue_stats)
+
+
+# ===========================
+# POOL DE WORKERS ASSÍNCRONOS
+# ===========================
+
+class WebhookWorkerPool:
+    """
+    Conjunto de corrotinas que drenam a fila de webhooks: executam o turno de
+    conversa, enviam a resposta e tratam retentativas/dead-letter.
+    Os contadores daqui são só deste processo (ex.: para o log do comando); o painel
+    lê os da fila inteira em webhook_queue_stats, calculados a partir do banco.
+    """
+
+    def __init__(self, chatbot_service, concurrency: int = None, poll_interval: float = None):
+        self.chatbot_service = chatbot_service
+        self.concurrency = concurrency or settings.WEBHOOK_WORKERS
+        self.poll_interval = poll_interval or settings.WEBHOOK_WORKER_POLL_INTERVAL
+        self._stopping = asyncio.Event()
+        self._tasks = []
+        self.processed = 0
+        self.retried = 0
+        self.dead_lettered = 0
+        self.busy = 0
+        self._total_duration = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.concurrency,
+            "busy": self.busy,
+            "processed": self.processed,
+            "retried": self.retried,
+            "dead_lettered": self.dead_lettered,
+            "avg_duration_seconds": round(self._total_duration / self.processed, 3) if self.processed else 0.0,
+        }
+
+    async def run(self):
+        logger.info(f"Iniciando {self.concurrency} workers da fila de webhooks.")
+        self._tasks = [asyncio.create_task(self._worker_loop(i)) for i in range(self.concurrency)]
+        await asyncio.gather(*self._tasks)
+
+    def stop(self):
+        """Pede aos workers que terminem após a tarefa atual."""
+        self._stopping.set()
+
+    async def _worker_loop(self, worker_number: int):
+        while not self._stopping.is_set():
+            try:
+                jobs = await database_sync_to_async(claim_webhook_jobs)(1)
+            except Exception:
+                logger.exception(f"Worker {worker_number}: erro ao reservar tarefas da fila.")
+                jobs = []
+
+            if not jobs:
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            for job in jobs:
+                await self._run_job(job)
+
+    async def _process_and_send(self, job: WebhookJob):
+        # Respostas em streaming (LLM) saem um parágrafo por mensagem, à medida que ficam prontas.
+        # Numa nova tentativa, os parágrafos já aceitos pela Evolution API não são reenviados.
+        paragraphs = ParagraphStream(
+            lambda text: self.chatbot_service.send_whatsapp_message(job.whatsapp_id, text),
+            skip=job.paragrafos_enviados,
+        )
+
+        # Se o turno já foi executado numa tentativa anterior, só repetimos o envio:
+        # reprocessar a mensagem avançaria a máquina de estados duas vezes.
+        if job.resposta is None:
+            fields = extract_message_fields(job.payload)
+            if fields is None:
+                job.resposta = ""
+                return
+            user_id, push_name, message_text, location_data = fields
+            # Retentativas (ex.: acumuladas durante uma queda do LLM) ficam atrás das mensagens novas.
+            priority = PRIORITY_INTERACTIVE if job.tentativas <= 1 else PRIORITY_BACKGROUND
+            job.resposta = await self.chatbot_service.process_message(
+                user_id, message_text, push_name, 'whatsapp', location_data, on_chunk=paragraphs.feed, priority=priority
+            ) or ""
+            await database_sync_to_async(save_job_response)(job, job.resposta)
+
+        if job.resposta:
+            sent = await paragraphs.finish(job.resposta)
+            if not sent:
+                await database_sync_to_async(save_job_progress)(job, paragraphs.sent_paragraphs)
+                raise RuntimeError("A Evolution API não confirmou o envio da mensagem.")
+
+    async def _run_job(self, job: WebhookJob):
+        started = time.monotonic()
+        self.busy += 1
+        try:
+            # O lock do usuário cobre o turno e o envio: mensagens seguidas do mesmo
+            # agricultor, pegas por workers diferentes, não se cruzam.
+            async with self.chatbot_service.user_locks.hold(job.whatsapp_id):
+                await self._process_and_send(job)
+            await database_sync_to_async(complete_webhook_job)(job)
+            self.processed += 1
+            self._total_duration += time.monotonic() - started
+        except Exception as e:
+            logger.exception(f"Erro ao processar a tarefa de webhook {job.pk} (tentativa {job.tentativas}).")
+            dead = await database_sync_to_async(fail_webhook_job)(job, f"{type(e).__name__}: {e}")
+            if dead:
+                self.dead_lettered += 1
+                logger.error(f"Tarefa de webhook {job.pk} movida para dead-letter após {job.tentativas} tentativas.")
+            else:
+                self.retried += 1
+        finally:
+            self.busy -= 1
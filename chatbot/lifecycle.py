@@ -0,0 +1,93 @@
+# chatbot/lifecycle.py
+
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, Iterable, Tuple
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+WarmupStep = Tuple[str, Callable[[], Awaitable]]
+
+
+class ServiceLifecycle:
+    """
+    Ciclo de vida de um worker do chatbot: aquecimento, prontidão e drenagem.
+
+    - warmup() executa os passos de aquecimento (carga de tabelas, pools...) medindo o
+      tempo de cada um. O worker só fica pronto quando todos terminam sem erro; se algum
+      falhar, um novo warmup() (ex.: na próxima sonda de prontidão) tenta de novo.
+    - track() envolve cada turno de conversa e conta os que estão em andamento.
+    - drain() para de declarar prontidão e espera os turnos em andamento terminarem,
+      até o tempo limite, antes de os recursos serem fechados no shutdown.
+    """
+
+    def __init__(self):
+        self.ready = False
+        self.draining = False
+        self.in_flight = 0
+        self.warmup_ms: Dict[str, float] = {}
+        self.warmup_errors: Dict[str, str] = {}
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._warmup_lock = asyncio.Lock()
+        metrics.register('lifecycle', self.stats)
+
+    async def warmup(self, steps: Iterable[WarmupStep]) -> bool:
+        async with self._warmup_lock:
+            if self.ready:
+                return True
+            started = time.perf_counter()
+            errors = {}
+            for name, step in steps:
+                step_started = time.perf_counter()
+                try:
+                    await step()
+                except Exception as e:
+                    logger.exception(f"Erro no aquecimento '{name}'.")
+                    errors[name] = str(e)
+                self.warmup_ms[name] = round((time.perf_counter() - step_started) * 1000, 1)
+            self.warmup_ms['total'] = round((time.perf_counter() - started) * 1000, 1)
+            self.warmup_errors = errors
+            self.ready = not errors and not self.draining
+            if errors:
+                logger.error(f"Aquecimento incompleto em {self.warmup_ms['total']} ms. Falharam: {sorted(errors)}.")
+            else:
+                logger.info(f"Aquecimento concluído em {self.warmup_ms['total']} ms: {self.warmup_ms}")
+            return self.ready
+
+    @asynccontextmanager
+    async def track(self):
+        self.in_flight += 1
+        self._idle.clear()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            if self.in_flight == 0:
+                self._idle.set()
+
+    async def drain(self, timeout: float) -> bool:
+        """Retorna True se todos os turnos em andamento terminaram dentro do tempo limite."""
+        self.draining = True
+        self.ready = False
+        if self.in_flight:
+            logger.info(f"Encerrando: aguardando {self.in_flight} turno(s) em andamento (até {timeout}s).")
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            logger.warning(f"AVISO: {self.in_flight} turno(s) ainda em andamento após {timeout}s. Encerrando assim mesmo.")
+            return False
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "draining": self.draining,
+            "in_flight": self.in_flight,
+            "warmup_ms": dict(self.warmup_ms),
+            "warmup_errors": dict(self.warmup_errors),
+        }
@@ -0,0 +1,225 @@
+# chatbot/llm.py
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+
+from . import metrics
+from .admission import PRIORITY_INTERACTIVE, AdmissionController
+from .tools import ToolCall
+
+logger = logging.getLogger(__name__)
+
+DeltaCallback = Callable[[str], Awaitable[None]]
+
+
+def estimate_tokens(text: str) -> int:
+    """Tokens aproximados de um texto em português (~4 caracteres por token)."""
+    return len(text or '') // 4 + 1
+
+
+class LLMAnswer(NamedTuple):
+    text: str
+    # True se a geração foi interrompida (tempo total ou erro) depois do primeiro trecho.
+    truncated: bool
+    # Ferramentas que o modelo pediu para chamar (vazio numa resposta só de texto).
+    tool_calls: Tuple[ToolCall, ...] = ()
+
+
+class StreamingLLM:
+    """
+    Respostas em streaming de um modelo compatível com a API de chat da OpenAI.
+
+    - Cada trecho gerado é repassado a 'on_delta' assim que chega (webchat por WebSocket,
+      parágrafos no WhatsApp), então o tempo até o primeiro byte é o do primeiro token.
+    - Cada chamada passa antes pelo AdmissionController (vagas, prioridade e orçamento de
+      tokens da organização); recusada, AdmissionRejected chega a quem chamou.
+    - Sem o primeiro token em LLM_FIRST_TOKEN_TIMEOUT segundos a chamada é abandonada; depois
+      dele, a geração inteira tem até LLM_TOTAL_TIMEOUT segundos. Uma resposta cortada no meio
+      é devolvida como está, marcada como truncada.
+    O cliente vem de 'client_getter' (o AsyncOpenAI do ChatbotService, que pode apontar para
+    outro servidor via OPENAI_BASE_URL, ex.: um servidor falso local nos testes).
+    """
+
+    def __init__(self, client_getter: Callable[[], object], admission: AdmissionController):
+        self._client_getter = client_getter
+        self.admission = admission
+        # Métricas
+        self.in_flight = 0
+        self.calls = 0
+        self.timeouts = 0
+        self.truncated = 0
+        self.errors = 0
+        self._total_ttft = 0.0
+        self._answered = 0
+        self._total_duration = 0.0
+        metrics.register('llm', self.stats)
+
+    @property
+    def available(self) -> bool:
+        return self._client_getter() is not None
+
+    async def stream(self, messages: List[dict], on_delta: DeltaCallback = None, *, priority: int = PRIORITY_INTERACTIVE,
+                     organizacao_id: Optional[int] = None, **options) -> Optional[LLMAnswer]:
+        """
+        Gera a resposta para 'messages'. Retorna None se não houve resposta (erro ou tempo esgotado);
+        levanta AdmissionRejected se a chamada não foi admitida. Os tokens gastos são debitados
+        da organização 'organizacao_id'.
+        """
+        client = self._client_getter()
+        if client is None:
+            return None
+        async with self.admission.admit(priority, organizacao_id):
+            self.in_flight += 1
+            self.calls += 1
+            try:
+                answer, tokens = await self._generate(client, messages, on_delta, options)
+            finally:
+                self.in_flight -= 1
+        await self.admission.charge(organizacao_id, tokens)
+        return answer
+
+    async def _generate(self, client, messages: List[dict], on_delta: Optional[DeltaCallback], options: dict) -> Tuple[Optional[LLMAnswer], int]:
+        """Retorna a resposta e os tokens gastos (informados pela API ou, na falta, estimados)."""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        parts: List[str] = []
+        calls: Dict[int, dict] = {}
+        usage = {}
+        stream = None
+        try:
+            async with asyncio.timeout_at(started + min(settings.LLM_FIRST_TOKEN_TIMEOUT, settings.LLM_TOTAL_TIMEOUT)) as deadline:
+                stream = await client.chat.completions.create(
+                    model=settings.OPENAI_MODEL,
+                    messages=messages,
+                    stream=True,
+                    # O último evento traz o total de tokens da chamada (para o orçamento da organização).
+                    stream_options={"include_usage": True},
+                    **{"max_tokens": settings.LLM_MAX_TOKENS, **options},
+                )
+                async for event in stream:
+                    if event.usage is not None:
+                        usage["tokens"] = event.usage.total_tokens
+                    if not event.choices:
+                        continue
+                    delta = event.choices[0].delta
+                    if not delta.content and not delta.tool_calls:
+                        continue
+                    if not parts and not calls:
+                        self._total_ttft += loop.time() - started
+                        deadline.reschedule(started + settings.LLM_TOTAL_TIMEOUT)
+                    for piece in delta.tool_calls or ():
+                        # Os argumentos de cada chamada chegam em pedaços, identificados pelo índice.
+                        call = calls.setdefault(piece.index, {"id": "", "name": "", "arguments": ""})
+                        call["id"] = piece.id or call["id"]
+                        if piece.function is not None:
+                            call["name"] += piece.function.name or ""
+                            call["arguments"] += piece.function.arguments or ""
+                    if delta.content:
+                        parts.append(delta.content)
+                        if on_delta is not None:
+                            await on_delta(delta.content)
+        except TimeoutError:
+            self.timeouts += 1
+            logger.warning(f"AVISO: Tempo esgotado na geração do LLM ({'com' if parts else 'sem'} resposta parcial).")
+            return self._finish(parts, {}, started, truncated=True), self._tokens(messages, parts, calls, usage)
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"ERRO DE API: Falha na geração do LLM. Erro: {e}")
+            return self._finish(parts, {}, started, truncated=True), self._tokens(messages, parts, calls, usage)
+        finally:
+            if stream is not None:
+                try:
+                    await stream.close()
+                except Exception:
+                    pass
+        return self._finish(parts, calls, started, truncated=False), self._tokens(messages, parts, calls, usage)
+
+    @staticmethod
+    def _tokens(messages: List[dict], parts: List[str], calls: Dict[int, dict], usage: dict) -> int:
+        if "tokens" in usage:
+            return usage["tokens"]
+        if not parts and not calls:
+            return 0
+        # Sem 'usage' (geração interrompida ou servidor que não o envia): estimativa pelo texto.
+        text = ''.join(str(message.get("content") or "") for message in messages)
+        text += ''.join(parts) + ''.join(call["arguments"] for call in calls.values())
+        return estimate_tokens(text)
+
+    def _finish(self, parts: List[str], calls: Dict[int, dict], started: float, truncated: bool) -> Optional[LLMAnswer]:
+        # Chamadas de ferramenta cortadas no meio (truncated) têm argumentos incompletos e são descartadas.
+        if not parts and not calls:
+            return None
+        self._answered += 1
+        self._total_duration += asyncio.get_running_loop().time() - started
+        self.truncated += truncated
+        tool_calls = tuple(ToolCall(call["id"], call["name"], call["arguments"]) for _, call in sorted(calls.items()))
+        return LLMAnswer(''.join(parts), truncated, tool_calls)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "calls": self.calls,
+            "timeouts": self.timeouts,
+            "truncated": self.truncated,
+            "errors": self.errors,
+            "avg_ttft_ms": round(self._total_ttft / self._answered * 1000, 1) if self._answered else 0.0,
+            "avg_duration_ms": round(self._total_duration / self._answered * 1000, 1) if self._answered else 0.0,
+        }
+
+
+class ParagraphStream:
+    """
+    Entrega uma resposta em streaming como mensagens separadas por parágrafo (WhatsApp):
+    cada parágrafo é enviado assim que o seguinte começa, sem esperar o fim da geração.
+    Os trechos recebidos devem formar o início da resposta final (contrato de Turn.emit).
+
+    'sent_paragraphs' conta os parágrafos da resposta (separados por linha em branco) já
+    aceitos pela API; com 'skip', uma nova tentativa envia só os parágrafos seguintes.
+    """
+
+    def __init__(self, send: Callable[[str], Awaitable[bool]], skip: int = 0):
+        self._send = send
+        self._skip = skip
+        self._buffer = ''
+        self.streamed = ''
+        self.sent_messages = 0
+        self.sent_paragraphs = skip
+        self.failed = False
+
+    async def feed(self, chunk: str):
+        self.streamed += chunk
+        self._buffer += chunk
+        while '\n\n' in self._buffer:
+            paragraph, self._buffer = self._buffer.split('\n\n', 1)
+            await self._deliver(paragraph)
+
+    async def finish(self, response: str) -> bool:
+        """Envia o que falta da resposta final. Retorna True se todas as mensagens foram aceitas."""
+        if self._skip:
+            await self._deliver('\n\n'.join(response.split('\n\n')[self._skip:]))
+        elif not self.streamed:
+            await self._deliver(response)
+        elif response.startswith(self.streamed):
+            await self._deliver(self._buffer + response[len(self.streamed):])
+        else:
+            # O handler não respeitou o contrato: reenviar tudo é melhor que perder o fim.
+            logger.warning("AVISO: Resposta final não começa com os trechos já enviados. Enviando a resposta completa.")
+            self.sent_paragraphs = 0
+            await self._deliver(response)
+        self._buffer = ''
+        return not self.failed
+
+    async def _deliver(self, text: str):
+        if self.failed:
+            return
+        paragraphs = text.count('\n\n') + 1
+        text = text.strip()
+        if text:
+            if not await self._send(text):
+                self.failed = True
+                return
+            self.sent_messages += 1
+        self.sent_paragraphs += paragraphs
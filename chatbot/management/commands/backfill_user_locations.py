@@ -0,0 +1,82 @@
+# chatbot/management/commands/backfill_user_locations.py
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from chatbot.gazetteer import gazetteer
+from chatbot.models import Usuario
+
+
+class Command(BaseCommand):
+    help = (
+        "Completa a localização dos usuários usando o gazetteer local: cidade/UF a partir "
+        "das coordenadas e coordenadas (sede do município) a partir de cidade/UF."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Usuários por lote de atualização.")
+        parser.add_argument('--dry-run', action='store_true', help="Apenas conta o que seria alterado.")
+
+    def handle(self, *args, **options):
+        batch_size, dry_run = options['batch_size'], options['dry_run']
+        gazetteer.ensure_loaded()
+
+        from_coords = self._fill_city_from_coords(batch_size, dry_run)
+        from_city = self._fill_coords_from_city(batch_size, dry_run)
+        prefix = "[dry-run] " if dry_run else ""
+        self.stdout.write(self.style.SUCCESS(
+            f"{prefix}{from_coords} usuários com cidade preenchida pelas coordenadas; "
+            f"{from_city} com coordenadas preenchidas pela cidade."
+        ))
+
+    def _batches(self, queryset, batch_size):
+        batch = []
+        for user in queryset.iterator(chunk_size=batch_size):
+            batch.append(user)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _fill_city_from_coords(self, batch_size, dry_run) -> int:
+        queryset = Usuario.objects.filter(
+            latitude__isnull=False, longitude__isnull=False
+        ).filter(Q(cidade__isnull=True) | Q(cidade='')).only('id', 'latitude', 'longitude', 'cidade', 'estado')
+
+        updated = 0
+        for batch in self._batches(queryset, batch_size):
+            results = gazetteer.nearest_many(
+                ((user.latitude, user.longitude) for user in batch),
+                max_km=settings.GAZETTEER_NEAREST_MAX_KM,
+            )
+            changed = []
+            for user, found in zip(batch, results):
+                if found is not None:
+                    municipio, _ = found
+                    user.cidade, user.estado = municipio.nome, municipio.uf
+                    changed.append(user)
+            if changed and not dry_run:
+                Usuario.objects.bulk_update(changed, ['cidade', 'estado'])
+            updated += len(changed)
+        return updated
+
+    def _fill_coords_from_city(self, batch_size, dry_run) -> int:
+        queryset = Usuario.objects.filter(
+            Q(latitude__isnull=True) | Q(longitude__isnull=True)
+        ).exclude(cidade__isnull=True).exclude(cidade='').only('id', 'latitude', 'longitude', 'cidade', 'estado')
+
+        updated = 0
+        for batch in self._batches(queryset, batch_size):
+            changed = []
+            for user in batch:
+                matches = gazetteer.exact(user.cidade, user.estado or None)
+                if len(matches) == 1 and matches[0].latitude is not None:
+                    user.latitude = round(matches[0].latitude, 6)
+                    user.longitude = round(matches[0].longitude, 6)
+                    changed.append(user)
+            if changed and not dry_run:
+                Usuario.objects.bulk_update(changed, ['latitude', 'longitude'])
+            updated += len(changed)
+        return updated
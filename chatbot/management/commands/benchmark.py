@@ -0,0 +1,18 @@
+# chatbot/management/commands/benchmark.py
+
+import json
+
+from django.core.management.base import BaseCommand
+
+from chatbot.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = "Roda uma medição de desempenho de chatbot/benchmarks.py e imprime o resultado em JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', choices=sorted(BENCHMARKS), help="Medição a rodar.")
+
+    def handle(self, *args, **options):
+        result = BENCHMARKS[options['name']]()
+        self.stdout.write(json.dumps(result, indent=2, ensure_ascii=False))
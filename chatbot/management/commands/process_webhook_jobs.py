@@ -0,0 +1,47 @@
+# chatbot/management/commands/process_webhook_jobs.py
+
+import asyncio
+import logging
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chatbot.jobs import WebhookWorkerPool
+from chatbot.services import ChatbotService
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Drena a fila durável de webhooks (modo fast-ack) com um pool de workers assíncronos."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=settings.WEBHOOK_WORKERS,
+            help="Número de workers concorrentes neste processo.",
+        )
+
+    def handle(self, *args, **options):
+        asyncio.run(self._run(options['workers']))
+
+    async def _run(self, workers: int):
+        chatbot_service = ChatbotService()
+        pool = WebhookWorkerPool(chatbot_service, concurrency=workers)
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, pool.stop)
+            except NotImplementedError:
+                # Windows não suporta add_signal_handler; Ctrl+C interrompe o processo.
+                pass
+
+        self.stdout.write(f"Processando a fila de webhooks com {workers} workers...")
+        try:
+            await pool.run()
+        finally:
+            await chatbot_service.aclose()
+        self.stdout.write(f"Workers encerrados. Métricas: {pool.stats()}")
@@ -0,0 +1,31 @@
+# chatbot/metrics.py
+
+import logging
+from typing import Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+# Cada componente (fila de webhooks, caches, pools...) registra aqui uma função
+# que devolve um dicionário com as suas métricas. O painel lê tudo via snapshot().
+_providers: Dict[str, Callable[[], dict]] = {}
+
+
+def register(name: str, provider: Callable[[], dict]):
+    """Registra (ou substitui) o provedor de métricas de um componente."""
+    _providers[name] = provider
+
+
+def unregister(name: str):
+    _providers.pop(name, None)
+
+
+def snapshot() -> dict:
+    """Coleta as métricas de todos os componentes registrados neste processo."""
+    result = {}
+    for name, provider in list(_providers.items()):
+        try:
+            result[name] = provider()
+        except Exception as e:
+            logger.exception(f"Erro ao coletar métricas de '{name}'.")
+            result[name] = {"error": str(e)}
+    return result
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.4 on 2026-10-17 00:21
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0005_remove_administrador_senha_hash_administrador_user'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message_id', models.CharField(blank=True, help_text='ID da mensagem na Evolution API, usado para descartar reenvios do mesmo evento.', max_length=100, null=True, unique=True)),
+                ('whatsapp_id', models.CharField(db_index=True, max_length=50)),
+                ('payload', models.JSONField()),
+                ('status', models.CharField(choices=[('pendente', 'Pendente'), ('processando', 'Processando'), ('concluido', 'Concluído'), ('falhou', 'Falhou (dead-letter)')], default='pendente', max_length=20)),
+                ('tentativas', models.PositiveIntegerField(default=0)),
+                ('proxima_tentativa', models.DateTimeField(default=django.utils.timezone.now)),
+                ('inicio_processamento', models.DateTimeField(blank=True, null=True)),
+                ('resposta', models.TextField(blank=True, help_text='Resposta já gerada. Numa nova tentativa apenas o envio é repetido.', null=True)),
+                ('ultimo_erro', models.TextField(blank=True, null=True)),
+                ('data_criacao', models.DateTimeField(auto_now_add=True)),
+                ('data_atualizacao', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Tarefa de Webhook',
+                'verbose_name_plural': 'Tarefas de Webhook',
+                'db_table': 'tb_webhook_jobs',
+                'indexes': [models.Index(fields=['status', 'proxima_tentativa'], name='webhook_job_fila_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.4 on 2026-10-17 00:48
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0006_webhookjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prompt',
+            name='data_atualizacao',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
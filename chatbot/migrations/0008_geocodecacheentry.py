@@ -0,0 +1,30 @@
+# Generated by Django 5.2.4 on 2026-10-17 01:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0007_prompt_data_atualizacao'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocodeCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tipo', models.CharField(choices=[('direta', 'Cidade -> coordenadas'), ('reversa', 'Coordenadas -> cidade')], max_length=10)),
+                ('chave', models.CharField(help_text="Nome da cidade normalizado ou 'lat,lon' arredondados para a grade configurada.", max_length=255)),
+                ('resultado', models.JSONField(blank=True, null=True)),
+                ('data_criacao', models.DateTimeField(auto_now_add=True)),
+                ('expira_em', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Cache de Geocodificação',
+                'verbose_name_plural': 'Cache de Geocodificação',
+                'db_table': 'tb_geocode_cache',
+                'constraints': [models.UniqueConstraint(fields=('tipo', 'chave'), name='geocode_cache_tipo_chave_uniq')],
+            },
+        ),
+    ]
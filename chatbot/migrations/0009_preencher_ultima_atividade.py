@@ -0,0 +1,30 @@
+from django.db import migrations
+from django.db.models import Max, OuterRef, Subquery
+
+
+def preencher_ultima_atividade(apps, schema_editor):
+    """
+    O início de sessão passou a ser lido de Usuario.ultima_atividade, que até aqui
+    nunca era preenchido. Copiamos para ele o horário da última interação de cada
+    usuário, para que quem conversou há pouco não receba de novo as boas-vindas.
+    """
+    Usuario = apps.get_model('chatbot', 'Usuario')
+    Interacao = apps.get_model('chatbot', 'Interacao')
+    ultima = (
+        Interacao.objects.filter(agricultor=OuterRef('pk'))
+        .values('agricultor')
+        .annotate(ultima=Max('timestamp'))
+        .values('ultima')
+    )
+    Usuario.objects.filter(ultima_atividade__isnull=True).update(ultima_atividade=Subquery(ultima))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0008_geocodecacheentry'),
+    ]
+
+    operations = [
+        migrations.RunPython(preencher_ultima_atividade, reverse_code=migrations.RunPython.noop),
+    ]
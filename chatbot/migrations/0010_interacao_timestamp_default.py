@@ -0,0 +1,19 @@
+# Generated by Django 5.2.4 on 2026-10-17 00:38
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0009_preencher_ultima_atividade'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='interacao',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
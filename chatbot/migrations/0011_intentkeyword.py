@@ -0,0 +1,31 @@
+# Generated by Django 5.2.4 on 2026-10-17 00:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0010_interacao_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IntentKeyword',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(help_text="Onde a palavra-chave vale (ex: 'menu', 'weather_choice').", max_length=50)),
+                ('intent', models.CharField(help_text="Intenção reconhecida (ex: 'clima').", max_length=50)),
+                ('pattern', models.CharField(help_text='Palavra ou expressão; casa apenas com palavras inteiras, sem diferenciar acentos.', max_length=255)),
+                ('is_regex', models.BooleanField(default=False, help_text="Trata 'pattern' como expressão regular (aplicada ao texto sem acentos e em minúsculas).")),
+                ('priority', models.IntegerField(default=0, help_text='Se a mensagem casar com várias intenções, vence a de maior prioridade.')),
+                ('data_atualizacao', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Palavra-chave de Intenção',
+                'verbose_name_plural': 'Palavras-chave de Intenção',
+                'db_table': 'tb_intent_keywords',
+                'constraints': [models.UniqueConstraint(fields=('scope', 'pattern'), name='intent_keyword_scope_pattern_uniq')],
+            },
+        ),
+    ]
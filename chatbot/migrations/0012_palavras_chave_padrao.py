@@ -0,0 +1,40 @@
+from django.db import migrations
+
+# (escopo, intenção, prioridade, palavras) - as mesmas palavras que o menu usava no código.
+PALAVRAS_CHAVE = [
+    ('menu', 'clima', 50, ['[1]', '1', 'clima']),
+    ('menu', 'plantio', 40, ['[2]', '2', 'plantio']),
+    ('menu', 'precos', 30, ['[3]', '3', 'preços']),
+    ('menu', 'relatorios', 20, ['[4]', '4', 'relatórios']),
+    ('menu', 'safra', 10, ['[5]', '5', 'safra']),
+    ('weather_choice', 'minha_cidade', 20, ['1', 'minha', 'atual']),
+    ('weather_choice', 'outra_cidade', 10, ['2', 'outra']),
+    ('weather_followup', 'outra_cidade', 10, ['sim', 'outra', 'cidade']),
+]
+
+
+def criar_palavras_chave(apps, schema_editor):
+    """Cadastra as palavras-chave que antes estavam fixas em services.py."""
+    IntentKeyword = apps.get_model('chatbot', 'IntentKeyword')
+    IntentKeyword.objects.bulk_create([
+        IntentKeyword(scope=scope, intent=intent, pattern=pattern, priority=priority)
+        for scope, intent, priority, patterns in PALAVRAS_CHAVE
+        for pattern in patterns
+    ], ignore_conflicts=True)
+
+
+def remover_palavras_chave(apps, schema_editor):
+    IntentKeyword = apps.get_model('chatbot', 'IntentKeyword')
+    for scope, intent, _, patterns in PALAVRAS_CHAVE:
+        IntentKeyword.objects.filter(scope=scope, intent=intent, pattern__in=patterns).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0011_intentkeyword'),
+    ]
+
+    operations = [
+        migrations.RunPython(criar_palavras_chave, reverse_code=remover_palavras_chave),
+    ]
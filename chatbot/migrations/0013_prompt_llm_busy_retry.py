@@ -0,0 +1,32 @@
+from django.db import migrations
+
+CHAVE = 'llm_busy_retry'
+TEXTO = (
+    "Estou atendendo muitos agricultores agora 🌱 "
+    "Por favor, mande a sua pergunta de novo em alguns instantes."
+)
+
+
+def criar_prompt(apps, schema_editor):
+    """Resposta enviada quando o consultor agrícola (LLM) está sem vaga ou sem orçamento de tokens."""
+    Prompt = apps.get_model('chatbot', 'Prompt')
+    Prompt.objects.get_or_create(
+        key=CHAVE,
+        defaults={'text': TEXTO, 'description': 'Consultor agrícola ocupado: pedir para tentar de novo em instantes.'},
+    )
+
+
+def remover_prompt(apps, schema_editor):
+    Prompt = apps.get_model('chatbot', 'Prompt')
+    Prompt.objects.filter(key=CHAVE, text=TEXTO).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0012_palavras_chave_padrao'),
+    ]
+
+    operations = [
+        migrations.RunPython(criar_prompt, reverse_code=remover_prompt),
+    ]
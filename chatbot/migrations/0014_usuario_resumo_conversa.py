@@ -0,0 +1,27 @@
+# Generated by Django 5.2.4 on 2026-10-17 01:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0013_prompt_llm_busy_retry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usuario',
+            name='resumo_atualizado_ate',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='usuario',
+            name='resumo_conversa',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddIndex(
+            model_name='interacao',
+            index=models.Index(fields=['agricultor', '-timestamp'], name='interacao_agricultor_ts_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+from django.db import migrations
+
+CHAVE = 'conversation_summary'
+TEXTO = (
+    "Você mantém o resumo da conversa entre um agricultor e o Iagro, consultor agrícola. "
+    "Recebe o resumo atual (pode estar vazio) e os trechos mais novos da conversa, e devolve "
+    "o resumo atualizado, em português, em no máximo 5 frases curtas. Guarde o que importa "
+    "para as próximas respostas: culturas, área, local, problemas relatados, recomendações já "
+    "dadas e pendências. Não invente nada e não inclua saudações. Responda só com o resumo."
+)
+
+
+def criar_prompt(apps, schema_editor):
+    """Instruções do resumo incremental da conversa (contexto do LLM)."""
+    Prompt = apps.get_model('chatbot', 'Prompt')
+    Prompt.objects.get_or_create(
+        key=CHAVE,
+        defaults={'text': TEXTO, 'description': 'Prompt de sistema do resumo incremental da conversa (Usuario.resumo_conversa).'},
+    )
+
+
+def remover_prompt(apps, schema_editor):
+    Prompt = apps.get_model('chatbot', 'Prompt')
+    Prompt.objects.filter(key=CHAVE, text=TEXTO).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0014_usuario_resumo_conversa'),
+    ]
+
+    operations = [
+        migrations.RunPython(criar_prompt, reverse_code=remover_prompt),
+    ]
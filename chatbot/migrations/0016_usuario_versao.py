@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-17 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0015_prompt_resumo_conversa'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usuario',
+            name='versao',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+    ]
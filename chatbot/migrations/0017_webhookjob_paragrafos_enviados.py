@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-17 13:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0016_usuario_versao'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookjob',
+            name='paragrafos_enviados',
+            field=models.PositiveIntegerField(default=0, help_text='Parágrafos da resposta já aceitos pela Evolution API. Uma nova tentativa envia só os seguintes.'),
+        ),
+    ]
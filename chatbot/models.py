@@ -1,6 +1,7 @@
 # chatbot/models.py
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 # =======================
 # TABELA DE ORGANIZAÇÕES
@@ -50,6 +51,13 @@ class Usuario(models.Model):
     data_cadastro = models.DateTimeField(auto_now_add=True)
     ultima_atividade = models.DateTimeField(null=True, blank=True)
     contexto = models.JSONField(default=dict, blank=True)
+    # Número do último turno gravado pelo ConversationStateStore: uma gravação atrasada
+    # (de um turno mais antigo) não sobrescreve uma mais nova.
+    versao = models.PositiveBigIntegerField(default=0, editable=False)
+    # Resumo das interações até 'resumo_atualizado_ate', mantido em segundo plano e enviado ao LLM
+    # no lugar da conversa antiga (as mais recentes vão na íntegra).
+    resumo_conversa = models.TextField(blank=True, default='')
+    resumo_atualizado_ate = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return f"{self.nome} ({self.whatsapp_id})"
@@ -104,7 +112,8 @@ class Interacao(models.Model):
     mensagem_usuario = models.TextField(null=True, blank=True)
     resposta_chatbot = models.TextField(null=True, blank=True)
     entidades = models.JSONField(null=True, blank=True)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # default em vez de auto_now_add: interações gravadas em lote mantêm o horário real do turno.
+    timestamp = models.DateTimeField(default=timezone.now)
 
     def __str__(self):
         return f"Interação com {self.agricultor.nome} em {self.timestamp.strftime('%d/%m/%Y %H:%M')}"
@@ -113,6 +122,22 @@ class Interacao(models.Model):
         verbose_name = "Interação"
         verbose_name_plural = "Interações"
         db_table = 'tb_interacoes'
+        indexes = [
+            # Histórico recente de um agricultor (contexto do LLM).
+            models.Index(fields=['agricultor', '-timestamp'], name='interacao_agricultor_ts_idx'),
+        ]
+
+class ConfigQuerySet(models.QuerySet):
+    """
+    Tabelas de configuração servidas em memória (TableSnapshot): update() e bulk_update()
+    também carimbam 'data_atualizacao', que auto_now só preenche no save(). Os outros
+    workers só percebem uma edição quando esse carimbo muda.
+    """
+
+    def update(self, **kwargs):
+        kwargs.setdefault('data_atualizacao', timezone.now())
+        return super().update(**kwargs)
+
 
 # ==================================
 # NOVA TABELA DE PROMPTS DO CHATBOT
@@ -134,6 +159,9 @@ class Prompt(models.Model):
         blank=True, 
         help_text="Descrição interna para explicar onde este prompt é usado."
     )
+    data_atualizacao = models.DateTimeField(auto_now=True)
+
+    objects = ConfigQuerySet.as_manager()
 
     def __str__(self):
         return self.key
@@ -143,6 +171,46 @@ class Prompt(models.Model):
         verbose_name_plural = "Prompts do Chatbot"
         db_table = 'tb_prompts'
         
+class IntentKeyword(models.Model):
+    """
+    Palavras-chave (ou expressões regulares) que levam cada mensagem a uma intenção,
+    por escopo da conversa (ex.: 'menu'). Compiladas em memória pelo IntentMatcher.
+    """
+    scope = models.CharField(
+        max_length=50,
+        help_text="Onde a palavra-chave vale (ex: 'menu', 'weather_choice')."
+    )
+    intent = models.CharField(
+        max_length=50,
+        help_text="Intenção reconhecida (ex: 'clima')."
+    )
+    pattern = models.CharField(
+        max_length=255,
+        help_text="Palavra ou expressão; casa apenas com palavras inteiras, sem diferenciar acentos."
+    )
+    is_regex = models.BooleanField(
+        default=False,
+        help_text="Trata 'pattern' como expressão regular (aplicada ao texto sem acentos e em minúsculas)."
+    )
+    priority = models.IntegerField(
+        default=0,
+        help_text="Se a mensagem casar com várias intenções, vence a de maior prioridade."
+    )
+    data_atualizacao = models.DateTimeField(auto_now=True)
+
+    objects = ConfigQuerySet.as_manager()
+
+    def __str__(self):
+        return f"{self.scope}: {self.pattern} -> {self.intent}"
+
+    class Meta:
+        verbose_name = "Palavra-chave de Intenção"
+        verbose_name_plural = "Palavras-chave de Intenção"
+        db_table = 'tb_intent_keywords'
+        constraints = [
+            models.UniqueConstraint(fields=['scope', 'pattern'], name='intent_keyword_scope_pattern_uniq'),
+        ]
+
 class State(models.Model):
     """
     Armazena os estados brasileiros e suas siglas.
@@ -156,4 +224,96 @@ class State(models.Model):
     class Meta:
         verbose_name = "Estado"
         verbose_name_plural = "Estados"
-        db_table = 'tb_states'
\ No newline at end of file
+        db_table = 'tb_states'
+
+# ==================================
+# FILA DURÁVEL DE WEBHOOKS (FAST-ACK)
+# ==================================
+class WebhookJob(models.Model):
+    """
+    Evento de mensagem recebido pelo webhook e persistido para processamento
+    assíncrono pelos workers (ver chatbot/jobs.py).
+    """
+    STATUS_PENDENTE = 'pendente'
+    STATUS_PROCESSANDO = 'processando'
+    STATUS_CONCLUIDO = 'concluido'
+    STATUS_FALHOU = 'falhou'
+    STATUS_CHOICES = [
+        (STATUS_PENDENTE, 'Pendente'),
+        (STATUS_PROCESSANDO, 'Processando'),
+        (STATUS_CONCLUIDO, 'Concluído'),
+        (STATUS_FALHOU, 'Falhou (dead-letter)'),
+    ]
+
+    message_id = models.CharField(
+        max_length=100,
+        unique=True,
+        null=True,
+        blank=True,
+        help_text="ID da mensagem na Evolution API, usado para descartar reenvios do mesmo evento."
+    )
+    whatsapp_id = models.CharField(max_length=50, db_index=True)
+    payload = models.JSONField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDENTE)
+    tentativas = models.PositiveIntegerField(default=0)
+    proxima_tentativa = models.DateTimeField(default=timezone.now)
+    inicio_processamento = models.DateTimeField(null=True, blank=True)
+    resposta = models.TextField(
+        null=True,
+        blank=True,
+        help_text="Resposta já gerada. Numa nova tentativa apenas o envio é repetido."
+    )
+    paragrafos_enviados = models.PositiveIntegerField(
+        default=0,
+        help_text="Parágrafos da resposta já aceitos pela Evolution API. Uma nova tentativa envia só os seguintes."
+    )
+    ultimo_erro = models.TextField(null=True, blank=True)
+    data_criacao = models.DateTimeField(auto_now_add=True)
+    data_atualizacao = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Webhook {self.pk} de {self.whatsapp_id} ({self.status})"
+
+    class Meta:
+        verbose_name = "Tarefa de Webhook"
+        verbose_name_plural = "Tarefas de Webhook"
+        db_table = 'tb_webhook_jobs'
+        indexes = [
+            models.Index(fields=['status', 'proxima_tentativa'], name='webhook_job_fila_idx'),
+        ]
+
+
+# ===================================
+# CACHE PERSISTENTE DE GEOCODIFICAÇÃO
+# ===================================
+class GeocodeCacheEntry(models.Model):
+    """
+    Resultado de uma consulta à API de geocodificação do OpenWeather.
+    Um 'resultado' nulo representa uma busca sem resultado (cache negativo).
+    """
+    TIPO_DIRETA = 'direta'
+    TIPO_REVERSA = 'reversa'
+    TIPO_CHOICES = [
+        (TIPO_DIRETA, 'Cidade -> coordenadas'),
+        (TIPO_REVERSA, 'Coordenadas -> cidade'),
+    ]
+
+    tipo = models.CharField(max_length=10, choices=TIPO_CHOICES)
+    chave = models.CharField(
+        max_length=255,
+        help_text="Nome da cidade normalizado ou 'lat,lon' arredondados para a grade configurada."
+    )
+    resultado = models.JSONField(null=True, blank=True)
+    data_criacao = models.DateTimeField(auto_now_add=True)
+    expira_em = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.tipo}: {self.chave}"
+
+    class Meta:
+        verbose_name = "Cache de Geocodificação"
+        verbose_name_plural = "Cache de Geocodificação"
+        db_table = 'tb_geocode_cache'
+        constraints = [
+            models.UniqueConstraint(fields=['tipo', 'chave'], name='geocode_cache_tipo_chave_uniq'),
+        ]
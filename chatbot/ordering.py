@@ -0,0 +1,172 @@
+# chatbot/ordering.py
+
+import asyncio
+import hashlib
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Dict, List
+
+from django.conf import settings
+from django.db import connection
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class UserLockTimeout(Exception):
+    """O lock do usuário não foi obtido em USER_LOCK_TIMEOUT: a mensagem deve ser tentada de novo."""
+
+
+def advisory_key(user_identifier: str) -> int:
+    """Chave estável de 64 bits (com sinal, como o bigint do Postgres) para um usuário."""
+    digest = hashlib.blake2b(f"chatbot:usuario:{user_identifier}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+class _KeyLock:
+    __slots__ = ('lock', 'users')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class UserLocks:
+    """
+    Processamento em ordem por usuário, em paralelo entre usuários.
+
+    - Dentro do processo: um asyncio.Lock por whatsapp_id (a fila de espera é FIFO, então
+      as mensagens saem na ordem em que chegaram). Locks sem uso são descartados.
+    - Entre processos e máquinas (PostgreSQL): um advisory lock de sessão por usuário.
+      Um lock de sessão precisa ser liberado pela mesma conexão que o obteve, então cada
+      usuário é mapeado para um de USER_LOCK_SHARDS executores de uma única thread, cada
+      um com a sua própria conexão. O lock é obtido com pg_try_advisory_lock em polling,
+      para que uma espera longa não prenda a thread e os demais usuários do shard.
+      Se o lock não vem em USER_LOCK_TIMEOUT, levanta UserLockTimeout: a tarefa da fila é
+      reagendada e o webhook/webchat responde 503, em vez de processar o turno fora de ordem.
+    Em outros bancos (ex.: SQLite no desenvolvimento) só a ordem dentro do processo é garantida.
+    """
+
+    def __init__(self):
+        self._locks: Dict[str, _KeyLock] = {}
+        self._executors: List[ThreadPoolExecutor] = []
+        # Métricas
+        self.acquired = 0
+        self.contended = 0
+        self.db_lock_timeouts = 0
+        self._total_wait = 0.0
+        self.max_wait = 0.0
+        metrics.register('user_locks', self.stats)
+
+    @asynccontextmanager
+    async def hold(self, user_identifier: str):
+        started = time.monotonic()
+        entry = self._locks.get(user_identifier)
+        if entry is None:
+            entry = self._locks[user_identifier] = _KeyLock()
+        entry.users += 1
+        if entry.lock.locked():
+            self.contended += 1
+        try:
+            async with entry.lock:
+                db_locked = await self._acquire_db_lock(user_identifier)
+                self._record_wait(time.monotonic() - started)
+                try:
+                    yield
+                finally:
+                    if db_locked:
+                        await self._release_db_lock(user_identifier)
+        finally:
+            entry.users -= 1
+            if entry.users == 0:
+                self._locks.pop(user_identifier, None)
+
+    def stats(self) -> dict:
+        return {
+            "active_users": len(self._locks),
+            "acquired": self.acquired,
+            "contended": self.contended,
+            "avg_wait_ms": round(self._total_wait / self.acquired * 1000, 2) if self.acquired else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 2),
+            "db_lock_timeouts": self.db_lock_timeouts,
+        }
+
+    async def aclose(self):
+        """Fecha a conexão de cada shard na própria thread (liberando os locks dela) e encerra os executores."""
+        executors, self._executors = self._executors, []
+        loop = asyncio.get_running_loop()
+        for executor in executors:
+            try:
+                await loop.run_in_executor(executor, self._close_connection)
+            except Exception as e:
+                logger.error(f"ERRO DE BANCO: Falha ao fechar a conexão de um shard de locks. Erro: {e}")
+            executor.shutdown(wait=False)
+
+    # --- Advisory locks do PostgreSQL ---
+
+    @staticmethod
+    def _db_locks_enabled() -> bool:
+        return settings.USER_LOCK_USE_DB and connection.vendor == 'postgresql'
+
+    def _executor_for(self, key: int) -> ThreadPoolExecutor:
+        if not self._executors:
+            self._executors = [
+                ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"user-lock-{shard}")
+                for shard in range(settings.USER_LOCK_SHARDS)
+            ]
+        return self._executors[key % len(self._executors)]
+
+    async def _run_on_shard(self, key: int, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor_for(key), func, *args)
+
+    @staticmethod
+    def _try_lock(key: int) -> bool:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", [key])
+            return cursor.fetchone()[0]
+
+    @staticmethod
+    def _close_connection():
+        # Conexão quebrada (ex.: banco reiniciado) ou shutdown: o servidor libera os locks da sessão.
+        connection.close()
+
+    @staticmethod
+    def _unlock(key: int):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", [key])
+
+    async def _acquire_db_lock(self, user_identifier: str) -> bool:
+        if not self._db_locks_enabled():
+            return False
+        key = advisory_key(user_identifier)
+        deadline = time.monotonic() + settings.USER_LOCK_TIMEOUT
+        delay = 0.01
+        while True:
+            try:
+                if await self._run_on_shard(key, self._try_lock, key):
+                    return True
+            except Exception as e:
+                # Tenta de novo com uma conexão nova até o prazo; processar sem o lock quebraria a ordem.
+                logger.error(f"ERRO DE BANCO: Falha ao obter o advisory lock do usuário {user_identifier}. Erro: {e}")
+                await self._run_on_shard(key, self._close_connection)
+            if time.monotonic() >= deadline:
+                self.db_lock_timeouts += 1
+                logger.warning(f"AVISO: Tempo esgotado aguardando o lock do usuário {user_identifier} em outro processo.")
+                raise UserLockTimeout(f"Lock do usuário {user_identifier} não obtido em {settings.USER_LOCK_TIMEOUT}s.")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.2)
+
+    async def _release_db_lock(self, user_identifier: str):
+        key = advisory_key(user_identifier)
+        try:
+            await self._run_on_shard(key, self._unlock, key)
+        except Exception as e:
+            logger.error(f"ERRO DE BANCO: Falha ao liberar o advisory lock do usuário {user_identifier}. Erro: {e}")
+
+    def _record_wait(self, waited: float):
+        self.acquired += 1
+        self._total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
@@ -0,0 +1,103 @@
+# chatbot/prompts.py
+
+import logging
+from string import Formatter
+from typing import Dict, FrozenSet
+
+from .models import Prompt
+from .snapshots import TableSnapshot
+
+logger = logging.getLogger(__name__)
+
+# Placeholders aceitos por cada prompt formatado com .format() no código.
+# Prompts fora desta tabela são enviados como texto puro e não são validados.
+PROMPT_PLACEHOLDERS: Dict[str, FrozenSet[str]] = {
+    'welcome_first_interaction': frozenset({'user_nome'}),
+    'welcome_ask_location_whatsapp': frozenset({'user_nome'}),
+    'welcome_ask_location_web': frozenset({'user_nome'}),
+    'location_received_whatsapp': frozenset({'user_nome'}),
+    'location_received_web': frozenset({'cidade', 'user_nome'}),
+    'location_not_found_web': frozenset({'cidade'}),
+    'weather_city_not_found': frozenset({'cidade'}),
+    'weather_dynamic_response': frozenset({'cidade', 'descricao', 'temperatura', 'sensacao', 'umidade'}),
+    'default_fallback': frozenset({'user_nome'}),
+}
+
+
+class _KeepMissing(dict):
+    """Mantém '{campo}' no texto quando o template usa um placeholder desconhecido."""
+    def __missing__(self, key):
+        return '{' + key + '}'
+
+
+def template_errors(key: str, text: str):
+    """
+    Valida os {placeholders} de um template.
+    Retorna (erro, pode_formatar): a descrição do problema ('' se válido) e se o
+    texto ainda pode passar por format_map (falso quando a sintaxe está quebrada).
+    """
+    allowed = PROMPT_PLACEHOLDERS.get(key)
+    if allowed is None:
+        return '', True
+    try:
+        fields = {
+            field_name.split('.')[0].split('[')[0]
+            for _, field_name, _, _ in Formatter().parse(text)
+            if field_name is not None
+        }
+    except ValueError as e:
+        return f"sintaxe inválida ({e})", False
+    unknown = fields - allowed
+    if unknown:
+        return f"placeholders desconhecidos {sorted(unknown)}; permitidos: {sorted(allowed)}", True
+    return '', True
+
+
+class PromptCatalog(TableSnapshot):
+    """
+    Todos os registros de Prompt em memória, validados no momento da carga.
+    Um template inválido (ex.: edição errada no admin) é reportado uma única vez
+    por carga e renderizado em modo tolerante, em vez de falhar a cada mensagem.
+    """
+    model = Prompt
+
+    def __init__(self):
+        super().__init__()
+        # chave -> pode_formatar, apenas para templates inválidos
+        self._invalid: Dict[str, bool] = {}
+        self._reported = set()
+        self._warned_missing = set()
+
+    def build(self, rows):
+        invalid = {}
+        for prompt in rows:
+            error, formattable = template_errors(prompt.key, prompt.text)
+            if error:
+                invalid[prompt.key] = formattable
+                # Recargas causadas por outros prompts não repetem o aviso.
+                if (prompt.key, prompt.text) not in self._reported:
+                    self._reported.add((prompt.key, prompt.text))
+                    logger.error(f"Prompt '{prompt.key}' inválido: {error}. O texto será enviado sem formatação completa.")
+        self._invalid = invalid
+        self._warned_missing = set()
+        return {prompt.key: prompt.text for prompt in rows}
+
+    def get(self, key: str) -> str:
+        text = self.data.get(key)
+        if text is None:
+            if key not in self._warned_missing:
+                self._warned_missing.add(key)
+                logger.warning(f"AVISO: Prompt com a chave '{key}' não encontrado no banco de dados.")
+            return f"Prompt '{key}' não configurado."
+        return text
+
+    def render(self, key: str, **kwargs) -> str:
+        text = self.get(key)
+        if key not in self._invalid:
+            return text.format(**kwargs)
+        if not self._invalid[key]:
+            return text
+        return text.format_map(_KeepMissing(kwargs))
+
+
+prompt_catalog = PromptCatalog()
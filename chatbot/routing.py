@@ -0,0 +1,10 @@
+# chatbot/routing.py
+
+from django.urls import path
+
+from .consumers import WebchatConsumer
+
+websocket_urlpatterns = [
+    # Webchat do site por WebSocket (o POST /api/v1/chatbot/webchat/ continua valendo)
+    path('ws/webchat/<str:session_id>/', WebchatConsumer.as_asgi(), name='webchat_ws'),
+]
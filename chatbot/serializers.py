@@ -68,6 +68,33 @@ class WebhookPayloadSerializer(serializers.Serializer):
         attrs['data'] = message_object
         return attrs
 
+def extract_message_fields(data_payload: dict):
+    """
+    Extrai (user_id, push_name, message_text, location_data) do objeto de mensagem
+    já normalizado pelo WebhookPayloadSerializer.
+    Retorna None quando o tipo de mensagem não é suportado pelo chatbot.
+    """
+    key_data = data_payload.get('key', {})
+    user_id = key_data.get('remoteJid')
+
+    push_name = data_payload.get('pushName', 'Utilizador')
+    message_data = data_payload.get('message', {})
+    message_text = ""
+    location_data = None
+
+    if 'conversation' in message_data and message_data.get('conversation'):
+        message_text = message_data['conversation']
+    elif 'extendedTextMessage' in message_data:
+        message_text = message_data.get('extendedTextMessage', {}).get('text', '')
+    elif 'locationMessage' in message_data:
+        loc_msg = message_data['locationMessage']
+        if 'degreesLatitude' in loc_msg and 'degreesLongitude' in loc_msg:
+            location_data = {"latitude": loc_msg['degreesLatitude'], "longitude": loc_msg['degreesLongitude']}
+    else:
+        return None
+
+    return user_id, push_name, message_text, location_data
+
 class ChatbotResponseSerializer(serializers.Serializer):
     """
     Serializer para a estrutura de resposta padrão do chatbot.
@@ -1,38 +1,159 @@
 # chatbot/services.py
 
-import httpx
-import openai
+import copy
+import logging
 import re
-import logging 
 from datetime import timedelta
-from django.utils import timezone
-from typing import List, Dict
+from typing import Dict, List, Tuple
 
+import httpx
+import openai
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from .models import Usuario, Prompt, State, Interacao
-from channels.db import database_sync_to_async
+from django.utils import timezone
+
+from .admission import PRIORITY_INTERACTIVE, AdmissionController, AdmissionRejected
+from .answer_cache import SimilarAnswerCache
+from .cache import AsyncTTLCache
+from .db_pool import db_monitor
+from .debounce import InboundMessage, MessageDebouncer
+from .flows import ASK_NAME, RESTART_COMMANDS, machine
+from .fsm import MENU, ChunkCallback, Turn, set_state
+from .gazetteer import Municipio, gazetteer
+from .geocoding import GeocodeCache, forward_key, reverse_key
+from .history import ConversationHistory
+from .http_clients import UpstreamClients
+from .intents import intent_matcher
+from .interaction_log import InteractionLogger
+from .lifecycle import ServiceLifecycle
+from .llm import ParagraphStream, StreamingLLM
+from .models import GeocodeCacheEntry, State, Usuario
+from .ordering import UserLocks
+from .prompts import prompt_catalog
+from .state_store import ConversationStateStore
+from .text import normalize_text
+from .tools import Tool, ToolExecutor, ToolRegistry
 
 logger = logging.getLogger(__name__)
 
 class ChatbotService:
     def __init__(self):
-        if settings.OPENAI_API_KEY:
-            self.openai_client = openai.AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
-        else:
-            self.openai_client = None
-        
+        # Clientes HTTP de longa duração (um pool por serviço externo).
+        self.http = UpstreamClients()
+
+        self.openai_client = self._build_openai_client()
+        # Respostas livres do consultor agrícola, em streaming, atrás da fila de admissão
+        # (vagas, prioridade interativa e orçamento de tokens por organização).
+        self.llm_admission = AdmissionController()
+        self.llm = StreamingLLM(lambda: self.openai_client, self.llm_admission)
+        # Ferramentas que o modelo pode chamar (clima e, com o serviço Node configurado, preços).
+        self.tools = self._build_tools()
+        self.tool_executor = ToolExecutor(self.tools)
+
         self.state_map_by_name: Dict[str, str] = {}
         self.state_map_by_abbr: List[str] = []
 
+        # Prompts e palavras-chave servidos da memória (recarregados quando as tabelas mudam).
+        self.prompts = prompt_catalog
+        self.intents = intent_matcher
+
+        # Clima atual por cidade: muitos agricultores da mesma cidade perguntam em poucos minutos.
+        self.weather_cache = AsyncTTLCache(
+            'weather',
+            ttl=settings.WEATHER_CACHE_TTL,
+            stale_ttl=settings.WEATHER_CACHE_STALE_TTL,
+            max_size=settings.WEATHER_CACHE_MAX_SIZE,
+        )
+
+        # Respostas do consultor agrícola: agricultores da mesma UF repetem as mesmas perguntas.
+        self.answer_cache = SimilarAnswerCache(
+            ttl=settings.LLM_ANSWER_CACHE_TTL,
+            max_size=settings.LLM_ANSWER_CACHE_MAX_SIZE,
+            threshold=settings.LLM_ANSWER_CACHE_THRESHOLD,
+        )
+
+        # Geocodificação: municípios não mudam, então o resultado é guardado no banco.
+        self.geocode_cache = GeocodeCache()
+
+        # Municípios do IBGE em memória: resolve cidade/UF sem ir à rede.
+        self.gazetteer = gazetteer
+
+        # Interações gravadas em lote, fora do caminho da resposta.
+        self.interaction_log = InteractionLogger()
+        # Contexto da conversa para o LLM: interações recentes + resumo incremental das antigas.
+        self.history = ConversationHistory(self.llm, self.interaction_log, self.prompts)
+
+        # Estado da conversa fora do banco; Usuario.contexto é atualizado em segundo plano.
+        self.state = ConversationStateStore()
+
+        # Máquina de estados da conversa (tabela compilada em chatbot/flows.py).
+        self.fsm = machine
+
+        # Mensagens do mesmo usuário são processadas em ordem; usuários diferentes, em paralelo.
+        self.user_locks = UserLocks()
+        # Mensagens do WhatsApp mandadas em sequência viram um só turno (WHATSAPP_DEBOUNCE_SECONDS).
+        self.debouncer = MessageDebouncer()
+
+        # Conexões com o banco (pool do psycopg ou conexões persistentes).
+        self.db = db_monitor
+
+        # Aquecimento no startup do ASGI, prontidão e drenagem no shutdown.
+        self.lifecycle = ServiceLifecycle()
+
+    async def warmup(self) -> bool:
+        """
+        Carrega antes da primeira mensagem tudo o que ela pagaria sob demanda: estados
+        brasileiros, prompts, palavras-chave, municípios e os clientes HTTP.
+        Retorna True quando o worker está pronto para receber tráfego.
+        """
+        return await self.lifecycle.warmup([
+            ('states', self._load_state_maps_if_needed),
+            ('prompts', self._warmup_prompts),
+            ('intents', self.intents.ensure_loaded),
+            ('gazetteer', self._ensure_gazetteer),
+            ('http_clients', self._warmup_http_clients),
+        ])
+
+    async def _warmup_prompts(self):
+        await self.prompts.ensure_loaded()
+        missing = sorted(key for key in self.fsm.prompt_keys() if key not in self.prompts.data)
+        if missing:
+            logger.warning(f"AVISO: Prompts usados pela máquina de estados e ausentes da tabela: {missing}")
+
+    async def _warmup_http_clients(self):
+        # Cria os clientes (contexto TLS, limites do pool); as conexões abrem na primeira chamada.
+        for name in ('evolution', 'openweather', 'openai'):
+            self.http.get(name)
+        if self.openai_client is None:
+            self.openai_client = self._build_openai_client()
+
+    def _build_openai_client(self):
+        if not settings.OPENAI_API_KEY:
+            return None
+        return openai.AsyncOpenAI(api_key=settings.OPENAI_API_KEY, base_url=settings.OPENAI_BASE_URL, http_client=self.http.openai)
+
+    async def shutdown(self):
+        """Shutdown do ASGI: espera os turnos em andamento e então libera os recursos."""
+        await self.lifecycle.drain(settings.SHUTDOWN_DRAIN_TIMEOUT)
+        await self.aclose()
+
+    async def aclose(self):
+        """Libera os recursos do serviço (interações pendentes e pools de conexões) no shutdown do ASGI."""
+        await self.history.aclose()
+        await self.interaction_log.aclose()
+        await self.state.aclose()
+        await self.http.aclose()
+        await self.user_locks.aclose()
+        await sync_to_async(self.db.close_pools)()
+
     async def _load_state_maps_if_needed(self):
         if not self.state_map_by_name:
             states = await self._get_all_states()
             self.state_map_by_name = {state.name: state.abbreviation for state in states}
             self.state_map_by_abbr = [state.abbreviation for state in states]
 
-    @database_sync_to_async
-    def _get_all_states(self) -> List[State]:
-        return list(State.objects.all())
+    async def _get_all_states(self) -> List[State]:
+        return [state async for state in State.objects.all()]
 
     async def _parse_city_from_input(self, text: str) -> str:
         await self._load_state_maps_if_needed()
@@ -42,132 +163,453 @@ class ChatbotService:
             return " ".join(words[:-1]).strip()
         return cleaned_text.strip()
 
-    @database_sync_to_async
+    async def _ensure_gazetteer(self):
+        if not self.gazetteer.loaded:
+            await sync_to_async(self.gazetteer.ensure_loaded)()
+
+    async def _resolve_municipio(self, text: str) -> Municipio:
+        """Procura o município no gazetteer local. Retorna None se não achar ou se for ambíguo."""
+        await self._ensure_gazetteer()
+        return self.gazetteer.resolve(text)
+
     def _get_prompt(self, key: str) -> str:
-        try:
-            return Prompt.objects.get(key=key).text
-        except Prompt.DoesNotExist:
-            logger.warning(f"AVISO: Prompt com a chave '{key}' não encontrado no banco de dados.")
-            return f"Prompt '{key}' não configurado."
+        return self.prompts.get(key)
 
-    async def send_whatsapp_message(self, phone_number: str, text: str):
+    def _render_prompt(self, key: str, **kwargs) -> str:
+        return self.prompts.render(key, **kwargs)
+
+    async def send_whatsapp_message(self, phone_number: str, text: str) -> bool:
+        """Envia a mensagem via Evolution API. Retorna True se a API confirmou o envio."""
         logger.info(f"Tentando enviar mensagem para {phone_number} via Evolution API.")
         
         corrected_text = text.replace('\\n', '\n')
         
-        url = f"{settings.EVOLUTION_API_URL}/message/sendText/{settings.EVOLUTION_INSTANCE_NAME}"
-        headers = {"apikey": settings.EVOLUTION_API_KEY}
+        url = f"/message/sendText/{settings.EVOLUTION_INSTANCE_NAME}"
         payload = {"number": phone_number, "textMessage": {"text": corrected_text}}
         
         logger.debug(f"URL da API: {url}")
         logger.debug(f"Payload de envio: {payload}")
 
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, json=payload, headers=headers, timeout=10)
-                logger.info(f"Mensagem enviada para {phone_number}. Status da API: {response.status_code}")
-                logger.debug(f"Resposta da API: {response.text}")
+            response = await self.http.evolution.post(url, json=payload)
+            logger.info(f"Mensagem enviada para {phone_number}. Status da API: {response.status_code}")
+            logger.debug(f"Resposta da API: {response.text}")
+            return response.is_success
         except Exception as e:
             logger.error(f"ERRO DE API: Falha ao enviar mensagem para {phone_number}. Erro: {e}")
+            return False
 
     async def get_weather_data(self, city: str) -> dict:
-        url = "http://api.openweathermap.org/data/2.5/weather"
-        params = {"q": f"{city},BR", "appid": settings.OPENWEATHER_API_KEY, "units": "metric", "lang": "pt_br"}
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, params=params)
-            return response.json() if response.status_code == 200 else {"error": f"Cidade '{city}' não encontrada."}
+        """
+        Clima atual da cidade, servido do cache quando possível (só respostas válidas são guardadas).
+        Municípios reconhecidos pelo gazetteer são consultados por coordenadas e compartilham
+        a mesma entrada de cache, qualquer que seja a grafia usada pelo usuário.
+        """
+        municipio = await self._resolve_municipio(city)
+        if municipio is None:
+            city = await self._parse_city_from_input(city)
+            return await self.weather_cache.get_or_load(
+                normalize_text(city),
+                lambda: self._fetch_weather_data(city),
+                cacheable=lambda data: data.get("cod") == 200,
+            )
+        return await self.weather_cache.get_or_load(
+            f"ibge:{municipio.codigo_ibge}",
+            lambda: self._fetch_municipio_weather(municipio),
+            cacheable=lambda data: data.get("cod") == 200,
+        )
+
+    async def _fetch_weather_data(self, city: str, coords: Tuple[float, float] = None) -> dict:
+        url = "/data/2.5/weather"
+        params = {"appid": settings.OPENWEATHER_API_KEY, "units": "metric", "lang": "pt_br"}
+        if coords:
+            params["lat"], params["lon"] = coords
+        else:
+            params["q"] = f"{city},BR"
+        try:
+            response = await self.http.openweather.get(url, params=params)
+        except httpx.HTTPError as e:
+            logger.error(f"ERRO DE API: Falha ao consultar o clima de '{city}'. Erro: {e}")
+            return {"error": f"Não foi possível consultar o clima de '{city}'."}
+        return response.json() if response.status_code == 200 else {"error": f"Cidade '{city}' não encontrada."}
+
+    async def _fetch_municipio_weather(self, municipio: Municipio) -> dict:
+        coords = (municipio.latitude, municipio.longitude) if municipio.latitude is not None else None
+        data = await self._fetch_weather_data(municipio.nome, coords)
+        if data.get("cod") == 200:
+            # A busca por coordenadas pode devolver o nome de um bairro ou distrito.
+            data["name"] = municipio.nome
+        return data
 
     async def get_location_details_from_coords(self, lat: float, lon: float) -> dict:
+        """
+        Cidade e UF a partir de um pino de localização. Usa a sede municipal mais próxima
+        no gazetteer local e só consulta a API se o ponto estiver longe de todas elas.
+        """
+        await self._ensure_gazetteer()
+        nearest = self.gazetteer.nearest(lat, lon, max_km=settings.GAZETTEER_NEAREST_MAX_KM)
+        if nearest is not None:
+            municipio, _ = nearest
+            return {"city": municipio.nome, "state": municipio.uf, "lat": lat, "lon": lon}
+
         await self._load_state_maps_if_needed()
-        url = "http://api.openweathermap.org/geo/1.0/reverse"
+        try:
+            return await self.geocode_cache.lookup(
+                GeocodeCacheEntry.TIPO_REVERSA, reverse_key(lat, lon),
+                lambda: self._fetch_reverse_geocode(lat, lon),
+            )
+        except httpx.HTTPError as e:
+            logger.error(f"ERRO DE API: Falha na geocodificação reversa de ({lat}, {lon}). Erro: {e}")
+            return {}
+
+    async def _fetch_reverse_geocode(self, lat: float, lon: float) -> dict:
+        url = "/geo/1.0/reverse"
         params = {"lat": lat, "lon": lon, "limit": 1, "appid": settings.OPENWEATHER_API_KEY}
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, params=params)
-            if response.status_code == 200 and response.json():
-                location = response.json()[0]
-                state_abbr = self.state_map_by_name.get(location.get("state"), "")
-                return {"city": location.get("name"), "state": state_abbr}
+        response = await self.http.openweather.get(url, params=params)
+        # Erros da API (chave inválida, limite de requisições...) não são "cidade inexistente".
+        response.raise_for_status()
+        if response.json():
+            location = response.json()[0]
+            state_abbr = self.state_map_by_name.get(location.get("state"), "")
+            return {"city": location.get("name"), "state": state_abbr}
+        return {}
+
+    async def get_location_details_from_city(self, text: str) -> dict:
+        """
+        Cidade e UF a partir do texto digitado ('Feira de Santana - BA', 'feira de santana'...).
+        Tenta o gazetteer local e só consulta a API de geocodificação se não encontrar.
+        """
+        municipio = await self._resolve_municipio(text)
+        if municipio is not None:
+            return {"city": municipio.nome, "state": municipio.uf, "lat": municipio.latitude, "lon": municipio.longitude}
+
+        city = await self._parse_city_from_input(text)
+        try:
+            return await self.geocode_cache.lookup(
+                GeocodeCacheEntry.TIPO_DIRETA, forward_key(city),
+                lambda: self._fetch_direct_geocode(city),
+            )
+        except httpx.HTTPError as e:
+            logger.error(f"ERRO DE API: Falha na geocodificação de '{city}'. Erro: {e}")
             return {}
 
-    async def get_location_details_from_city(self, city: str) -> dict:
-        await self._load_state_maps_if_needed()
-        url = "http://api.openweathermap.org/geo/1.0/direct"
+    async def _fetch_direct_geocode(self, city: str) -> dict:
+        url = "/geo/1.0/direct"
         params = {"q": f"{city},BR", "limit": 1, "appid": settings.OPENWEATHER_API_KEY}
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, params=params)
-            if response.status_code == 200 and response.json():
-                location = response.json()[0]
-                state_abbr = self.state_map_by_name.get(location.get("state"), "")
-                return {"city": location.get("name"), "state": state_abbr, "lat": location.get("lat"), "lon": location.get("lon")}
-            return {}
+        response = await self.http.openweather.get(url, params=params)
+        response.raise_for_status()
+        if response.json():
+            location = response.json()[0]
+            state_abbr = self.state_map_by_name.get(location.get("state"), "")
+            return {"city": location.get("name"), "state": state_abbr, "lat": location.get("lat"), "lon": location.get("lon")}
+        return {}
 
-    @database_sync_to_async
-    def get_or_create_user(self, user_identifier: str, push_name: str, channel: str):
-        # AQUI ESTÁ A CORREÇÃO: A função agora retorna a tupla (user, created)
-        return Usuario.objects.get_or_create(
+    async def get_or_create_user(self, user_identifier: str, push_name: str, channel: str) -> Tuple[Usuario, bool]:
+        """Usuario da sessão guardada no ConversationStateStore; numa ausência, do banco (criado se novo)."""
+        user = await self.state.get(user_identifier)
+        if user is not None:
+            return user, False
+        user, created = await Usuario.objects.aget_or_create(
             whatsapp_id=user_identifier,
             defaults={'nome': push_name if channel == 'whatsapp' else 'Visitante', 'organizacao_id': 1, 'contexto': {}}
         )
+        await self.state.prime(user)
+        return user, created
+
+    # Colunas do usuário que um turno de conversa pode alterar.
+    TURN_FIELDS = ('nome', 'cidade', 'estado', 'latitude', 'longitude', 'contexto')
 
-    @database_sync_to_async
-    def save_user(self, user: Usuario):
-        user.save()
+    def _snapshot_user(self, user: Usuario) -> dict:
+        """Cópia dos campos editáveis no turno, para saber depois o que mudou."""
+        return {field: copy.deepcopy(getattr(user, field)) for field in self.TURN_FIELDS}
+
+    async def _persist_turn(self, user: Usuario, original: dict, user_message: str, bot_response: str,
+                            originals: List[InboundMessage] = None):
+        """
+        Grava o turno sem esperar o banco: a sessão do usuário vai para o ConversationStateStore
+        (que grava as colunas alteradas em write-behind) e a interação, para o buffer do
+        InteractionLogger. Num turno de mensagens agrupadas ('originals'), cada mensagem vira
+        uma interação, no horário em que chegou; a resposta fica na última.
+        """
+        # Não salva nada se o bot não deu resposta (ex: erro interno)
+        if not bot_response:
+            return
+        changed = [field for field in self.TURN_FIELDS if getattr(user, field) != original[field]]
+        await self.state.set(user, changed + ['ultima_atividade'])
+        if originals and len(originals) > 1:
+            for message in originals[:-1]:
+                self.interaction_log.log(user.pk, message.text, None, timestamp=message.received_at)
+            user_message = originals[-1].text
+        self.interaction_log.log(user.pk, user_message, bot_response, timestamp=user.ultima_atividade)
+
+    def _apply_location(self, user: Usuario, details: dict):
+        """Copia cidade, UF e coordenadas (quando conhecidas) para o usuário."""
+        user.cidade, user.estado = details.get('city'), details.get('state')
+        if details.get('lat') is not None and details.get('lon') is not None:
+            user.latitude = round(float(details['lat']), 6)
+            user.longitude = round(float(details['lon']), 6)
 
     def _reset_all_flow_flags(self, context: dict) -> dict:
-        keys_to_remove = [key for key in context if key.startswith('awaiting_')]
-        for key in keys_to_remove:
-            context.pop(key, None)
+        set_state(context, MENU)
         return context
 
-    async def _format_weather_response(self, cidade: str) -> str:
-        cidade_limpa = await self._parse_city_from_input(cidade)
-        clima_atual = await self.get_weather_data(cidade_limpa)
+    # --- Ferramentas do consultor agrícola ---
+
+    # Quantas sugestões de produto o agricultor pode escolher pelo número.
+    MAX_PRODUCT_SUGGESTIONS = 10
+
+    def _build_tools(self) -> ToolRegistry:
+        registry = ToolRegistry()
+        registry.register(Tool(
+            name='get_current_weather',
+            description="Tempo atual (agora, sem previsão para os próximos dias) numa cidade brasileira. "
+                        "Devolve o texto pronto para o usuário.",
+            parameters={
+                "type": "object",
+                "properties": {"city": {"type": "string", "description": "Cidade, opcionalmente com UF (ex.: 'Feira de Santana - BA'). Vazio usa a cidade do agricultor."}},
+            },
+            handler=self._tool_current_weather,
+        ))
+        if settings.PRECODAHORA_SERVICE_URL:
+            registry.register(Tool(
+                name='search_product_suggestions',
+                description="Busca produtos no Preço da Hora (Bahia) e devolve uma lista numerada de sugestões para o usuário escolher.",
+                parameters={
+                    "type": "object",
+                    "properties": {"product_name": {"type": "string", "description": "Produto, ex.: 'tomate kg'."}},
+                    "required": ["product_name"],
+                },
+                handler=self._tool_search_products,
+            ))
+            registry.register(Tool(
+                name='get_product_prices_from_suggestion',
+                description="Preços do produto escolhido pelo número, na última lista de sugestões mostrada ao usuário.",
+                parameters={
+                    "type": "object",
+                    "properties": {"suggestion_number": {"type": "integer", "description": "Número escolhido (1, 2, ...)."}},
+                    "required": ["suggestion_number"],
+                },
+                handler=self._tool_product_prices,
+            ))
+        return registry
+
+    async def _tool_current_weather(self, turn: Turn, city: str = "") -> str:
+        city = (city or turn.user.cidade or "").strip()
+        if not city:
+            return '{"erro": "cidade não informada e o agricultor não tem cidade cadastrada"}'
+        text, _ = await self._format_weather_response(city)
+        return text
+
+    async def _tool_search_products(self, turn: Turn, product_name: str) -> dict:
+        response = await self.http.precodahora.post('/sugestoes', json={"produto": product_name})
+        response.raise_for_status()
+        data = response.json()
+        suggestions = (data.get('sugestoes', []) if isinstance(data, dict) else data)[:self.MAX_PRODUCT_SUGGESTIONS]
+        # Guardadas no contexto para a escolha pelo número na próxima mensagem.
+        turn.context['sugestoes_produtos'] = suggestions
+        return {"sugestoes": {str(number): item for number, item in enumerate(suggestions, start=1)}}
+
+    async def _tool_product_prices(self, turn: Turn, suggestion_number: int):
+        suggestions = turn.context.get('sugestoes_produtos') or []
+        if not 1 <= int(suggestion_number) <= len(suggestions):
+            return {"erro": f"não há sugestão número {suggestion_number} na última lista mostrada"}
+        user = turn.user
+        payload = {
+            "sugestao": suggestions[int(suggestion_number) - 1],
+            "latitude": float(user.latitude) if user.latitude is not None else None,
+            "longitude": float(user.longitude) if user.longitude is not None else None,
+        }
+        response = await self.http.precodahora.post('/precos', json=payload)
+        response.raise_for_status()
+        return response.json()
+
+    # Prompt de sistema do consultor agrícola, cadastrado pelo painel (ver README).
+    LLM_SYSTEM_PROMPT_KEY = 'system_prompt_tools'
+    # Resposta quando a chamada ao modelo é recusada (fila cheia ou orçamento da organização esgotado).
+    LLM_BUSY_PROMPT_KEY = 'llm_busy_retry'
+
+    async def answer_with_llm(self, turn: Turn) -> str:
+        """
+        Resposta livre do consultor agrícola para a mensagem do turno, enviada em streaming
+        por turn.emit. Retorna '' se o LLM não estiver configurado ou não responder a tempo.
+
+        Se o modelo pedir ferramentas, elas são executadas (em paralelo) e o resultado volta
+        para ele, em até LLM_MAX_TOOL_ROUNDS rodadas; na última, o modelo é obrigado a
+        responder em texto. Se a chamada não for admitida, a resposta é o prompt 'llm_busy_retry'.
+
+        Respostas completas que não usaram ferramentas vão para o cache de perguntas
+        parecidas (por UF e prompt de sistema) e são reaproveitadas sem chamar o modelo.
+        """
+        system_prompt = self.prompts.data.get(self.LLM_SYSTEM_PROMPT_KEY)
+        if not system_prompt or not self.llm.available:
+            return ""
+        cache_scope = (turn.user.estado or '', system_prompt)
+        cached = self.answer_cache.lookup(cache_scope, turn.message_text)
+        if cached is not None:
+            return cached
+
+        messages = await self._llm_messages(turn, system_prompt)
+        tool_cache = {}
+        texts: List[str] = []
+        # Respostas com ferramentas (clima, preços) ou incompletas não podem ser reaproveitadas.
+        reusable = True
+
+        for round_number in range(settings.LLM_MAX_TOOL_ROUNDS + 1):
+            options = {}
+            if self.tools:
+                options["tools"] = self.tools.schemas()
+                if round_number == settings.LLM_MAX_TOOL_ROUNDS:
+                    options["tool_choice"] = "none"
+            try:
+                answer = await self.llm.stream(
+                    messages, on_delta=self._round_emitter(turn, texts),
+                    priority=turn.priority, organizacao_id=turn.user.organizacao_id, **options,
+                )
+            except AdmissionRejected:
+                if texts:
+                    reusable = False
+                    break
+                return self._get_prompt(self.LLM_BUSY_PROMPT_KEY)
+            if answer is None:
+                reusable = False
+                break
+            if answer.text:
+                texts.append(answer.text)
+            reusable = reusable and not answer.truncated and not answer.tool_calls
+            if not answer.tool_calls or round_number == settings.LLM_MAX_TOOL_ROUNDS:
+                break
+            messages.append({
+                "role": "assistant",
+                "content": answer.text or None,
+                "tool_calls": [
+                    {"id": call.id, "type": "function", "function": {"name": call.name, "arguments": call.arguments}}
+                    for call in answer.tool_calls
+                ],
+            })
+            messages.extend(await self.tool_executor.run(turn, list(answer.tool_calls), tool_cache))
+        response = "\n\n".join(texts)
+        if reusable:
+            self.answer_cache.store(cache_scope, turn.message_text, response, personal=(turn.first_name, turn.user.cidade))
+        return response
+
+    @staticmethod
+    def _round_emitter(turn: Turn, texts: List[str]):
+        """Repassa os trechos de uma rodada, separando-a da anterior por um parágrafo."""
+        started = False
+
+        async def emit(chunk: str):
+            nonlocal started
+            if not started and texts:
+                await turn.emit("\n\n")
+            started = True
+            await turn.emit(chunk)
+        return emit
+
+    async def _llm_messages(self, turn: Turn, system_prompt: str) -> List[dict]:
+        user = turn.user
+        profile = f"Agricultor: {turn.first_name or 'não informado'}."
+        if user.cidade:
+            profile += f" Cidade: {user.cidade}{'/' + user.estado if user.estado else ''}."
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": profile},
+            *await self.history.build(user),
+            {"role": "user", "content": turn.message_text},
+        ]
+
+    async def _format_weather_response(self, cidade: str) -> Tuple[str, bool]:
+        """Monta a resposta de clima. Retorna (texto, cidade_encontrada)."""
+        clima_atual = await self.get_weather_data(cidade)
 
         if "error" in clima_atual or clima_atual.get("cod") != 200:
-            prompt_template = await self._get_prompt('weather_city_not_found')
-            return prompt_template.format(cidade=cidade_limpa)
+            return self._render_prompt('weather_city_not_found', cidade=await self._parse_city_from_input(cidade)), False
         
-        prompt_template = await self._get_prompt('weather_dynamic_response')
-        return prompt_template.format(
-            cidade=clima_atual.get('name', cidade_limpa),
+        return self._render_prompt(
+            'weather_dynamic_response',
+            cidade=clima_atual.get('name', cidade),
             descricao=clima_atual['weather'][0]['description'].capitalize(),
             temperatura=f"{clima_atual['main']['temp']:.1f}",
             sensacao=f"{clima_atual['main']['feels_like']:.1f}",
             umidade=clima_atual['main']['humidity']
-        )
+        ), True
         
-    @database_sync_to_async
-    def _get_last_interaction_time(self, user: Usuario):
-        """Busca o timestamp da última interação do usuário."""
-        last_interaction = Interacao.objects.filter(agricultor=user).order_by('-timestamp').first()
-        return last_interaction.timestamp if last_interaction else None
-
-    @database_sync_to_async
-    def _log_interaction(self, user: Usuario, user_message: str, bot_response: str):
-        """Salva a interação atual na base de dados."""
-        # Não salva interações se o bot não deu resposta (ex: erro interno)
-        if not bot_response:  
-            return
-        Interacao.objects.create(
-            agricultor=user,
-            mensagem_usuario=user_message,
-            resposta_chatbot=bot_response
-        )
+    async def handle_message(self, user_identifier: str, message_text: str, push_name: str, channel: str, location_data: dict = None,
+                             user: Usuario = None, created: bool = False, on_chunk: ChunkCallback = None) -> str:
+        """process_message com a garantia de ordem por usuário. Ponto de entrada das views e do WebSocket."""
+        async with self.lifecycle.track(), self.user_locks.hold(user_identifier):
+            return await self.process_message(user_identifier, message_text, push_name, channel, location_data,
+                                              user=user, created=created, on_chunk=on_chunk)
+
+    async def handle_whatsapp_message(self, user_identifier: str, message_text: str, push_name: str, location_data: dict = None) -> str:
+        """
+        Processa e envia a resposta sem soltar o lock do usuário, para que as respostas
+        de mensagens seguidas cheguem ao WhatsApp na mesma ordem das perguntas.
+
+        Mensagens que chegam dentro da janela de WHATSAPP_DEBOUNCE_SECONDS são respondidas
+        num só turno, pela chamada que abriu a janela; as demais retornam '' assim que a
+        janela fecha. Se um turno falha, as mensagens das outras chamadas voltam para a
+        próxima janela do usuário e esta chamada levanta a exceção (o webhook responde erro
+        e a Evolution API reenvia a mensagem). O agrupamento vale só entre mensagens que
+        chegam ao mesmo worker.
+        """
+        async with self.lifecycle.track():
+            own = InboundMessage(message_text, location_data, timezone.now())
+            turns = await self.debouncer.submit(user_identifier, own)
+            if turns is None:
+                return ""
+            response_text = ""
+            done = 0
+            try:
+                async with self.user_locks.hold(user_identifier):
+                    for messages in turns:
+                        # Respostas em streaming (LLM) saem um parágrafo por mensagem, à medida que ficam prontas.
+                        paragraphs = ParagraphStream(lambda text: self.send_whatsapp_message(user_identifier, text))
+                        response_text = await self.process_message(
+                            user_identifier, self.debouncer.merged_text(messages), push_name, 'whatsapp', messages[-1].location_data,
+                            on_chunk=paragraphs.feed, originals=messages,
+                        )
+                        if response_text:
+                            await paragraphs.finish(response_text)
+                        done += 1
+            except BaseException as e:
+                # A mensagem desta chamada volta pelo reenvio do webhook; as outras, pela próxima janela.
+                self.debouncer.carry_over(user_identifier, [
+                    message for messages in turns[done:] for message in messages if message is not own
+                ])
+                if done == 0 or not isinstance(e, Exception):
+                    raise
+                # A mensagem desta chamada já foi respondida: reenviá-la duplicaria o turno.
+                logger.exception(f"Erro num turno de mensagens agrupadas de {user_identifier}.")
+            return response_text
 
-    async def process_message(self, user_identifier: str, message_text: str, push_name: str, channel: str, location_data: dict = None) -> str:
+    async def process_message(self, user_identifier: str, message_text: str, push_name: str, channel: str, location_data: dict = None,
+                              user: Usuario = None, created: bool = False, on_chunk: ChunkCallback = None,
+                              priority: int = PRIORITY_INTERACTIVE, originals: List[InboundMessage] = None) -> str:
+        """
+        Um turno de conversa. 'user' (e 'created', se acabou de ser criado) é o Usuario já
+        carregado por quem mantém a sessão, ex.: a conexão WebSocket, dispensando a busca
+        no banco; 'on_chunk' recebe os trechos da resposta à medida que são gerados;
+        'priority' é a prioridade das chamadas ao LLM na fila de admissão; 'originals' são
+        as mensagens que o MessageDebouncer juntou em 'message_text'.
+        """
         # 1. Variáveis iniciais
         final_response_text = ""
-        user = None 
-        
+        original = None
+
         try:
             # 2. Setup inicial: carrega mapas e obtém o usuário
             await self._load_state_maps_if_needed()
-            user, created = await self.get_or_create_user(user_identifier, push_name, channel)
-            context = user.contexto or {}
+            await self.prompts.ensure_loaded()
+            await self.intents.ensure_loaded()
+            if user is None:
+                user, created = await self.get_or_create_user(user_identifier, push_name, channel)
+            context = user.contexto = user.contexto or {}
+            original = self._snapshot_user(user)
             message_lower = message_text.lower().strip()
             
             now = timezone.now()
-            last_interaction_time = await self._get_last_interaction_time(user)
+            last_interaction_time = user.ultima_atividade
+            user.ultima_atividade = now
 
             # 3. Lógica de "Início de Sessão" (Saudação de boas-vindas)
             show_welcome_message = False
@@ -175,140 +617,39 @@ class ChatbotService:
                 show_welcome_message = True
 
             if show_welcome_message and user.nome:
-                welcome_template = await self._get_prompt('welcome_first_interaction')
-                menu_text = await self._get_prompt('main_menu_v2')
-                final_response_text = welcome_template.format(user_nome=user.nome.split(' ')[0])
+                menu_text = self._get_prompt('main_menu_v2')
+                final_response_text = self._render_prompt('welcome_first_interaction', user_nome=user.nome.split(' ')[0])
                 user.contexto = self._reset_all_flow_flags(context)
                 final_response_text = f"{final_response_text}\n\n{menu_text}"
                 # Este é o único 'return' antecipado, para uma nova sessão limpa.
                 return final_response_text 
 
             # 4. Processamento principal da conversa (Máquina de Estados)
-            current_state = next((state for state in context if state.startswith('awaiting_')), None)
+            turn = Turn(self, user, context, message_text, channel, location_data, on_chunk=on_chunk, priority=priority)
 
-            # Comando de Reinício
-             # 1. Trata o comando de reinício primeiro
-            if message_lower in ['reiniciar', 'recomeçar', 'inicio']:
+            # Comando de Reinício: vale em qualquer estado
+            if message_lower in RESTART_COMMANDS:
                 user.nome = ""
-                user.contexto = {'awaiting_initial_name': True}
-                final_response_text = await self._get_prompt('welcome_ask_name')
-
-            # 2. Se o utilizador é NOVO (acabou de ser criado), inicia o onboarding
-            elif created or (not user.nome and not current_state):
-                user.contexto = {'awaiting_initial_name': True}
-                final_response_text = await self._get_prompt('welcome_ask_name')
-
-            # 3. Se o bot está AGUARDANDO o nome, processa a resposta
-            elif current_state == 'awaiting_initial_name':
-                user.nome = message_text.strip().title()
-                context.pop('awaiting_initial_name', None)
-                context['awaiting_location'] = True
-                prompt_key = 'welcome_ask_location_whatsapp' if channel == 'whatsapp' else 'welcome_ask_location_web'
-                template = await self._get_prompt(prompt_key)
-                final_response_text = template.format(user_nome=user.nome)
-            
-            # Estado: Aguardando localização
-            elif current_state == 'awaiting_location':
-                context.pop('awaiting_location', None)
-                location_processed = False
-                thank_you_message = ""
-                
-                if channel == 'whatsapp' and location_data:
-                    details = await self.get_location_details_from_coords(location_data['latitude'], location_data['longitude'])
-                    if details:
-                        user.cidade, user.estado = details.get('city'), details.get('state')
-                        template = await self._get_prompt('location_received_whatsapp')
-                        thank_you_message = template.format(user_nome=user.nome)
-                        location_processed = True
-                elif message_text:
-                    details = await self.get_location_details_from_city(await self._parse_city_from_input(message_text))
-                    if details:
-                        user.cidade, user.estado = details.get('city'), details.get('state')
-                        template = await self._get_prompt('location_received_web')
-                        thank_you_message = template.format(cidade=user.cidade, user_nome=user.nome)
-                        location_processed = True
-                    else:
-                        final_response_text = (await self._get_prompt('location_not_found_web')).format(cidade=message_text)
-                
-                if location_processed:
-                    main_menu_text = await self._get_prompt('main_menu_v2')
-                    final_response_text = f"{thank_you_message}\n\n{main_menu_text}"
-                elif not final_response_text:
-                    final_response_text = await self._get_prompt('location_error')
-            
-            # Estado: Aguardando escolha no submenu de clima
-            elif current_state == 'awaiting_weather_location_choice':
-                context.pop('awaiting_weather_location_choice', None)
-                if any(s in message_lower for s in ["1", "minha", "atual"]):
-                    if user.cidade:
-                        final_response_text = await self._format_weather_response(user.cidade)
-                        context['awaiting_weather_followup'] = True
-                    else:
-                        context['awaiting_location'] = True
-                        final_response_text = await self._get_prompt('weather_location_not_found')
-                elif any(s in message_lower for s in ["2", "outra"]):
-                    context['awaiting_weather_location'] = True
-                    final_response_text = await self._get_prompt('weather_ask_another_city')
-                else:
-                    context['awaiting_weather_location_choice'] = True
-                    final_response_text = await self._get_prompt('weather_choice_invalid')
-
-            # Estado: Aguardando nome da cidade para o clima
-            elif current_state == 'awaiting_weather_location':
-                cidade_limpa = await self._parse_city_from_input(message_text)
-                clima_atual = await self.get_weather_data(cidade_limpa)
-                if "error" in clima_atual or clima_atual.get("cod") != 200:
-                    prompt_template = await self._get_prompt('weather_city_not_found')
-                    final_response_text = prompt_template.format(cidade=cidade_limpa)
-                    context['awaiting_weather_location'] = True
-                else:
-                    prompt_template = await self._get_prompt('weather_dynamic_response')
-                    final_response_text = prompt_template.format(
-                        cidade=clima_atual.get('name', cidade_limpa),
-                        descricao=clima_atual['weather'][0]['description'].capitalize(),
-                        temperatura=f"{clima_atual['main']['temp']:.1f}",
-                        sensacao=f"{clima_atual['main']['feels_like']:.1f}",
-                        umidade=clima_atual['main']['humidity']
-                    )
-                    context.pop('awaiting_weather_location', None)
-                    context['awaiting_weather_followup'] = True
-
-            # Estado: Aguardando resposta de acompanhamento do clima
-            elif current_state == 'awaiting_weather_followup':
-                context.pop('awaiting_weather_followup', None)
-                if any(s in message_lower for s in ["sim", "outra", "cidade"]):
-                    context['awaiting_weather_location'] = True
-                    final_response_text = await self._get_prompt('weather_ask_another_city')
-                else:
-                    final_response_text = await self._get_prompt('main_menu_v2')
-
-            # Roteamento de Menu e Fallback final
+                context.clear()
+                set_state(context, ASK_NAME)
+                final_response_text = self._get_prompt('welcome_ask_name')
+
+            # Se o utilizador é NOVO (ou não tem nome), inicia o onboarding
+            elif created or (not user.nome and turn.state == MENU):
+                set_state(context, ASK_NAME)
+                final_response_text = self._get_prompt('welcome_ask_name')
+
             else:
-                if any(s in message_lower for s in ["[1]", "1", "clima"]):
-                    context['awaiting_weather_location_choice'] = True
-                    final_response_text = await self._get_prompt('weather_submenu_choice')
-                elif any(s in message_lower for s in ["[2]", "2", "plantio"]):
-                    final_response_text = await self._get_prompt('feature_planting_wip')
-                elif any(s in message_lower for s in ["[3]", "3", "preços"]):
-                    final_response_text = await self._get_prompt('feature_prices_wip')
-                elif any(s in message_lower for s in ["[4]", "4", "relatórios"]):
-                    final_response_text = await self._get_prompt('feature_reports_wip')
-                elif any(s in message_lower for s in ["[5]", "5", "safra"]):
-                    final_response_text = await self._get_prompt('feature_harvest_wip')
-                else:
-                    fallback_template = await self._get_prompt('default_fallback')
-                    menu_text = await self._get_prompt('main_menu_v2')
-                    final_response_text = f"{fallback_template.format(user_nome=user.nome.split(' ')[0])}\n\n{menu_text}"
+                final_response_text = await self.fsm.dispatch(turn)
             
-            # 5. Salva o estado do usuário antes de sair do 'try'
+            # 5. Atualiza o estado do usuário antes de sair do 'try'
             user.contexto = context
-            await self.save_user(user)
             
             # 6. Ponto de saída único
             return final_response_text
 
         finally:
-            # 7. Bloco de Segurança: Salva a Interação no Final
+            # 7. Bloco de Segurança: Salva o usuário e a Interação no Final
             # Este código é executado sempre, garantindo que a conversa seja salva.
-            if user:
-                await self._log_interaction(user, message_text, final_response_text)
+            if user and original is not None:
+                await self._persist_turn(user, original, message_text, final_response_text, originals)
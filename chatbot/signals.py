@@ -0,0 +1,35 @@
+# chatbot/signals.py
+
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .db_pool import db_monitor
+from .intents import intent_matcher
+from .models import IntentKeyword, Prompt, Usuario
+from .prompts import prompt_catalog
+from .state_store import forget_session
+
+
+@receiver([post_save, post_delete], sender=Prompt)
+def reload_prompt_catalog(sender, **kwargs):
+    # Recarrega só depois do commit, para nunca servir uma edição que foi desfeita.
+    transaction.on_commit(prompt_catalog.reload)
+
+
+@receiver([post_save, post_delete], sender=IntentKeyword)
+def reload_intent_matcher(sender, **kwargs):
+    transaction.on_commit(intent_matcher.reload)
+
+
+@receiver([post_save, post_delete], sender=Usuario)
+def forget_user_session(sender, instance, **kwargs):
+    # Usuario editado fora da conversa (painel, admin, comandos): o próximo turno o relê do banco.
+    # As gravações do próprio store usam UPDATE e não passam por aqui.
+    transaction.on_commit(lambda: forget_session(instance.whatsapp_id))
+
+
+@receiver(connection_created)
+def track_db_connection(sender, connection, **kwargs):
+    db_monitor.connection_opened(connection)
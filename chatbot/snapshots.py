@@ -0,0 +1,101 @@
+# chatbot/snapshots.py
+
+import asyncio
+import logging
+import threading
+import time
+from types import MappingProxyType
+from typing import Mapping, Optional
+
+from django.conf import settings
+from django.db.models import Count, Max
+from channels.db import database_sync_to_async
+
+logger = logging.getLogger(__name__)
+
+
+class TableSnapshot:
+    """
+    Cópia imutável em memória de uma tabela pequena de configuração (prompts, intenções...).
+
+    - A carga completa acontece uma vez (warmup ou primeira mensagem) e as leituras
+      seguintes não tocam no banco.
+    - No processo onde a tabela é editada, os sinais post_save/post_delete chamam reload().
+    - Nos demais processos (outros workers do uvicorn), um carimbo de versão
+      (maior 'data_atualizacao' + número de linhas) é verificado em segundo plano a cada
+      SNAPSHOT_VERSION_CHECK_INTERVAL segundos; se mudou, a tabela é recarregada. O modelo
+      usa ConfigQuerySet para que update() em lote também mova o carimbo.
+    A troca do mapa é atômica: os leitores veem sempre a versão antiga ou a nova, nunca metade.
+    """
+    model = None
+
+    def __init__(self):
+        self._data: Mapping = MappingProxyType({})
+        self._version = None
+        self._loaded = False
+        self._last_check = 0.0
+        self._check_task: Optional[asyncio.Task] = None
+        self._lock = threading.Lock()
+
+    # --- Pontos de extensão ---
+
+    def build(self, rows) -> Mapping:
+        """Transforma as linhas da tabela no mapa servido em memória."""
+        raise NotImplementedError
+
+    # --- Carga e invalidação ---
+
+    def _version_stamp(self):
+        stamp = self.model.objects.aggregate(ultima=Max('data_atualizacao'), total=Count('pk'))
+        return stamp['ultima'], stamp['total']
+
+    def reload(self):
+        """Recarrega a tabela inteira (síncrono). Seguro para chamar a partir de sinais."""
+        with self._lock:
+            version = self._version_stamp()
+            data = self.build(list(self.model.objects.all()))
+            self._data = MappingProxyType(dict(data))
+            self._version = version
+            self._loaded = True
+            self._last_check = time.monotonic()
+        logger.info(f"{type(self).__name__}: {len(self._data)} registros carregados.")
+
+    def _reload_if_changed(self):
+        if self._version_stamp() != self._version:
+            self.reload()
+        else:
+            self._last_check = time.monotonic()
+
+    async def ensure_loaded(self):
+        """
+        Garante que o mapa está carregado. Depois da primeira carga só agenda,
+        sem esperar, a verificação periódica de versão.
+        """
+        if not self._loaded:
+            await database_sync_to_async(self.reload)()
+            return
+        if self._checking() or time.monotonic() - self._last_check < settings.SNAPSHOT_VERSION_CHECK_INTERVAL:
+            return
+        self._check_task = asyncio.create_task(self._background_check())
+        self._check_task.add_done_callback(self._check_done)
+
+    def _checking(self) -> bool:
+        # Uma verificação presa num event loop que já acabou não impede a próxima.
+        task = self._check_task
+        return task is not None and not task.done() and task.get_loop() is asyncio.get_running_loop()
+
+    async def _background_check(self):
+        try:
+            await database_sync_to_async(self._reload_if_changed)()
+        except Exception:
+            # Sem banco, a próxima tentativa fica para o próximo intervalo.
+            self._last_check = time.monotonic()
+            raise
+
+    def _check_done(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"{type(self).__name__}: erro ao verificar a versão da tabela.", exc_info=task.exception())
+
+    @property
+    def data(self) -> Mapping:
+        return self._data
@@ -0,0 +1,124 @@
+# chatbot/spatial.py
+
+import math
+import sys
+from array import array
+from typing import Iterable, List, Optional, Tuple
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def to_unit_vector(lat: float, lon: float) -> Tuple[float, float, float]:
+    """Converte latitude/longitude (graus) em um ponto na esfera unitária."""
+    phi, lam = math.radians(lat), math.radians(lon)
+    cos_phi = math.cos(phi)
+    return cos_phi * math.cos(lam), cos_phi * math.sin(lam), math.sin(phi)
+
+
+def chord_to_km(chord_squared: float) -> float:
+    """Distância sobre a superfície correspondente a uma corda (ao quadrado) na esfera unitária."""
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(chord_squared) / 2))
+
+
+def km_to_chord_squared(km: float) -> float:
+    return (2 * math.sin(min(km / EARTH_RADIUS_KM, math.pi) / 2)) ** 2
+
+
+class KDTree:
+    """
+    KD-tree estática em 3D guardada em arrays, sem objetos por nó.
+
+    Os pontos são latitude/longitude projetados na esfera unitária, então a distância
+    euclidiana (corda) cresce junto com a distância geodésica e não há problema com a
+    linha de data nem com a convergência dos meridianos.
+    A árvore é implícita: 'order' é uma permutação dos pontos onde cada intervalo
+    [início, fim) tem a mediana no meio, e 'axes' guarda o eixo de corte dessa mediana.
+    """
+
+    def __init__(self, coords: Iterable[Tuple[float, float]]):
+        xs, ys, zs = array('d'), array('d'), array('d')
+        ids = array('l')
+        for point_id, (lat, lon) in enumerate(coords):
+            if lat != lat or lon != lon:  # NaN: ponto sem coordenada
+                continue
+            x, y, z = to_unit_vector(lat, lon)
+            xs.append(x)
+            ys.append(y)
+            zs.append(z)
+            ids.append(point_id)
+        self._dims = (xs, ys, zs)
+        self.ids = ids
+        self.order = array('l', range(len(ids)))
+        self.axes = array('b', bytes(len(ids)))
+        self._build(0, len(ids))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def memory_bytes(self) -> int:
+        return sum(sys.getsizeof(a) for a in (*self._dims, self.ids, self.order, self.axes))
+
+    def _build(self, start: int, end: int):
+        # Pilha explícita em vez de recursão.
+        stack = [(start, end)]
+        order, dims = self.order, self._dims
+        while stack:
+            start, end = stack.pop()
+            if end - start <= 1:
+                continue
+            segment = order[start:end]
+            spreads = [max(dim[i] for i in segment) - min(dim[i] for i in segment) for dim in dims]
+            axis = spreads.index(max(spreads))
+            values = dims[axis]
+            order[start:end] = array('l', sorted(segment, key=values.__getitem__))
+            middle = (start + end) // 2
+            self.axes[middle] = axis
+            stack.append((start, middle))
+            stack.append((middle + 1, end))
+
+    def nearest(self, lat: float, lon: float, max_km: float = None) -> Optional[Tuple[int, float]]:
+        """
+        Ponto mais próximo de (lat, lon). Retorna (id, distância em km), ou None se a
+        árvore estiver vazia ou se nenhum ponto estiver a até 'max_km'.
+        """
+        if not self.ids:
+            return None
+        query = to_unit_vector(lat, lon)
+        qx, qy, qz = query
+        xs, ys, zs = self._dims
+        order, axes = self.order, self.axes
+        best_index = -1
+        best = km_to_chord_squared(max_km) if max_km is not None else math.inf
+
+        # (início, fim, distância mínima possível até o intervalo)
+        stack = [(0, len(order), 0.0)]
+        while stack:
+            start, end, bound = stack.pop()
+            if start >= end or bound >= best:
+                continue
+            middle = (start + end) // 2
+            point = order[middle]
+            dx, dy, dz = xs[point] - qx, ys[point] - qy, zs[point] - qz
+            distance = dx * dx + dy * dy + dz * dz
+            if distance < best:
+                best, best_index = distance, point
+            if end - start == 1:
+                continue
+            axis = axes[middle]
+            diff = query[axis] - self._dims[axis][point]
+            # O lado distante só vale a visita se o plano de corte estiver mais perto que o
+            # melhor ponto; é empilhado antes para que o lado próximo seja processado primeiro.
+            if diff < 0:
+                stack.append((middle + 1, end, max(bound, diff * diff)))
+                stack.append((start, middle, bound))
+            else:
+                stack.append((start, middle, max(bound, diff * diff)))
+                stack.append((middle + 1, end, bound))
+
+        if best_index < 0:
+            return None
+        return self.ids[best_index], chord_to_km(best)
+
+    def nearest_many(self, points: Iterable[Tuple[float, float]], max_km: float = None) -> List[Optional[Tuple[int, float]]]:
+        """Versão em lote de nearest(), para backfills."""
+        return [self.nearest(lat, lon, max_km) for lat, lon in points]
@@ -0,0 +1,274 @@
+# chatbot/state_store.py
+
+import asyncio
+import copy
+import logging
+import weakref
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, transaction
+from channels.db import database_sync_to_async
+
+from . import metrics
+from .models import Usuario
+
+logger = logging.getLogger(__name__)
+
+# Colunas do Usuario guardadas na sessão: tudo o que um turno de conversa lê ou altera.
+# As demais (ex.: o resumo da conversa) ficam adiadas e são lidas do banco se alguém as usar.
+SESSION_FIELDS = (
+    'id', 'organizacao_id', 'whatsapp_id', 'nome', 'cidade', 'estado',
+    'latitude', 'longitude', 'ultima_atividade', 'contexto', 'versao',
+)
+
+# Valores das SESSION_FIELDS de um usuário, indexados pelo nome da coluna.
+Session = Dict[str, object]
+
+# Instâncias vivas do store, para que as edições do Usuario fora da conversa as invalidem.
+_stores = weakref.WeakSet()
+
+
+def forget_session(whatsapp_id: str):
+    """Descarta a sessão do usuário em todos os stores (ex.: Usuario editado ou apagado no painel)."""
+    for store in list(_stores):
+        store.forget(whatsapp_id)
+
+
+class LocMemStateBackend:
+    """LRU em memória do processo. Adequado a um único processo (ou roteamento fixo por usuário)."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data: OrderedDict = OrderedDict()
+
+    async def get(self, whatsapp_id: str) -> Optional[Session]:
+        session = self._data.get(whatsapp_id)
+        if session is not None:
+            self._data.move_to_end(whatsapp_id)
+        return copy.deepcopy(session)
+
+    async def set(self, whatsapp_id: str, session: Session):
+        self._data[whatsapp_id] = copy.deepcopy(session)
+        self._data.move_to_end(whatsapp_id)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def delete(self, whatsapp_id: str):
+        self._data.pop(whatsapp_id, None)
+
+    def size(self) -> Optional[int]:
+        return len(self._data)
+
+
+class CacheStateBackend:
+    """
+    Estado em um cache do Django (CACHES[alias]), compartilhado entre processos quando o
+    cache é de rede (Redis, Memcached). Em testes, um LocMemCache pode ocupar o lugar dele.
+    """
+
+    def __init__(self, alias: str, ttl: float):
+        self.cache = caches[alias]
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(whatsapp_id: str) -> str:
+        return f"conversa:sessao:{whatsapp_id}"
+
+    async def get(self, whatsapp_id: str) -> Optional[Session]:
+        return await self.cache.aget(self._key(whatsapp_id))
+
+    async def set(self, whatsapp_id: str, session: Session):
+        await self.cache.aset(self._key(whatsapp_id), session, timeout=self.ttl)
+
+    def delete(self, whatsapp_id: str):
+        self.cache.delete(self._key(whatsapp_id))
+
+    def size(self) -> Optional[int]:
+        return None
+
+
+def build_backend():
+    backend = settings.CONVERSATION_STATE_BACKEND
+    if backend == 'locmem':
+        per_process = True
+    elif backend == 'cache':
+        alias = settings.CONVERSATION_STATE_CACHE_ALIAS
+        per_process = settings.CACHES[alias]['BACKEND'].endswith('LocMemCache')
+    else:
+        raise ValueError(f"CONVERSATION_STATE_BACKEND desconhecido: '{backend}'. Use 'locmem' ou 'cache'.")
+    if per_process and settings.WEB_CONCURRENCY > 1:
+        # Cada worker teria a sua cópia do estado, e um turno num worker não veria o do outro.
+        raise ImproperlyConfigured(
+            f"O estado das conversas está na memória do processo e WEB_CONCURRENCY={settings.WEB_CONCURRENCY}. "
+            "Use CONVERSATION_STATE_BACKEND='cache' com um cache de rede (ex.: Redis) em CACHES."
+        )
+    if backend == 'locmem':
+        return LocMemStateBackend(settings.CONVERSATION_STATE_MAX_SIZE)
+    return CacheStateBackend(settings.CONVERSATION_STATE_CACHE_ALIAS, settings.CONVERSATION_STATE_TTL)
+
+
+class ConversationStateStore:
+    """
+    Sessão da conversa (as SESSION_FIELDS do Usuario: nome, cidade, estado da conversa...)
+    fora do caminho do banco.
+
+    - O turno lê o usuário do backend; só numa ausência (primeiro turno do worker com um
+      cache em memória, TTL expirado, edição no painel) ele vem do banco, via prime().
+    - O fim do turno (set) grava a sessão no backend e agenda, em write-behind, as colunas
+      alteradas. A cada CONVERSATION_STATE_FLUSH_INTERVAL segundos, as pendentes vão ao banco
+      numa transação: um UPDATE por usuário, com as colunas do usuário e o contexto juntos.
+      Vários turnos do mesmo usuário entre dois flushes viram uma só escrita.
+    - Cada turno incrementa Usuario.versao; o UPDATE só vale se a versão no banco é menor,
+      então uma escrita atrasada (de um turno mais antigo) não sobrescreve uma mais nova.
+    Os turnos de um usuário são serializados pelo UserLocks, e com mais de um worker o
+    backend precisa ser compartilhado (ver build_backend): a sessão do backend é sempre a
+    do último turno. Edições do Usuario fora da conversa descartam a sessão (forget_session).
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or build_backend()
+        # Sessões ainda não gravadas no banco e as colunas alteradas em cada uma.
+        self._pending: Dict[str, Session] = {}
+        self._changed: Dict[str, set] = {}
+        # Sessões descartadas por forget(): a pendente não serve mais de leitura.
+        self._forgotten: set = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._timer: Optional[asyncio.Task] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        _stores.add(self)
+        # Métricas
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.coalesced = 0
+        self.rows_flushed = 0
+        self.rows_superseded = 0
+        self.flush_errors = 0
+        metrics.register('conversation_state', self.stats)
+
+    async def get(self, whatsapp_id: str) -> Optional[Usuario]:
+        """Usuario da sessão (sem ir ao banco), ou None se ela não está no store."""
+        session = await self.backend.get(whatsapp_id)
+        if session is None and whatsapp_id not in self._forgotten:
+            # Uma escrita ainda não gravada no banco vale mais que um backend que já a descartou (LRU).
+            session = copy.deepcopy(self._pending.get(whatsapp_id))
+        if session is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # from_db recebe os valores na ordem das colunas do modelo; as que faltam ficam adiadas.
+        names = [field.attname for field in Usuario._meta.concrete_fields if field.attname in session]
+        return Usuario.from_db(DEFAULT_DB_ALIAS, names, [session[name] for name in names])
+
+    async def prime(self, user: Usuario):
+        """Guarda no backend a sessão do usuário lido do banco, sem agendar escrita."""
+        self._forgotten.discard(user.whatsapp_id)
+        await self.backend.set(user.whatsapp_id, self._session(user))
+
+    async def set(self, user: Usuario, changed: List[str]):
+        """
+        Registra o fim de um turno do usuário: a versão avança, a sessão vai para o backend
+        e as colunas em 'changed' ficam pendentes para o próximo flush.
+        """
+        user.versao += 1
+        session = self._session(user)
+        self._forgotten.discard(user.whatsapp_id)
+        await self.backend.set(user.whatsapp_id, session)
+        self.writes += 1
+        if user.whatsapp_id in self._pending:
+            self.coalesced += 1
+        self._pending[user.whatsapp_id] = session
+        self._changed.setdefault(user.whatsapp_id, set()).update(changed)
+        self._ensure_timer()
+
+    def forget(self, whatsapp_id: str):
+        """
+        Descarta a sessão do backend; o próximo turno relê o usuário do banco.
+        Uma escrita pendente continua valendo (ela leva só as colunas alteradas pelos turnos).
+        """
+        self._forgotten.add(whatsapp_id)
+        self.backend.delete(whatsapp_id)
+
+    async def flush(self):
+        async with self._get_lock():
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            changed, self._changed = self._changed, {}
+            try:
+                written = await database_sync_to_async(self._write)(pending, changed)
+            except Exception as e:
+                self.flush_errors += 1
+                logger.error(f"ERRO DE BANCO: Falha ao gravar a sessão de {len(pending)} usuários. Nova tentativa no próximo ciclo. Erro: {e}")
+                # Turnos feitos durante a tentativa são mais novos e prevalecem.
+                self._pending = {**pending, **self._pending}
+                for whatsapp_id, fields in changed.items():
+                    self._changed.setdefault(whatsapp_id, set()).update(fields)
+                return
+            self.rows_flushed += written
+            self.rows_superseded += len(pending) - written
+
+    async def aclose(self):
+        if self._timer is not None and self._loop is asyncio.get_running_loop():
+            self._timer.cancel()
+        self._timer = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "size": self.backend.size(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "writes": self.writes,
+            "coalesced": self.coalesced,
+            "pending": len(self._pending),
+            "rows_flushed": self.rows_flushed,
+            "rows_superseded": self.rows_superseded,
+            "flush_errors": self.flush_errors,
+        }
+
+    # --- Internos ---
+
+    @staticmethod
+    def _session(user: Usuario) -> Session:
+        return {name: copy.deepcopy(getattr(user, name)) for name in SESSION_FIELDS}
+
+    @staticmethod
+    def _write(pending: Dict[str, Session], changed: Dict[str, set]) -> int:
+        # Um UPDATE por usuário (colunas do turno, contexto e versão juntos), condicionado à
+        # versão: se um turno mais novo já foi gravado, esta escrita é descartada.
+        written = 0
+        with transaction.atomic():
+            for whatsapp_id, session in pending.items():
+                values = {name: session[name] for name in changed[whatsapp_id]}
+                written += Usuario.objects.filter(pk=session['id'], versao__lt=session['versao']).update(
+                    versao=session['versao'], **values,
+                )
+        return written
+
+    def _get_lock(self) -> asyncio.Lock:
+        if self._flush_lock is None or self._loop is not asyncio.get_running_loop():
+            self._flush_lock = asyncio.Lock()
+        return self._flush_lock
+
+    def _ensure_timer(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._timer is None or self._timer.done():
+            self._loop = loop
+            self._flush_lock = None
+            self._timer = loop.create_task(self._periodic_flush())
+
+    async def _periodic_flush(self):
+        while True:
+            await asyncio.sleep(settings.CONVERSATION_STATE_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Erro inesperado no flush do estado das conversas.")
@@ -1,3 +1,1602 @@
-from django.test import TestCase
+import asyncio
+import json
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+import httpx
+import openai
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test import AsyncClient, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import metrics, views
+from .admission import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, AdmissionController, AdmissionRejected
+from .answer_cache import SimilarAnswerCache
+from .benchmarks import BENCHMARK_SCRIPT, debounce_replay, gazetteer_lookups, intent_corpus, turn_latency, view_concurrency
+from .cache import AsyncTTLCache
+from .consumers import WebchatConsumer
+from .debounce import InboundMessage, MessageDebouncer
+from .flows import ASK_LOCATION, ASK_NAME, WEATHER_CHOICE, WEATHER_CITY, WEATHER_FOLLOWUP
+from .fsm import MENU, STATE_KEY, StateMachine, Turn, set_state
+from .gazetteer import gazetteer, split_state
+from .geocoding import GeocodeCache, reverse_key
+from .history import ConversationHistory
+from .http_clients import UpstreamClients
+from .intents import IntentMatcher, intent_matcher
+from .interaction_log import InteractionLogger
+from .jobs import WebhookWorkerPool, claim_webhook_jobs, complete_webhook_job, fail_webhook_job, webhook_queue_stats
+from .lifecycle import ServiceLifecycle
+from .llm import LLMAnswer, StreamingLLM
+from .models import GeocodeCacheEntry, IntentKeyword, Interacao, Prompt, State, Usuario, WebhookJob
+from .ordering import UserLocks, UserLockTimeout
+from .prompts import prompt_catalog
+from .services import ChatbotService
+from .spatial import EARTH_RADIUS_KM, KDTree
+from .snapshots import TableSnapshot
+from .state_store import CacheStateBackend, ConversationStateStore, build_backend
+from .tools import Tool, ToolCall, ToolExecutor, ToolRegistry
+
+
+class GazetteerTests(SimpleTestCase):
+
+    def test_hyphen_inside_name_is_not_a_state_separator(self):
+        self.assertEqual(split_state('Ji-Paraná'), ('Ji-Paraná', None))
+        self.assertEqual(split_state('Ji-Paraná - RO'), ('Ji-Paraná', 'RO'))
+        self.assertEqual(split_state('Feira de Santana-BA'), ('Feira de Santana-BA', None))
+
+    def test_resolve_hyphenated_names(self):
+        for text, expected in [
+            ('Ji-Paraná', ('Ji Paraná', 'RO')),
+            ('Ji-Paraná - RO', ('Ji Paraná', 'RO')),
+            ('Grão-Pará', ('Grão-Pará', 'SC')),
+            ('Grão-Pará/SC', ('Grão-Pará', 'SC')),
+        ]:
+            with self.subTest(text=text):
+                found = gazetteer.resolve(text)
+                self.assertIsNotNone(found)
+                self.assertEqual((found.nome, found.uf), expected)
+
+    def test_resolve_separated_state(self):
+        for text in ('Feira de Santana - BA', 'Feira de Santana, Bahia', 'Feira de Santana (BA)', 'Feira de Santana BA'):
+            with self.subTest(text=text):
+                self.assertEqual(gazetteer.resolve(text).codigo_ibge, 2910800)
+
+    def test_resolve_typos_in_long_names(self):
+        self.assertEqual(gazetteer.resolve('Salvadr').nome, 'Salvador')
+        self.assertEqual(gazetteer.resolve('Feira de Santanna').nome, 'Feira de Santana')
+        self.assertEqual(gazetteer.resolve('Vitoria da Conqista').nome, 'Vitória da Conquista')
+
+    def test_common_words_are_not_cities(self):
+        for text in ('milho', 'feijao', 'banana', 'praga', 'cana', 'laranja'):
+            with self.subTest(text=text):
+                self.assertIsNone(gazetteer.resolve(text))
+
+
+class InteractionLoggerTests(SimpleTestCase):
+
+    def test_rows_stay_pending_until_written(self):
+        log = InteractionLogger()
+        seen = []
+        # Sem banco: o _write só registra o que pending() enxerga no meio do flush.
+        log._write = lambda rows: seen.append(log.pending(1))
+
+        async def run():
+            log.log(1, 'oi', 'Olá!')
+            log.log(2, 'bom dia', 'Bom dia!')
+            await log.aclose()
+
+        async_to_sync(run)()
+        self.assertEqual([[row['mensagem_usuario'] for row in rows] for rows in seen], [['oi']])
+        self.assertEqual(log.pending(1), [])
+        self.assertEqual(log.stats()['rows_written'], 2)
+
+
+class FakeSnapshot(TableSnapshot):
+    """Snapshot já carregado cuja verificação de versão só conta as chamadas (ou falha)."""
+
+    def __init__(self, error=None):
+        super().__init__()
+        self._loaded = True
+        self.error = error
+        self.checks = 0
+
+    def _reload_if_changed(self):
+        self.checks += 1
+        if self.error:
+            raise self.error
+
+
+@override_settings(SNAPSHOT_VERSION_CHECK_INTERVAL=0)
+class TableSnapshotTests(SimpleTestCase):
+
+    def test_one_version_check_at_a_time(self):
+        snapshot = FakeSnapshot()
+
+        async def run():
+            await snapshot.ensure_loaded()
+            task = snapshot._check_task
+            await snapshot.ensure_loaded()
+            self.assertIs(snapshot._check_task, task)
+            await task
+            await snapshot.ensure_loaded()
+            self.assertIsNot(snapshot._check_task, task)
+            await snapshot._check_task
+
+        async_to_sync(run)()
+        self.assertEqual(snapshot.checks, 2)
+
+    def test_failed_check_is_logged(self):
+        snapshot = FakeSnapshot(error=RuntimeError('banco fora do ar'))
+
+        async def run():
+            await snapshot.ensure_loaded()
+            await asyncio.gather(snapshot._check_task, return_exceptions=True)
+            await asyncio.sleep(0)
+
+        with self.assertLogs('chatbot.snapshots', 'ERROR') as logs:
+            async_to_sync(run)()
+        self.assertIn('banco fora do ar', logs.output[0])
+        self.assertGreater(snapshot._last_check, 0)
+
+
+class IntentMatcherTests(TestCase):
+
+    def test_other_worker_sees_a_bulk_update(self):
+        # Outro worker: não recebe os sinais de save do processo que editou a tabela.
+        matcher = IntentMatcher()
+        matcher.reload()
+        self.assertEqual(matcher.match('menu', 'clima'), 'clima')
+
+        IntentKeyword.objects.filter(scope='menu', pattern='clima').update(intent='previsao')
+        matcher._reload_if_changed()
+        self.assertEqual(matcher.match('menu', 'clima'), 'previsao')
+
+        keyword = IntentKeyword.objects.get(scope='menu', pattern='safra')
+        keyword.priority = 60
+        IntentKeyword.objects.bulk_update([keyword], ['priority'])
+        matcher._reload_if_changed()
+        self.assertEqual(matcher.match('menu', 'clima ou safra'), 'safra')
+
+    def test_corpus_benchmark_reports_whole_word_matching(self):
+        result = intent_corpus(rounds=1)
+        self.assertGreater(result["matcher_us_per_message"], 0)
+        # A regra antiga via o '1' de '10 hectares' e abria o clima.
+        self.assertIn('quero ver 10 hectares', result["differ_examples"])
+
+
+PROMPTS = {
+    'welcome_first_interaction': 'Olá de novo, {user_nome}!',
+    'main_menu_v2': 'MENU',
+    'welcome_ask_name': 'Qual o seu nome?',
+    'welcome_ask_location_whatsapp': 'Prazer {user_nome}, envie sua localização.',
+    'welcome_ask_location_web': 'Prazer {user_nome}, qual sua cidade?',
+    'location_received_whatsapp': 'Obrigado {user_nome}, localização recebida.',
+    'location_received_web': 'Obrigado {user_nome}, anotei {cidade}.',
+    'location_not_found_web': 'Não achei {cidade}.',
+    'location_error': 'Erro de localização.',
+    'weather_submenu_choice': '[1] minha cidade [2] outra cidade',
+    'weather_location_not_found': 'Não sei sua cidade.',
+    'weather_ask_another_city': 'Qual cidade?',
+    'weather_choice_invalid': 'Opção inválida.',
+    'weather_city_not_found': 'Cidade {cidade} não encontrada.',
+    'weather_dynamic_response': 'Em {cidade}: {descricao}, {temperatura}C.',
+    'feature_planting_wip': 'Plantio em breve.',
+    'feature_prices_wip': 'Preços em breve.',
+    'feature_reports_wip': 'Relatórios em breve.',
+    'feature_harvest_wip': 'Safra em breve.',
+    'default_fallback': 'Não entendi, {user_nome}.',
+}
+
+
+def openweather(request):
+    if request.url.path.endswith('/weather'):
+        return httpx.Response(200, json={
+            'cod': 200, 'name': 'Bairro', 'weather': [{'description': 'céu limpo'}],
+            'main': {'temp': 30.0, 'feels_like': 31.0, 'humidity': 40},
+        })
+    if request.url.path.endswith('/direct'):
+        return httpx.Response(200, json=[])
+    return httpx.Response(404)
+
+
+def build_service() -> ChatbotService:
+    service = ChatbotService()
+    service.http._clients['openweather'] = httpx.AsyncClient(
+        base_url='http://openweather', transport=httpx.MockTransport(openweather),
+    )
+    return service
+
+
+@override_settings(OPENAI_API_KEY=None, SNAPSHOT_VERSION_CHECK_INTERVAL=3600, CONVERSATION_STATE_FLUSH_INTERVAL=3600)
+class ServiceTestCase(TestCase):
+    """Turnos de conversa contra o banco de teste, com a OpenWeather simulada e sem LLM."""
+
+    whatsapp_id = '5571999990000'
+
+    @classmethod
+    def setUpTestData(cls):
+        Prompt.objects.bulk_create(Prompt(key=key, text=text) for key, text in PROMPTS.items())
+        State.objects.bulk_create([State(abbreviation='BA', name='Bahia'), State(abbreviation='SP', name='São Paulo')])
+
+    def setUp(self):
+        prompt_catalog.reload()
+        intent_matcher.reload()
+        gazetteer.ensure_loaded()
+        caches['default'].clear()
+        self.service = build_service()
+
+    def make_user(self, state, **fields):
+        context = {}
+        set_state(context, state)
+        fields.setdefault('nome', 'João')
+        return Usuario.objects.create(
+            organizacao_id=1, whatsapp_id=self.whatsapp_id, ultima_atividade=timezone.now(), contexto=context, **fields,
+        )
+
+    def run_turn(self, text, service=None, whatsapp_id=None, channel='webchat', location_data=None):
+        """Roda um turno; devolve a resposta e as consultas feitas por ele."""
+        service = service or self.service
+        whatsapp_id = whatsapp_id or self.whatsapp_id
+        # Estados brasileiros: uma consulta por worker (warmup), não por turno.
+        async_to_sync(service._load_state_maps_if_needed)()
+
+        async def run():
+            # O ORM assíncrono usa a conexão vista de dentro do sync_to_async; a contagem é feita lá.
+            queries = CaptureQueriesContext(connection)
+            await sync_to_async(queries.__enter__)()
+            try:
+                response = await service.process_message(whatsapp_id, text, 'João', channel, location_data)
+            finally:
+                await sync_to_async(queries.__exit__)(None, None, None)
+            executed = await sync_to_async(lambda: queries.captured_queries)()
+            # Interações e contexto pendentes vão ao banco antes de o loop do teste fechar.
+            await service.interaction_log.aclose()
+            await service.state.aclose()
+            return response, executed
+
+        return async_to_sync(run)()
+
+
+class TurnQueryCountTests(ServiceTestCase):
+    """
+    Consultas ao banco de um turno em cada estado da conversa. Prompts, intenções e
+    municípios vêm da memória; o usuário vem da sessão do ConversationStateStore (aqui,
+    vazio: uma consulta para lê-lo) e é gravado, com as interações, fora do turno.
+    Um número maior aqui é uma consulta nova no caminho da resposta.
+    """
+
+    def assertTurnQueries(self, num, whatsapp_id, text, channel='webchat', location_data=None):
+        """Roda um turno contando as consultas; devolve a resposta e o usuário relido do banco."""
+        response, executed = self.run_turn(text, whatsapp_id=whatsapp_id, channel=channel, location_data=location_data)
+        self.assertEqual(
+            len(executed), num,
+            f"{len(executed)} consultas no turno, esperadas {num}:\n" + "\n".join(q['sql'] for q in executed),
+        )
+        return response, Usuario.objects.get(whatsapp_id=whatsapp_id)
+
+    def test_new_user(self):
+        # get_or_create (SELECT, SAVEPOINT, INSERT, RELEASE)
+        response, user = self.assertTurnQueries(4, 'novo', 'oi', channel='whatsapp')
+        self.assertEqual(response, 'Olá de novo, João!\n\nMENU')
+        self.assertEqual((user.nome, user.contexto, user.versao), ('João', {}, 1))
+
+    def test_menu(self):
+        self.make_user(MENU)
+        response, user = self.assertTurnQueries(1, '5571999990000', '2')
+        self.assertEqual(response, 'Plantio em breve.')
+
+    def test_menu_without_llm(self):
+        self.make_user(MENU)
+        response, user = self.assertTurnQueries(1, '5571999990000', 'como plantar milho?')
+        self.assertEqual(response, 'Não entendi, João.\n\nMENU')
+
+    def test_ask_name(self):
+        self.make_user(ASK_NAME, nome='')
+        response, user = self.assertTurnQueries(1, '5571999990000', 'maria souza')
+        self.assertEqual(response, 'Prazer Maria Souza, qual sua cidade?')
+        self.assertEqual((user.nome, user.contexto), ('Maria Souza', {'estado': ASK_LOCATION}))
+
+    def test_ask_location_known_city(self):
+        self.make_user(ASK_LOCATION)
+        response, user = self.assertTurnQueries(1, '5571999990000', 'Feira de Santana - BA')
+        self.assertEqual(response, 'Obrigado João, anotei Feira de Santana.\n\nMENU')
+        self.assertEqual((user.cidade, user.estado, user.contexto), ('Feira de Santana', 'BA', {}))
+
+    def test_ask_location_unknown_city(self):
+        self.make_user(ASK_LOCATION)
+        # + cache de geocodificação no banco: consulta e, na falta, a gravação do resultado negativo
+        response, user = self.assertTurnQueries(8, '5571999990000', 'Atlantida')
+        self.assertEqual(response, 'Não achei Atlantida.')
+
+    def test_ask_location_pin(self):
+        self.make_user(ASK_LOCATION)
+        response, user = self.assertTurnQueries(
+            1, '5571999990000', '', channel='whatsapp', location_data={'latitude': -12.2664, 'longitude': -38.9663},
+        )
+        self.assertEqual(response, 'Obrigado João, localização recebida.\n\nMENU')
+        self.assertEqual(user.cidade, 'Feira de Santana')
+
+    def test_weather_choice_my_city(self):
+        self.make_user(WEATHER_CHOICE, cidade='Feira de Santana', estado='BA')
+        response, user = self.assertTurnQueries(1, '5571999990000', '1')
+        self.assertEqual(response, 'Em Feira de Santana: Céu limpo, 30.0C.')
+        self.assertEqual(user.contexto, {'estado': WEATHER_FOLLOWUP})
+
+    def test_weather_city(self):
+        self.make_user(WEATHER_CITY)
+        response, user = self.assertTurnQueries(1, '5571999990000', 'Salvador')
+        self.assertEqual(response, 'Em Salvador: Céu limpo, 30.0C.')
+
+    def test_weather_followup(self):
+        self.make_user(WEATHER_FOLLOWUP)
+        response, user = self.assertTurnQueries(1, '5571999990000', '1')
+        self.assertEqual(response, 'MENU')
+        self.assertEqual(user.contexto, {})
+
+    def test_turn_with_session_in_store_runs_no_queries(self):
+        self.make_user(MENU)
+        self.run_turn('1')
+        response, user = self.assertTurnQueries(0, '5571999990000', '2')
+        self.assertEqual(response, 'Qual cidade?')
+        self.assertEqual((user.contexto, user.versao), ({'estado': WEATHER_CITY}, 2))
+
+
+class TurnBenchmarkTests(ServiceTestCase):
+
+    def test_concurrent_conversations_are_measured_and_cleaned_up(self):
+        result = turn_latency(levels=(3,))["users_3"]
+        self.assertEqual(result["turns"], 3 * len(BENCHMARK_SCRIPT))
+        self.assertGreater(result["thread_pool_wait_p95_ms"], 0)
+        self.assertFalse(Usuario.objects.filter(whatsapp_id__startswith='benchmark_').exists())
+
+
+class ConversationStateTests(ServiceTestCase):
+    """Sessão da conversa no ConversationStateStore e a sua gravação em write-behind."""
+
+    def test_session_written_by_another_worker_is_used(self):
+        # Dois workers com o mesmo cache (como um Redis compartilhado) atendendo o mesmo usuário.
+        self.make_user(MENU)
+        other = build_service()
+        self.assertEqual(self.run_turn('1')[0], '[1] minha cidade [2] outra cidade')
+        self.assertEqual(self.run_turn('2', service=other)[0], 'Qual cidade?')
+        response, executed = self.run_turn('Salvador')
+        self.assertEqual((response, executed), ('Em Salvador: Céu limpo, 30.0C.', []))
+        user = Usuario.objects.get(whatsapp_id=self.whatsapp_id)
+        self.assertEqual((user.contexto, user.versao), ({'estado': WEATHER_FOLLOWUP}, 3))
+
+    def test_late_flush_does_not_overwrite_newer_turn(self):
+        user = self.make_user(WEATHER_CITY)
+        older, newer = self.service.state, build_service().state
+
+        async def run():
+            session = await older.get(user.whatsapp_id) or user
+            session.contexto = {'estado': WEATHER_FOLLOWUP}
+            await older.set(session, ['contexto'])
+            # O turno seguinte (noutro worker) é gravado primeiro.
+            session.contexto = {}
+            session.nome = 'João Silva'
+            await newer.set(session, ['contexto', 'nome'])
+            await newer.flush()
+            await older.flush()
+
+        async_to_sync(run)()
+        user.refresh_from_db()
+        self.assertEqual((user.nome, user.contexto, user.versao), ('João Silva', {}, 2))
+        self.assertEqual(older.stats()['rows_superseded'], 1)
+
+    def test_flush_writes_user_and_context_in_one_update(self):
+        self.make_user(ASK_NAME, nome='')
+
+        async def run():
+            await self.service.process_message(self.whatsapp_id, 'maria souza', 'João', 'webchat')
+            queries = CaptureQueriesContext(connection)
+            await sync_to_async(queries.__enter__)()
+            await self.service.state.flush()
+            await sync_to_async(queries.__exit__)(None, None, None)
+            await self.service.interaction_log.aclose()
+            return await sync_to_async(lambda: [query['sql'] for query in queries.captured_queries])()
+
+        updates = [sql for sql in async_to_sync(run)() if sql.startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        for column in ('"nome"', '"contexto"', '"ultima_atividade"', '"versao"'):
+            self.assertIn(column, updates[0])
+
+    def test_user_edited_outside_the_conversation_is_reloaded(self):
+        user = self.make_user(MENU)
+        self.run_turn('2')
+        user.refresh_from_db()
+        user.nome = 'Maria'
+        with self.captureOnCommitCallbacks(execute=True):
+            user.save()
+        response, executed = self.run_turn('tchau')
+        self.assertEqual(response, 'Não entendi, Maria.\n\nMENU')
+        self.assertEqual(len(executed), 1)
+
+    def test_summary_is_read_only_when_history_needs_it(self):
+        self.make_user(MENU, resumo_conversa='Planta milho em Feira de Santana.')
+        self.run_turn('2')
+
+        async def run():
+            user = await self.service.state.get(self.whatsapp_id)
+            self.assertIn('resumo_conversa', user.get_deferred_fields())
+            return await self.service.history.build(user)
+
+        messages = async_to_sync(run)()
+        self.assertIn('Planta milho em Feira de Santana.', messages[0]['content'])
+
+    @override_settings(CONVERSATION_STATE_BACKEND='locmem', WEB_CONCURRENCY=4)
+    def test_process_local_state_refused_with_several_workers(self):
+        with self.assertRaises(ImproperlyConfigured):
+            build_backend()
+        with self.settings(CONVERSATION_STATE_BACKEND='cache'):
+            with self.assertRaises(ImproperlyConfigured):
+                build_backend()
+        redis = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://localhost:6379'}}
+        with self.settings(CONVERSATION_STATE_BACKEND='cache', CACHES=redis):
+            self.assertIsInstance(build_backend(), CacheStateBackend)
+
+
+@override_settings(WEBHOOK_JOB_RETRY_BASE_SECONDS=0, WEBHOOK_JOB_MAX_ATTEMPTS=3)
+class WebhookJobClaimTests(TestCase):
+    """Reserva de tarefas da fila de webhooks: uma por usuário, na ordem de chegada."""
+
+    def enqueue(self, users):
+        return [
+            WebhookJob.objects.create(message_id=f"m{number}", whatsapp_id=user, payload={}).pk
+            for number, user in enumerate(users)
+        ]
+
+    def test_claims_only_oldest_job_per_user(self):
+        ids = self.enqueue(['a', 'b', 'a', 'c', 'b', 'a'])
+        claimed = claim_webhook_jobs(10)
+        self.assertEqual(sorted(job.pk for job in claimed), [ids[0], ids[1], ids[3]])
+        # 'a' está em andamento: a próxima mensagem dele espera.
+        self.assertEqual(claim_webhook_jobs(10), [])
+        complete_webhook_job(claimed[0])
+        self.assertEqual([job.pk for job in claim_webhook_jobs(10)], [ids[2]])
+
+    def test_failed_job_keeps_its_place(self):
+        ids = self.enqueue(['a', 'a'])
+        [first] = claim_webhook_jobs(10)
+        fail_webhook_job(first, 'erro')
+        self.assertEqual([job.pk for job in claim_webhook_jobs(10)], [ids[0]])
+
+    def test_stale_job_is_reclaimed_before_newer_ones(self):
+        ids = self.enqueue(['a', 'a'])
+        claim_webhook_jobs(10)
+        WebhookJob.objects.filter(pk=ids[0]).update(inicio_processamento=timezone.now() - timedelta(hours=1))
+        self.assertEqual([job.pk for job in claim_webhook_jobs(10)], [ids[0]])
+
+    def test_many_workers_keep_per_user_order(self):
+        rng = random.Random(12)
+        users = [f"55719{number:08d}" for number in range(25)]
+        ids = self.enqueue(rng.choice(users) for _ in range(400))
+        expected = defaultdict(list)
+        for pk, user in WebhookJob.objects.order_by('pk').values_list('pk', 'whatsapp_id'):
+            expected[user].append(pk)
+
+        finished = defaultdict(list)
+        running = {}
+        workers = 16
+        while len(running) or WebhookJob.objects.filter(status=WebhookJob.STATUS_PENDENTE).exists():
+            for _ in range(workers - len(running)):
+                for job in claim_webhook_jobs(rng.randint(1, 3)):
+                    self.assertNotIn(job.whatsapp_id, running, "duas tarefas do mesmo usuário em andamento")
+                    running[job.whatsapp_id] = job
+            for user, job in list(running.items()):
+                if rng.random() < 0.5:
+                    continue
+                del running[user]
+                if rng.random() < 0.1:
+                    if not fail_webhook_job(job, 'erro'):
+                        continue  # volta para a fila e é a próxima do usuário
+                else:
+                    complete_webhook_job(job)
+                finished[user].append(job.pk)
+
+        self.assertEqual(sum(map(len, finished.values())), len(ids))
+        self.assertEqual(dict(finished), dict(expected))
+
+
+class FakeWhatsAppService:
+    """O mínimo do ChatbotService usado pelos workers: um turno em streaming e o envio ao WhatsApp."""
+
+    def __init__(self, chunks, refuse=()):
+        self.chunks = chunks
+        self.refuse = list(refuse)
+        self.sent = []
+        self.turns = 0
+        self.user_locks = UserLocks()
+
+    async def process_message(self, user_id, message_text, push_name, channel, location_data, on_chunk=None, priority=None):
+        self.turns += 1
+        for chunk in self.chunks:
+            await on_chunk(chunk)
+        return ''.join(self.chunks)
+
+    async def send_whatsapp_message(self, phone_number, text):
+        self.sent.append(text)
+        if text in self.refuse:
+            self.refuse.remove(text)
+            return False
+        return True
+
+
+@override_settings(WEBHOOK_JOB_RETRY_BASE_SECONDS=0, WEBHOOK_JOB_MAX_ATTEMPTS=3)
+class WebhookWorkerTests(TestCase):
+
+    def make_job(self):
+        payload = {'key': {'remoteJid': '5571999990000', 'id': 'm1'}, 'pushName': 'João', 'message': {'conversation': 'oi'}}
+        return WebhookJob.objects.create(message_id='m1', whatsapp_id='5571999990000', payload=payload)
+
+    def run_claimed_job(self, pool):
+        [job] = claim_webhook_jobs(1)
+        async_to_sync(pool._run_job)(job)
+        return WebhookJob.objects.get(pk=job.pk)
+
+    def test_retry_sends_only_paragraphs_not_yet_delivered(self):
+        self.make_job()
+        service = FakeWhatsAppService(['Primeiro.\n\n', 'Segundo.\n\n', 'Terceiro.'], refuse=['Segundo.'])
+        pool = WebhookWorkerPool(service, concurrency=1)
+
+        with self.assertLogs('chatbot.jobs', 'ERROR'):
+            job = self.run_claimed_job(pool)
+        self.assertEqual((job.status, job.paragrafos_enviados), (WebhookJob.STATUS_PENDENTE, 1))
+        self.assertEqual(service.sent, ['Primeiro.', 'Segundo.'])
+
+        job = self.run_claimed_job(pool)
+        self.assertEqual(job.status, WebhookJob.STATUS_CONCLUIDO)
+        self.assertEqual(service.sent[2:], ['Segundo.\n\nTerceiro.'])
+        self.assertEqual(service.turns, 1)
+
+    def test_queue_stats_come_from_the_database(self):
+        now = timezone.now()
+        done, waiting, dead = (
+            WebhookJob.objects.create(message_id=f"m{number}", whatsapp_id='a', payload={}) for number in range(3)
+        )
+        WebhookJob.objects.filter(pk=done.pk).update(
+            status=WebhookJob.STATUS_CONCLUIDO, inicio_processamento=now - timedelta(seconds=3), data_atualizacao=now,
+        )
+        WebhookJob.objects.filter(pk=waiting.pk).update(tentativas=1, proxima_tentativa=now + timedelta(minutes=1))
+        WebhookJob.objects.filter(pk=dead.pk).update(status=WebhookJob.STATUS_FALHOU, tentativas=3)
+
+        stats = webhook_queue_stats()
+        self.assertEqual(
+            {key: stats[key] for key in ('pending', 'retrying', 'processing', 'dead_letter', 'processed_last_hour')},
+            {'pending': 1, 'retrying': 1, 'processing': 0, 'dead_letter': 1, 'processed_last_hour': 1},
+        )
+        self.assertAlmostEqual(stats['avg_duration_seconds'], 3, places=2)
+
+
+class UserLocksTests(SimpleTestCase):
+
+    def test_order_per_user_and_parallel_between_users(self):
+        locks = UserLocks()
+        rng = random.Random(7)
+        seen = defaultdict(list)
+        active = set()
+        peak = 0
+
+        async def turn(user, number):
+            nonlocal peak
+            async with locks.hold(user):
+                self.assertNotIn(user, active, "dois turnos do mesmo usuário ao mesmo tempo")
+                active.add(user)
+                peak = max(peak, len(active))
+                await asyncio.sleep(rng.random() / 500)
+                seen[user].append(number)
+                active.discard(user)
+
+        async def run():
+            tasks = []
+            for number in range(400):
+                tasks.append(asyncio.create_task(turn(f"u{rng.randrange(40)}", number)))
+                if number % 10 == 0:
+                    await asyncio.sleep(0)
+            await asyncio.gather(*tasks)
+
+        async_to_sync(run)()
+        self.assertEqual(sum(map(len, seen.values())), 400)
+        for numbers in seen.values():
+            self.assertEqual(numbers, sorted(numbers))
+        self.assertGreater(peak, 10)
+        self.assertEqual(locks.stats()['active_users'], 0)
+
+    def fake_db_locks(self, locks, results):
+        """Advisory locks simulados: cada tentativa consome o próximo resultado (bool ou exceção)."""
+        locks._db_locks_enabled = lambda: True
+        calls = []
+
+        async def run_on_shard(key, func, *args):
+            calls.append(func.__name__)
+            if func.__name__ != '_try_lock':
+                return None
+            result = results.pop(0) if results else False
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        locks._run_on_shard = run_on_shard
+        return calls
+
+    @override_settings(USER_LOCK_TIMEOUT=0.05)
+    def test_timeout_raises_instead_of_running_unlocked(self):
+        locks = UserLocks()
+        self.fake_db_locks(locks, [])
+        ran = []
+
+        async def run():
+            async with locks.hold('a'):
+                ran.append(True)
+
+        with self.assertLogs('chatbot.ordering', 'WARNING'), self.assertRaises(UserLockTimeout):
+            async_to_sync(run)()
+        self.assertEqual(ran, [])
+        self.assertEqual(locks.stats()['db_lock_timeouts'], 1)
+
+    @override_settings(USER_LOCK_TIMEOUT=5)
+    def test_database_error_retries_with_a_new_connection(self):
+        locks = UserLocks()
+        calls = self.fake_db_locks(locks, [RuntimeError('conexão perdida'), True])
+        ran = []
+
+        async def run():
+            async with locks.hold('a'):
+                ran.append(True)
+
+        with self.assertLogs('chatbot.ordering', 'ERROR'):
+            async_to_sync(run)()
+        self.assertEqual(ran, [True])
+        self.assertEqual(calls, ['_try_lock', '_close_connection', '_try_lock', '_unlock'])
+
+    @override_settings(USER_LOCK_SHARDS=3)
+    def test_aclose_closes_each_shard_connection(self):
+        locks = UserLocks()
+        closed = []
+        locks._close_connection = lambda: closed.append(threading.current_thread().name)
+        locks._executor_for(0)
+
+        async_to_sync(locks.aclose)()
+        self.assertEqual(sorted(name.rsplit('_', 1)[0] for name in closed), ['user-lock-0', 'user-lock-1', 'user-lock-2'])
+        self.assertEqual(locks._executors, [])
+
+
+class PoolTimeout(Exception):
+    """Mesmo nome da exceção do psycopg_pool quando DB_POOL_TIMEOUT se esgota."""
+
+
+class ChatbotViewTests(SimpleTestCase):
+
+    def post_webchat(self, message='oi'):
+        return async_to_sync(AsyncClient().post)(
+            '/api/v1/chatbot/webchat/', {'session_id': 'abc', 'message': message}, content_type='application/json',
+        )
+
+    def test_pool_timeout_is_a_503_with_retry_after(self):
+        saturated = mock.AsyncMock(side_effect=RuntimeError('sem conexão'))
+        saturated.side_effect.__cause__ = PoolTimeout('couldn\'t get a connection after 5.00 sec')
+        errors = views.chatbot_service.db.saturation_errors
+        with mock.patch.object(views.chatbot_service, 'handle_message', saturated), self.assertLogs('chatbot.db_pool', 'WARNING'):
+            response = self.post_webchat()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], str(views.SATURATED_RETRY_AFTER))
+        self.assertEqual(views.chatbot_service.db.saturation_errors, errors + 1)
+
+    def test_user_lock_timeout_is_a_503_with_retry_after(self):
+        busy = mock.AsyncMock(side_effect=UserLockTimeout('ocupado'))
+        with mock.patch.object(views.chatbot_service, 'handle_message', busy):
+            response = self.post_webchat()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], str(views.SATURATED_RETRY_AFTER))
+
+
+class WebchatConsumerTests(TestCase):
+
+    def test_user_reloaded_after_failed_turn(self):
+        seen = []
+
+        async def failing_turn(*args, user=None, **kwargs):
+            seen.append(user)
+            user.nome = ""
+            raise RuntimeError("falha no meio do turno")
+
+        async def turn(*args, user=None, **kwargs):
+            seen.append(user)
+            return "ok"
+
+        async def run():
+            communicator = WebsocketCommunicator(WebchatConsumer.as_asgi(), '/ws/webchat/abc/')
+            communicator.scope['url_route'] = {'kwargs': {'session_id': 'abc'}}
+            await communicator.connect()
+            with mock.patch('chatbot.consumers.chatbot_service.handle_message', side_effect=failing_turn):
+                await communicator.send_json_to({'message': 'reiniciar'})
+                self.assertEqual((await communicator.receive_json_from())['type'], 'error')
+            with mock.patch('chatbot.consumers.chatbot_service.handle_message', side_effect=turn):
+                await communicator.send_json_to({'message': 'oi'})
+                self.assertEqual((await communicator.receive_json_from())['type'], 'done')
+            await communicator.disconnect()
+
+        with self.assertLogs('chatbot.consumers', 'ERROR'):
+            async_to_sync(run)()
+        self.assertIsNot(seen[1], seen[0])
+        self.assertEqual(seen[1].nome, 'Visitante')
+
+
+@override_settings(WHATSAPP_DEBOUNCE_SECONDS=0.05, WHATSAPP_DEBOUNCE_MAX_SECONDS=1)
+class MessageDebouncerTests(SimpleTestCase):
+
+    def message(self, text):
+        return InboundMessage(text, None, timezone.now())
+
+    def test_follower_returns_when_the_window_closes(self):
+        debouncer = MessageDebouncer()
+        first, second = self.message('oi'), self.message('quero saber do milho')
+
+        async def run():
+            leader = asyncio.create_task(debouncer.submit('u', first))
+            await asyncio.sleep(0.01)
+            follower = asyncio.create_task(debouncer.submit('u', second))
+            turns = await leader
+            # O turno ainda não começou, mas a mensagem da outra chamada já está nele.
+            return turns, await asyncio.wait_for(follower, 0.01)
+
+        turns, outcome = async_to_sync(run)()
+        self.assertEqual(turns, [[first, second]])
+        self.assertIsNone(outcome)
+
+    def test_failed_turn_carries_other_messages_to_the_next_window(self):
+        service = build_service()
+        calls = []
+
+        async def turn(*args, originals=None, **kwargs):
+            calls.append([message.text for message in originals])
+            if len(calls) == 1:
+                raise RuntimeError('LLM fora do ar')
+            return ''
+
+        async def run():
+            first = asyncio.create_task(service.handle_whatsapp_message('u', 'oi', 'João'))
+            await asyncio.sleep(0.01)
+            second = asyncio.create_task(service.handle_whatsapp_message('u', 'tudo bem?', 'João'))
+            results = await asyncio.gather(first, second, return_exceptions=True)
+            # A Evolution API reenvia a mensagem cujo webhook respondeu erro.
+            await service.handle_whatsapp_message('u', 'oi', 'João')
+            return results
+
+        with mock.patch.object(service, 'process_message', side_effect=turn), \
+                override_settings(USER_LOCK_USE_DB=False), self.assertLogs('chatbot', 'WARNING'):
+            results = async_to_sync(run)()
+        self.assertIsInstance(results[0], RuntimeError)
+        self.assertEqual(results[1], '')
+        self.assertEqual(calls, [['oi', 'tudo bem?'], ['tudo bem?', 'oi']])
+        self.assertEqual(service.debouncer.stats()['carried_over'], 1)
+
+
+def fake_openai(deltas, first_delay=0.0, delay=0.0):
+    """
+    Servidor falso de /v1/chat/completions em streaming (SSE), no transporte do httpx:
+    um evento por delta, esperando 'first_delay' antes do primeiro e 'delay' entre eles.
+    """
+    async def events():
+        await asyncio.sleep(first_delay)
+        for number, delta in enumerate(deltas):
+            if number:
+                await asyncio.sleep(delay)
+            chunk = {"id": "c", "object": "chat.completion.chunk", "created": 0, "model": "m",
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+            yield f"data: {json.dumps(chunk)}\n\n".encode()
+        yield b"data: [DONE]\n\n"
+
+    def handler(request):
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=events())
+
+    return openai.AsyncOpenAI(
+        api_key='teste', base_url='http://openai/v1',
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+    )
+
+
+ANSWER_DELTAS = [{"content": piece} for piece in ("Plante o milho", " no início", " das chuvas.", "\n\n", "Boa safra!")]
+
+
+@override_settings(LLM_FIRST_TOKEN_TIMEOUT=0.2, LLM_TOTAL_TIMEOUT=5, LLM_ORG_TOKEN_BUDGET=0)
+class StreamingLLMTests(SimpleTestCase):
+
+    def generate(self, client, **options):
+        llm = StreamingLLM(lambda: client, AdmissionController())
+        deltas = []
+
+        async def on_delta(piece):
+            deltas.append(piece)
+
+        async def run():
+            started = asyncio.get_running_loop().time()
+            answer = await llm.stream([{"role": "user", "content": "quando plantar milho?"}], on_delta, **options)
+            return answer, asyncio.get_running_loop().time() - started
+
+        answer, elapsed = async_to_sync(run)()
+        return llm, answer, deltas, elapsed
+
+    def test_streams_every_delta_as_it_arrives(self):
+        llm, answer, deltas, _ = self.generate(fake_openai(ANSWER_DELTAS))
+        self.assertEqual(answer.text, "Plante o milho no início das chuvas.\n\nBoa safra!")
+        self.assertFalse(answer.truncated)
+        self.assertEqual(deltas, [delta["content"] for delta in ANSWER_DELTAS])
+
+    def test_first_token_timeout_abandons_the_call(self):
+        with self.assertLogs('chatbot.llm', 'WARNING'):
+            llm, answer, deltas, elapsed = self.generate(fake_openai(ANSWER_DELTAS, first_delay=1))
+        self.assertIsNone(answer)
+        self.assertEqual(deltas, [])
+        self.assertLess(elapsed, 0.6)
+        self.assertEqual(llm.stats()["timeouts"], 1)
+
+    @override_settings(LLM_TOTAL_TIMEOUT=0.25)
+    def test_total_timeout_returns_the_partial_answer(self):
+        with self.assertLogs('chatbot.llm', 'WARNING'):
+            llm, answer, deltas, elapsed = self.generate(fake_openai(ANSWER_DELTAS, delay=0.1))
+        self.assertTrue(answer.truncated)
+        self.assertTrue(answer.text.startswith("Plante o milho"))
+        self.assertLess(len(deltas), len(ANSWER_DELTAS))
+        self.assertEqual(answer.text, "".join(deltas))
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(llm.stats()["truncated"], 1)
+
+    def test_tool_call_arguments_are_assembled_across_chunks(self):
+        def piece(index, arguments, name=None):
+            call = {"index": index, "function": {"arguments": arguments}}
+            if name:
+                call.update(id=f"call_{index}", type="function")
+                call["function"]["name"] = name
+            return {"tool_calls": [call]}
+
+        # Os pedaços das duas chamadas chegam intercalados.
+        deltas = [
+            piece(0, '{"cidade": ', name='previsao_do_tempo'), piece(1, '{"produto"', name='cotacao'),
+            piece(0, '"Salvador"}'), piece(1, ': "milho"}'),
+        ]
+        llm, answer, text_deltas, _ = self.generate(fake_openai(deltas), tools=[])
+        self.assertEqual(answer.text, "")
+        self.assertEqual(text_deltas, [])
+        self.assertFalse(answer.truncated)
+        self.assertEqual(answer.tool_calls, (
+            ToolCall("call_0", "previsao_do_tempo", '{"cidade": "Salvador"}'),
+            ToolCall("call_1", "cotacao", '{"produto": "milho"}'),
+        ))
+
+
+class CountingHandler(BaseHTTPRequestHandler):
+    """Responde '{}' com keep-alive e anota de qual conexão (porta do cliente) veio cada pedido."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.peers.add(self.client_address)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+
+class UpstreamClientsTests(SimpleTestCase):
+
+    def test_client_is_shared_until_closed(self):
+        clients = UpstreamClients()
+
+        async def run():
+            first = clients.openweather
+            self.assertIs(clients.get('openweather'), first)
+            await first.aclose()
+            second = clients.openweather
+            await clients.aclose()
+            return first, second
+
+        first, second = async_to_sync(run)()
+        self.assertIsNot(first, second)
+        self.assertTrue(second.is_closed)
+        with self.assertRaises(ValueError):
+            clients.get('desconhecido')
+
+    @override_settings(EVOLUTION_API_URL='http://evolution.local', EVOLUTION_API_KEY='chave')
+    def test_evolution_client_sends_the_api_key(self):
+        client = UpstreamClients().evolution
+        self.assertEqual(str(client.base_url), 'http://evolution.local')
+        self.assertEqual(client.headers['apikey'], 'chave')
+
+    def test_connection_is_kept_alive_between_calls(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), CountingHandler)
+        server.peers = set()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        clients = UpstreamClients()
+
+        async def run():
+            for _ in range(3):
+                (await clients.precodahora.get('/')).raise_for_status()
+            stats = clients.stats()['precodahora']
+            await clients.aclose()
+            return stats
+
+        with override_settings(PRECODAHORA_SERVICE_URL=f'http://127.0.0.1:{server.server_port}'):
+            stats = async_to_sync(run)()
+        self.assertEqual(len(server.peers), 1)
+        self.assertEqual(stats, {"in_use": 0, "idle": 1, "waiting": 0})
+
+
+class AsyncTTLCacheTests(SimpleTestCase):
+
+    def test_concurrent_misses_share_one_load(self):
+        cache = AsyncTTLCache('teste', ttl=60, max_size=10)
+        calls = []
+
+        async def loader():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 'ensolarado'
+
+        async def run():
+            return await asyncio.gather(*(cache.get_or_load('salvador', loader) for _ in range(5)))
+
+        self.assertEqual(async_to_sync(run)(), ['ensolarado'] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual((cache.misses, cache.coalesced), (1, 4))
+
+    def test_failed_load_reaches_every_waiter_and_is_not_cached(self):
+        cache = AsyncTTLCache('teste', ttl=60, max_size=10)
+
+        async def loader():
+            await asyncio.sleep(0.01)
+            raise httpx.ConnectError('fora do ar')
+
+        async def run():
+            return await asyncio.gather(*(cache.get_or_load('salvador', loader) for _ in range(3)), return_exceptions=True)
+
+        results = async_to_sync(run)()
+        self.assertTrue(all(isinstance(result, httpx.ConnectError) for result in results))
+        self.assertIsNone(cache.peek('salvador'))
+
+    def test_stale_value_is_served_while_refreshing(self):
+        cache = AsyncTTLCache('teste', ttl=0.01, max_size=10, stale_ttl=60)
+        values = iter(['nublado', 'chuva'])
+
+        async def loader():
+            return next(values)
+
+        async def run():
+            first = await cache.get_or_load('salvador', loader)
+            await asyncio.sleep(0.02)
+            stale = await cache.get_or_load('salvador', loader)
+            # A atualização roda em segundo plano; depois dela o valor novo é servido.
+            await asyncio.sleep(0)
+            return first, stale, cache._entries['salvador'][0]
+
+        self.assertEqual(async_to_sync(run)(), ('nublado', 'nublado', 'chuva'))
+        self.assertEqual(cache.stale_hits, 1)
+
+    def test_failed_refresh_keeps_the_stale_value(self):
+        cache = AsyncTTLCache('teste', ttl=0.01, max_size=10, stale_ttl=60)
+        cache.set('salvador', 'nublado')
+
+        async def loader():
+            raise httpx.ConnectError('fora do ar')
+
+        async def run():
+            await asyncio.sleep(0.02)
+            stale = await cache.get_or_load('salvador', loader)
+            await asyncio.sleep(0)
+            return stale
+
+        with self.assertLogs('chatbot.cache', 'ERROR'):
+            self.assertEqual(async_to_sync(run)(), 'nublado')
+        self.assertEqual(cache.refresh_errors, 1)
+        self.assertEqual(cache._entries['salvador'][0], 'nublado')
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = AsyncTTLCache('teste', ttl=60, max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+
+        async def loader():
+            return 0
+
+        async_to_sync(cache.get_or_load)('a', loader)
+        cache.set('c', 3)
+        self.assertEqual(list(cache._entries), ['a', 'c'])
+        self.assertEqual(cache.evictions, 1)
+
+
+class GeocodeCacheTests(TestCase):
+
+    def lookup(self, cache, key, result=None, error=None):
+        calls = []
+
+        async def fetch():
+            calls.append(key)
+            if error:
+                raise error
+            return result
+
+        return async_to_sync(cache.lookup)(GeocodeCacheEntry.TIPO_DIRETA, key, fetch), calls
+
+    def test_result_is_shared_through_the_database(self):
+        found = {'lat': -12.25, 'lon': -38.96}
+        self.assertEqual(self.lookup(GeocodeCache(), 'feira de santana', found), (found, ['feira de santana']))
+        # Outro worker (memória vazia) encontra o resultado no banco, sem chamar a API.
+        other = GeocodeCache()
+        self.assertEqual(self.lookup(other, 'feira de santana'), (found, []))
+        self.assertEqual((other.db_hits, other.api_calls), (1, 0))
+
+    def test_empty_result_expires_in_the_database(self):
+        self.assertEqual(self.lookup(GeocodeCache(), 'atlantida'), ({}, ['atlantida']))
+        entry = GeocodeCacheEntry.objects.get(chave='atlantida')
+        self.assertIsNone(entry.resultado)
+        self.assertIsNotNone(entry.expira_em)
+
+        GeocodeCacheEntry.objects.filter(pk=entry.pk).update(expira_em=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.lookup(GeocodeCache(), 'atlantida'), ({}, ['atlantida']))
+
+    def test_network_error_is_not_cached(self):
+        cache = GeocodeCache()
+        with self.assertRaises(httpx.ConnectError):
+            self.lookup(cache, 'salvador', error=httpx.ConnectError('fora do ar'))
+        self.assertFalse(GeocodeCacheEntry.objects.exists())
+        self.assertEqual(self.lookup(cache, 'salvador', {'lat': -12.97}), ({'lat': -12.97}, ['salvador']))
+
+    @override_settings(GEOCODE_GRID_DEGREES=0.01)
+    def test_nearby_pins_share_a_reverse_key(self):
+        self.assertEqual(reverse_key(-12.2664, -38.9663), reverse_key(-12.2681, -38.9688))
+        self.assertNotEqual(reverse_key(-12.2664, -38.9663), reverse_key(-12.2864, -38.9663))
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((phi2 - phi1) / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+class KDTreeTests(SimpleTestCase):
+
+    def test_nearest_matches_brute_force(self):
+        rng = random.Random(8)
+        points = [(rng.uniform(-34, 5), rng.uniform(-74, -35)) for _ in range(500)]
+        tree = KDTree(points)
+        for _ in range(200):
+            lat, lon = rng.uniform(-40, 10), rng.uniform(-80, -30)
+            distances = [haversine_km(lat, lon, *point) for point in points]
+            expected = min(range(len(points)), key=distances.__getitem__)
+            found, km = tree.nearest(lat, lon)
+            self.assertEqual(found, expected)
+            self.assertAlmostEqual(km, distances[expected], places=6)
+
+    def test_points_without_coordinates_keep_the_ids_of_the_others(self):
+        tree = KDTree([(float('nan'), float('nan')), (-12.97, -38.50), (-23.55, -46.63)])
+        self.assertEqual(len(tree), 2)
+        self.assertEqual(tree.nearest(-23.5, -46.6)[0], 2)
+
+    def test_max_km_and_empty_tree(self):
+        tree = KDTree([(-12.97, -38.50)])
+        self.assertIsNone(tree.nearest(-23.55, -46.63, max_km=100))
+        self.assertEqual(tree.nearest(-12.98, -38.51, max_km=100)[0], 0)
+        self.assertIsNone(KDTree([]).nearest(0, 0))
+
+    def test_nearest_across_the_date_line(self):
+        tree = KDTree([(0, 179.9), (0, 170)])
+        found, km = tree.nearest(0, -179.9)
+        self.assertEqual(found, 0)
+        self.assertLess(km, 25)
+
+
+class StateMachineTests(SimpleTestCase):
+
+    def build(self):
+        machine = StateMachine()
+
+        @machine.state(MENU, transitions={'perguntando'})
+        async def menu(turn):
+            if turn.message_lower == 'pular':
+                turn.goto('inexistente')
+            turn.goto('perguntando')
+            return 'Qual a pergunta?'
+
+        @machine.state('perguntando', transitions={MENU})
+        async def perguntando(turn):
+            if turn.message_lower == 'erro':
+                raise RuntimeError('falha no handler')
+            turn.goto(MENU)
+            return f'Resposta: {turn.message_text}'
+
+        return machine
+
+    def dispatch(self, machine, context, text):
+        return async_to_sync(machine.dispatch)(Turn(None, None, context, text, 'webchat'))
+
+    def test_transitions_are_saved_in_the_context(self):
+        machine, context = self.build(), {}
+        self.assertEqual(self.dispatch(machine, context, 'oi'), 'Qual a pergunta?')
+        self.assertEqual(context, {STATE_KEY: 'perguntando'})
+        self.assertEqual(self.dispatch(machine, context, 'milho'), 'Resposta: milho')
+        self.assertEqual(context, {})
+        self.assertEqual(machine.stats()['perguntando']['count'], 1)
+
+    def test_undeclared_transition_is_refused(self):
+        machine, context = self.build(), {}
+        with self.assertRaises(ImproperlyConfigured):
+            self.dispatch(machine, context, 'pular')
+        self.assertEqual(context, {})
+
+    def test_failed_handler_keeps_the_state_and_is_counted(self):
+        machine, context = self.build(), {STATE_KEY: 'perguntando'}
+        with self.assertRaises(RuntimeError):
+            self.dispatch(machine, context, 'erro')
+        self.assertEqual(context, {STATE_KEY: 'perguntando'})
+        self.assertEqual(machine.stats()['perguntando']['errors'], 1)
+
+    def test_unknown_and_legacy_states(self):
+        machine = self.build()
+        context = {STATE_KEY: 'removido_na_versao_anterior'}
+        with self.assertLogs('chatbot.fsm', 'WARNING'):
+            self.assertEqual(self.dispatch(machine, context, 'oi'), 'Qual a pergunta?')
+        self.assertEqual(context, {STATE_KEY: 'perguntando'})
+
+        # Formato antigo: a flag 'awaiting_*' ligada é o estado.
+        legacy = StateMachine()
+
+        @legacy.state(MENU)
+        async def menu(turn):
+            return 'MENU'
+
+        @legacy.state('awaiting_location', transitions={MENU})
+        async def awaiting_location(turn):
+            turn.goto(MENU)
+            return 'Localização recebida.'
+
+        context = {'awaiting_location': True, 'awaiting_name': False}
+        self.assertEqual(self.dispatch(legacy, context, ''), 'Localização recebida.')
+        self.assertEqual(context, {})
+
+    def test_compile_validates_the_table(self):
+        machine = StateMachine()
+
+        @machine.state('perguntando')
+        async def perguntando(turn):
+            return ''
+
+        with self.assertRaisesMessage(ImproperlyConfigured, MENU):
+            machine.compile()
+
+        @machine.state(MENU, transitions={'inexistente'})
+        async def menu(turn):
+            return ''
+
+        with self.assertRaisesMessage(ImproperlyConfigured, 'inexistente'):
+            machine.compile()
+        with self.assertRaisesMessage(ImproperlyConfigured, 'duas vezes'):
+            machine.state(MENU)(menu)
+
+
+class ServiceLifecycleTests(SimpleTestCase):
+
+    def test_failed_warmup_step_is_retried_on_the_next_warmup(self):
+        lifecycle = ServiceLifecycle()
+        calls = []
+
+        async def tables():
+            calls.append('tables')
+
+        async def pools():
+            calls.append('pools')
+            if calls.count('pools') == 1:
+                raise ConnectionError('banco fora do ar')
+
+        steps = [('tables', tables), ('pools', pools)]
+        with self.assertLogs('chatbot.lifecycle', 'ERROR'):
+            self.assertFalse(async_to_sync(lifecycle.warmup)(steps))
+        self.assertEqual(lifecycle.warmup_errors, {'pools': 'banco fora do ar'})
+
+        async def twice():
+            # Sondas simultâneas: os passos rodam uma vez só.
+            return await asyncio.gather(lifecycle.warmup(steps), lifecycle.warmup(steps))
+
+        self.assertEqual(async_to_sync(twice)(), [True, True])
+        self.assertEqual(calls, ['tables', 'pools', 'tables', 'pools'])
+        self.assertEqual(set(lifecycle.stats()['warmup_ms']), {'tables', 'pools', 'total'})
+
+    def test_drain_waits_for_turns_in_flight(self):
+        lifecycle = ServiceLifecycle()
+        lifecycle.ready = True
+
+        async def run():
+            finished = []
+
+            async def turn():
+                async with lifecycle.track():
+                    await asyncio.sleep(0.05)
+                    finished.append(True)
+
+            task = asyncio.create_task(turn())
+            await asyncio.sleep(0)
+            drained = await lifecycle.drain(timeout=1)
+            await task
+            return drained, finished
+
+        self.assertEqual(async_to_sync(run)(), (True, [True]))
+        self.assertEqual((lifecycle.ready, lifecycle.draining, lifecycle.in_flight), (False, True, 0))
+
+    def test_drain_gives_up_after_the_timeout(self):
+        lifecycle = ServiceLifecycle()
+
+        async def run():
+            release = asyncio.Event()
+
+            async def turn():
+                async with lifecycle.track():
+                    await release.wait()
+
+            task = asyncio.create_task(turn())
+            await asyncio.sleep(0)
+            drained = await lifecycle.drain(timeout=0.05)
+            release.set()
+            await task
+            return drained
+
+        with self.assertLogs('chatbot.lifecycle', 'WARNING'):
+            self.assertFalse(async_to_sync(run)())
+        # Drenando, um novo aquecimento não volta a declarar prontidão.
+        self.assertFalse(async_to_sync(lifecycle.warmup)([]))
+
+
+@override_settings(TOOL_TIMEOUT=1)
+class ToolExecutorTests(SimpleTestCase):
+
+    def executor(self):
+        self.started = []
+        self.cancelled = []
+
+        async def clima(turn, cidade):
+            self.started.append(cidade)
+            await asyncio.sleep(0.05)
+            return {'cidade': cidade, 'temperatura': 30}
+
+        async def lenta(turn):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                self.cancelled.append('lenta')
+                raise
+
+        registry = ToolRegistry()
+        registry.register(Tool('clima', 'Clima atual', {}, clima))
+        registry.register(Tool('lenta', 'Nunca termina', {}, lenta, timeout=0.05))
+        return ToolExecutor(registry)
+
+    def run_calls(self, executor, calls):
+        async def run():
+            started = asyncio.get_running_loop().time()
+            messages = await executor.run(None, calls, {})
+            return messages, asyncio.get_running_loop().time() - started
+
+        return async_to_sync(run)()
+
+    def test_calls_run_in_parallel_and_repeats_share_one_execution(self):
+        executor = self.executor()
+        calls = [
+            ToolCall('c1', 'clima', '{"cidade": "Salvador"}'),
+            ToolCall('c2', 'clima', '{"cidade": "Feira de Santana"}'),
+            ToolCall('c3', 'clima', '{"cidade": "Salvador"}'),
+        ]
+        messages, elapsed = self.run_calls(executor, calls)
+        self.assertLess(elapsed, 0.1)
+        self.assertEqual(self.started, ['Salvador', 'Feira de Santana'])
+        self.assertEqual([message['tool_call_id'] for message in messages], ['c1', 'c2', 'c3'])
+        self.assertEqual(messages[0]['content'], messages[2]['content'])
+        self.assertEqual(executor.stats()['tools']['clima']['turn_cache_hits'], 1)
+
+    def test_timeout_cancels_the_tool_and_answers_with_an_error(self):
+        executor = self.executor()
+        calls = [ToolCall('c1', 'lenta', '{}'), ToolCall('c2', 'clima', '{"cidade": "Salvador"}')]
+        with self.assertLogs('chatbot.tools', 'WARNING'):
+            messages, elapsed = self.run_calls(executor, calls)
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(self.cancelled, ['lenta'])
+        self.assertEqual(json.loads(messages[0]['content']), {'erro': 'tempo esgotado'})
+        self.assertEqual(json.loads(messages[1]['content'])['cidade'], 'Salvador')
+        self.assertEqual(executor.stats()['tools']['lenta']['timeouts'], 1)
+
+    def test_bad_calls_answer_with_errors(self):
+        executor = self.executor()
+        calls = [
+            ToolCall('c1', 'inexistente', '{}'),
+            ToolCall('c2', 'clima', '{"cidade": '),
+            ToolCall('c3', 'clima', '{"municipio": "Salvador"}'),
+        ]
+        messages, _ = self.run_calls(executor, calls)
+        errors = [json.loads(message['content'])['erro'] for message in messages]
+        self.assertIn('desconhecida', errors[0])
+        self.assertIn('JSON malformado', errors[1])
+        self.assertIn('argumentos inválidos', errors[2])
+
+
+@override_settings(LLM_MAX_CONCURRENCY=1, LLM_MAX_QUEUE=10, LLM_QUEUE_TIMEOUT=1,
+                   LLM_ORG_TOKEN_BUDGET=100, LLM_ORG_TOKEN_WINDOW=3600, LLM_BUDGET_CACHE_ALIAS='default')
+class AdmissionControllerTests(SimpleTestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+
+    def test_organization_over_budget_is_refused_until_the_window_moves(self):
+        admission = AdmissionController()
+
+        async def call(organizacao_id, tokens):
+            async with admission.admit(organizacao_id=organizacao_id):
+                pass
+            await admission.charge(organizacao_id, tokens)
+
+        async_to_sync(call)(1, 60)
+        async_to_sync(call)(1, 50)
+        with self.assertLogs('chatbot.admission', 'WARNING'), self.assertRaises(AdmissionRejected) as refused:
+            async_to_sync(call)(1, 10)
+        self.assertEqual(refused.exception.reason, 'budget')
+        # O orçamento é por organização.
+        async_to_sync(call)(2, 10)
+        # Uma janela inteira depois, os gastos antigos saíram da conta.
+        with mock.patch('chatbot.admission.time.time', return_value=time.time() + 3600):
+            async_to_sync(call)(1, 10)
+        self.assertEqual(admission.stats()['shed_budget'], 1)
+        self.assertEqual(admission.stats()['tokens_by_org']['1'], {'calls': 3, 'tokens': 120})
+
+    def test_interactive_calls_skip_the_background_queue(self):
+        admission = AdmissionController()
+        order = []
+
+        async def call(name, priority):
+            async with admission.admit(priority):
+                order.append(name)
+                await asyncio.sleep(0.01)
+
+        async def run():
+            first = asyncio.create_task(call('em andamento', PRIORITY_BACKGROUND))
+            await asyncio.sleep(0)
+            background = asyncio.create_task(call('resumo', PRIORITY_BACKGROUND))
+            await asyncio.sleep(0)
+            interactive = asyncio.create_task(call('agricultor', PRIORITY_INTERACTIVE))
+            await asyncio.gather(first, background, interactive)
+
+        async_to_sync(run)()
+        self.assertEqual(order, ['em andamento', 'agricultor', 'resumo'])
+
+    @override_settings(LLM_QUEUE_TIMEOUT=0.05)
+    def test_call_without_a_slot_in_time_is_refused(self):
+        admission = AdmissionController()
+
+        async def run():
+            release = asyncio.Event()
+
+            async def hold():
+                async with admission.admit():
+                    await release.wait()
+
+            holder = asyncio.create_task(hold())
+            await asyncio.sleep(0)
+            try:
+                async with admission.admit():
+                    pass
+            finally:
+                release.set()
+                await holder
+
+        with self.assertLogs('chatbot.admission', 'WARNING'), self.assertRaises(AdmissionRejected) as refused:
+            async_to_sync(run)()
+        self.assertEqual(refused.exception.reason, 'busy')
+        self.assertEqual((admission.in_flight, admission.queued), (0, 0))
+
+
+class SimilarAnswerCacheTests(SimpleTestCase):
+
+    def test_similar_question_in_the_same_scope_reuses_the_answer(self):
+        cache = SimilarAnswerCache(ttl=60, max_size=10, threshold=0.6)
+        cache.store(('BA', 1), 'quando plantar milho', 'Entre outubro e novembro.')
+        self.assertEqual(cache.lookup(('BA', 1), 'qual a melhor época pra plantar milho?'), 'Entre outubro e novembro.')
+        self.assertIsNone(cache.lookup(('BA', 1), 'quando colher milho'))
+        # Outra UF ou outro prompt de sistema: a resposta não vale.
+        self.assertIsNone(cache.lookup(('SP', 1), 'quando plantar milho'))
+        self.assertIsNone(cache.lookup(('BA', 2), 'quando plantar milho'))
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    def test_short_and_personal_answers_are_not_shared(self):
+        cache = SimilarAnswerCache(ttl=60, max_size=10, threshold=0.6)
+        cache.store('BA', 'quando plantar milho', 'Maria, em Feira de Santana plante em outubro.', personal=('Maria', 'Feira de Santana'))
+        self.assertIsNone(cache.lookup('BA', 'quando plantar milho'))
+        # Nome contido em outra palavra não conta como dado do agricultor.
+        cache.store('BA', 'quando plantar milho', 'Plante em outubro, com a mariana.', personal=('Maria',))
+        self.assertEqual(cache.lookup('BA', 'quando plantar milho'), 'Plante em outubro, com a mariana.')
+        cache.store('BA', 'e o feijão?', 'Em novembro.')
+        self.assertIsNone(cache.lookup('BA', 'e o feijão?'))
+        self.assertEqual((cache.stores, cache.skipped), (1, 1))
+
+    def test_expired_and_least_recently_used_answers_leave_the_cache(self):
+        cache = SimilarAnswerCache(ttl=60, max_size=2, threshold=0.6)
+        cache.store('BA', 'quando plantar milho', 'Outubro.')
+        cache.store('BA', 'quando plantar feijão', 'Novembro.')
+        cache.lookup('BA', 'quando plantar milho')
+        cache.store('BA', 'como adubar milho', 'Com NPK.')
+        self.assertIsNone(cache.lookup('BA', 'quando plantar feijão'))
+        self.assertEqual(cache.lookup('BA', 'quando plantar milho'), 'Outubro.')
+        self.assertEqual(cache.evictions, 1)
+
+        with mock.patch('chatbot.answer_cache.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.lookup('BA', 'quando plantar milho'))
+        self.assertEqual(cache.expired, 1)
+        self.assertEqual(cache.stats()['size'], 1)
+        # O índice invertido não guarda termos das respostas que saíram.
+        self.assertEqual({term for _, term in cache._index}, {'adub', 'com', 'milh'})
+
+
+class FakeSummaryLLM:
+    """StreamingLLM do resumo: devolve 'answer' (ou levanta a exceção) e guarda as chamadas."""
+
+    available = True
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.calls = []
+
+    async def stream(self, messages, **kwargs):
+        self.calls.append((messages, kwargs))
+        if isinstance(self.answer, Exception):
+            raise self.answer
+        return self.answer
+
+
+class FakePendingLog:
+    """InteractionLogger só com as interações ainda não gravadas."""
+
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+
+    def pending(self, agricultor_id):
+        return [row for row in self.rows if row['agricultor_id'] == agricultor_id]
+
+
+@override_settings(LLM_HISTORY_TURNS=2, LLM_HISTORY_SUMMARY_BATCH=2, LLM_HISTORY_TOKEN_BUDGET=1500)
+class ConversationHistoryTests(TestCase):
+
+    def setUp(self):
+        self.user = Usuario.objects.create(organizacao_id=1, whatsapp_id='5571999990000', nome='João')
+        self.start = timezone.now() - timedelta(hours=1)
+        for number in range(5):
+            Interacao.objects.create(
+                agricultor=self.user, mensagem_usuario=f'pergunta {number}', resposta_chatbot=f'resposta {number}',
+                timestamp=self.start + timedelta(minutes=number),
+            )
+
+    def history(self, answer, pending=()):
+        prompts = mock.Mock(data={ConversationHistory.SUMMARY_PROMPT_KEY: 'Resuma a conversa.'})
+        return ConversationHistory(FakeSummaryLLM(answer), FakePendingLog(pending), prompts)
+
+    def build(self, history, user=None):
+        async def run():
+            messages = await history.build(user or self.user)
+            # O resumo roda em segundo plano; o teste espera por ele.
+            await asyncio.gather(*history._tasks.values())
+            return messages
+
+        return async_to_sync(run)()
+
+    @override_settings(LLM_HISTORY_SUMMARY_BATCH=100)
+    def test_context_is_the_summary_and_the_recent_window_within_budget(self):
+        self.user.resumo_conversa = 'Planta milho em Feira de Santana.'
+        self.user.resumo_atualizado_ate = self.start + timedelta(minutes=1)
+        self.user.save()
+        pending = [{
+            'agricultor_id': self.user.pk, 'mensagem_usuario': 'pergunta 5', 'resposta_chatbot': None,
+            'timestamp': self.start + timedelta(minutes=5),
+        }]
+        history = self.history(None, pending)
+        messages = self.build(history)
+        self.assertEqual(messages, [
+            {'role': 'system', 'content': 'Resumo da conversa até aqui: Planta milho em Feira de Santana.'},
+            {'role': 'user', 'content': 'pergunta 4'},
+            {'role': 'assistant', 'content': 'resposta 4'},
+            {'role': 'user', 'content': 'pergunta 5'},
+        ])
+
+        # Sem espaço para tudo, o resumo é cortado na metade do orçamento e as interações
+        # mais antigas saem primeiro.
+        with override_settings(LLM_HISTORY_TOKEN_BUDGET=18):
+            messages = self.build(history)
+        self.assertEqual(messages[0]['content'], 'Resumo da conversa até aqui: Pla')
+        self.assertEqual([message['content'] for message in messages[1:]], ['pergunta 5'])
+        self.assertEqual(history.trimmed, 2)
+        self.assertEqual(history.llm.calls, [])
+
+    def test_turns_behind_the_window_are_folded_into_the_summary(self):
+        self.user.resumo_conversa = 'Planta milho.'
+        self.user.save()
+        history = self.history(LLMAnswer('Planta milho e perguntou de 0 a 2.', False))
+        self.build(history)
+
+        [(messages, kwargs)] = history.llm.calls
+        self.assertEqual(kwargs['priority'], PRIORITY_BACKGROUND)
+        self.assertIn('Resumo atual: Planta milho.', messages[1]['content'])
+        self.assertIn('Agricultor: pergunta 2', messages[1]['content'])
+        self.assertNotIn('pergunta 3', messages[1]['content'])
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.resumo_conversa, 'Planta milho e perguntou de 0 a 2.')
+        self.assertEqual(self.user.resumo_atualizado_ate, self.start + timedelta(minutes=2))
+        self.assertEqual((history.summaries, history.turns_folded), (1, 3))
+
+    def test_summary_written_by_another_worker_is_kept(self):
+        history = self.history(LLMAnswer('Resumo deste worker.', False))
+        stale = Usuario.objects.get(pk=self.user.pk)
+        Usuario.objects.filter(pk=self.user.pk).update(
+            resumo_conversa='Resumo de outro worker.', resumo_atualizado_ate=self.start + timedelta(minutes=2),
+        )
+        self.build(history, stale)
+        self.assertEqual(history.summary_conflicts, 1)
+        self.assertEqual(stale.resumo_conversa, 'Resumo de outro worker.')
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.resumo_conversa, 'Resumo de outro worker.')
+
+    def test_refused_or_truncated_summary_leaves_the_turns_pending(self):
+        for answer in (AdmissionRejected('budget'), LLMAnswer('Resumo cort', True)):
+            history = self.history(answer)
+            self.build(history)
+            self.assertEqual(history.summary_failures, 1)
+            self.user.refresh_from_db()
+            self.assertEqual((self.user.resumo_conversa, self.user.resumo_atualizado_ate), ('', None))
+
+
+class MetricsRegistrationTests(ServiceTestCase):
+
+    def test_service_components_register_their_own_metrics(self):
+        service = self.service
+        components = {
+            'http_pools': service.http, 'llm_admission': service.llm_admission, 'llm': service.llm,
+            'tools': service.tool_executor, 'weather_cache': service.weather_cache,
+            'llm_answer_cache': service.answer_cache, 'geocode_cache': service.geocode_cache,
+            'gazetteer': service.gazetteer, 'interaction_log': service.interaction_log,
+            'conversation_history': service.history, 'conversation_state': service.state, 'fsm': service.fsm,
+            'user_locks': service.user_locks, 'whatsapp_debounce': service.debouncer, 'database': service.db,
+            'lifecycle': service.lifecycle,
+        }
+        for name, component in components.items():
+            self.assertIs(metrics._providers[name].__self__, component, name)
+
+
+class BenchmarkTests(SimpleTestCase):
+    """Versões pequenas das medições de chatbot/benchmarks.py."""
+
+    def test_debounce_replay_coalesces_bursts_within_the_max_window(self):
+        result = debounce_replay(users=5, bursts=2, speedup=100)
+        self.assertLess(result["turns"], result["messages"])
+        self.assertGreater(result["reduction"], 0)
+        # Nenhum webhook fica preso além da espera máxima (5 s), com folga para o relógio.
+        self.assertLess(result["webhook_wait_max_s"], 6)
+
+    def test_gazetteer_memory_estimate_matches_traced_allocations(self):
+        result = gazetteer_lookups(rounds=1, points=50)
+        self.assertGreater(result["municipios"], 5000)
+        # memory_bytes() alimenta o painel: não pode errar a ordem de grandeza.
+        self.assertLess(abs(result["memory_kib"] - result["traced_kib"]), result["traced_kib"] / 2)
+        self.assertGreater(result["nearest_us"], 0)
+
+    def test_async_views_keep_every_conversation_in_flight(self):
+        result = view_concurrency(levels=(4,), upstream_ms=20)["concurrency_4"]
+        self.assertEqual(result["async_view"]["in_flight_peak"], 4)
+        # A forma antiga (view síncrona sob ASGI) atende uma conversa de cada vez.
+        self.assertEqual(result["sync_bridge"]["in_flight_peak"], 1)
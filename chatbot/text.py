@@ -0,0 +1,68 @@
+# chatbot/text.py
+
+import re
+import unicodedata
+
+_SPACES = re.compile(r'\s+')
+
+
+def strip_accents(text: str) -> str:
+    """Remove acentos e cedilhas: 'São João' -> 'Sao Joao'."""
+    return ''.join(
+        char for char in unicodedata.normalize('NFKD', text)
+        if not unicodedata.combining(char)
+    )
+
+
+def normalize_text(text: str) -> str:
+    """Forma canônica para chaves de cache e buscas: sem acentos, minúscula e com espaços simples."""
+    return _SPACES.sub(' ', strip_accents(text or '').lower()).strip()
+
+
+# Palavras sem peso numa pergunta ('qual a melhor época pro milho' ~ 'época milho').
+# Interrogativos que mudam a pergunta (quando, como, onde, quanto) não entram aqui.
+STOPWORDS = frozenset('''
+    a o as os um uma uns umas de do da dos das em no na nos nas num numa ao aos
+    por pra pro pras pros para com sem e ou que qual quais se me te lhe eu voce vc
+    meu minha meus minhas seu sua seus suas isso esse essa este esta aquele aquela
+    ja mais muito muita bem melhor tem ter ha sobre aqui ai la entao tambem
+    posso devo pode podes queria gostaria quero saber sabe dizer diz fazer faz
+    oi ola bom boa dia tarde noite favor obrigado obrigada
+'''.split())
+
+# Sinônimos comuns nas perguntas dos agricultores, trocados antes do radical.
+SYNONYMS = {
+    'epoca': 'quando', 'periodo': 'quando', 'mes': 'quando',
+    'semear': 'plantar', 'semeadura': 'plantar', 'semeio': 'plantar', 'cultivo': 'plantar', 'cultivar': 'plantar',
+    'colheita': 'colher', 'adubacao': 'adubar', 'adubo': 'adubar', 'irrigacao': 'irrigar', 'aguar': 'irrigar',
+}
+
+_WORDS = re.compile(r'[a-z0-9]+')
+_PLURALS = (('oes', 'ao'), ('aes', 'ao'), ('ais', 'al'), ('eis', 'el'), ('ns', 'm'), ('res', 'r'), ('zes', 'z'), ('s', ''))
+_SUFFIXES = (
+    'amentos', 'imentos', 'amento', 'imento', 'mente', 'acoes', 'acao', 'icao', 'idade',
+    'adora', 'ador', 'ancia', 'avel', 'ivel', 'eiro', 'eira', 'agem', 'ando', 'endo', 'indo',
+    'ado', 'ada', 'ido', 'ida', 'oso', 'osa', 'ar', 'er', 'ir', 'ao', 'io', 'a', 'o', 'e',
+)
+
+
+def stem(word: str) -> str:
+    """Radical aproximado de uma palavra sem acentos: 'plantações' -> 'plant', 'milho' -> 'milh'."""
+    for suffix, replacement in _PLURALS:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            word = word[:-len(suffix)] + replacement
+            break
+    for suffix in _SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+
+def question_terms(text: str) -> frozenset:
+    """Termos de uma pergunta para comparar com outras: sem acentos, stopwords e sufixos."""
+    terms = set()
+    for word in _WORDS.findall(normalize_text(text)):
+        if word in STOPWORDS:
+            continue
+        terms.add(stem(SYNONYMS.get(word, word)))
+    return frozenset(terms)
@@ -0,0 +1,159 @@
+# chatbot/tools.py
+
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+ToolHandler = Callable[..., Awaitable[Any]]
+
+
+class Tool(NamedTuple):
+    name: str
+    description: str
+    # JSON Schema dos argumentos, no formato de 'function.parameters' da API da OpenAI.
+    parameters: dict
+    handler: ToolHandler
+    # Tempo máximo (segundos) da execução; None usa TOOL_TIMEOUT.
+    timeout: Optional[float] = None
+    # Se False, o resultado não é reaproveitado dentro do turno (ex.: ferramentas com efeito colateral).
+    cacheable: bool = True
+
+
+class ToolCall(NamedTuple):
+    id: str
+    name: str
+    arguments: str
+
+
+class ToolRegistry:
+    """Ferramentas oferecidas ao modelo. O handler recebe o Turn e os argumentos da chamada."""
+
+    def __init__(self):
+        self._tools: Dict[str, Tool] = {}
+
+    def register(self, tool: Tool):
+        self._tools[tool.name] = tool
+
+    def get(self, name: str) -> Optional[Tool]:
+        return self._tools.get(name)
+
+    def __bool__(self):
+        return bool(self._tools)
+
+    def schemas(self) -> List[dict]:
+        return [
+            {"type": "function", "function": {"name": tool.name, "description": tool.description, "parameters": tool.parameters}}
+            for tool in self._tools.values()
+        ]
+
+
+class ToolExecutor:
+    """
+    Executa as chamadas de ferramenta de uma resposta do modelo.
+
+    - Todas as chamadas de uma mesma resposta rodam em paralelo (asyncio.gather): uma
+      resposta com várias ferramentas custa a mais lenta delas, não a soma.
+    - Cada chamada tem o seu tempo limite; estourado, a tarefa é cancelada e o modelo
+      recebe um erro no lugar do resultado. Se o turno for cancelado, todas são canceladas.
+    - Resultados ficam no cache do turno (mesma ferramenta + mesmos argumentos = uma execução).
+    A latência de cada ferramenta e o tempo economizado pelo paralelismo vão para as métricas.
+    """
+
+    def __init__(self, registry: ToolRegistry):
+        self.registry = registry
+        self._timings: Dict[str, list] = {}
+        self.batches = 0
+        self._saved = 0.0
+        metrics.register('tools', self.stats)
+
+    async def run(self, turn, calls: List[ToolCall], cache: dict) -> List[dict]:
+        """Executa 'calls' e devolve as mensagens 'tool' para a próxima rodada do modelo."""
+        started = time.perf_counter()
+        results = await asyncio.gather(*(self._run_one(turn, call, cache) for call in calls))
+        wall = time.perf_counter() - started
+        self.batches += 1
+        self._saved += max(0.0, sum(elapsed for _, elapsed in results) - wall)
+        return [
+            {"role": "tool", "tool_call_id": call.id, "content": content}
+            for call, (content, _) in zip(calls, results)
+        ]
+
+    async def _run_one(self, turn, call: ToolCall, cache: dict):
+        tool = self.registry.get(call.name)
+        if tool is None:
+            return self._error(f"ferramenta desconhecida: {call.name}"), 0.0
+        try:
+            arguments = json.loads(call.arguments or '{}')
+        except ValueError:
+            return self._error("argumentos inválidos (JSON malformado)"), 0.0
+
+        key = (tool.name, json.dumps(arguments, sort_keys=True, ensure_ascii=False))
+        if tool.cacheable and key in cache:
+            self._timing(tool.name)[4] += 1
+            return await cache[key], 0.0
+
+        task = asyncio.ensure_future(self._execute(turn, tool, arguments))
+        if tool.cacheable:
+            # Chamadas repetidas na mesma rodada esperam a mesma tarefa.
+            cache[key] = task
+        started = time.perf_counter()
+        content = await task
+        elapsed = time.perf_counter() - started
+        return content, elapsed
+
+    async def _execute(self, turn, tool: Tool, arguments: dict) -> str:
+        timing = self._timing(tool.name)
+        started = time.perf_counter()
+        try:
+            async with asyncio.timeout(tool.timeout or settings.TOOL_TIMEOUT):
+                result = await tool.handler(turn, **arguments)
+            content = result if isinstance(result, str) else json.dumps(result, ensure_ascii=False, default=str)
+        except TimeoutError:
+            timing[2] += 1
+            logger.warning(f"AVISO: Ferramenta '{tool.name}' excedeu {tool.timeout or settings.TOOL_TIMEOUT}s e foi cancelada.")
+            content = self._error("tempo esgotado")
+        except TypeError as e:
+            timing[3] += 1
+            content = self._error(f"argumentos inválidos ({e})")
+        except Exception as e:
+            timing[3] += 1
+            logger.error(f"ERRO DE FERRAMENTA: Falha em '{tool.name}'. Erro: {e}")
+            content = self._error(str(e))
+        elapsed = time.perf_counter() - started
+        timing[0] += 1
+        timing[1] += elapsed
+        timing[5] = max(timing[5], elapsed)
+        return content
+
+    @staticmethod
+    def _error(message: str) -> str:
+        return json.dumps({"erro": message}, ensure_ascii=False)
+
+    def _timing(self, name: str) -> list:
+        # [execuções, tempo total, timeouts, erros, acertos no cache do turno, maior tempo]
+        return self._timings.setdefault(name, [0, 0.0, 0, 0, 0, 0.0])
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "parallel_saved_ms": round(self._saved * 1000, 1),
+            "tools": {
+                name: {
+                    "calls": count,
+                    "avg_ms": round(total / count * 1000, 1) if count else 0.0,
+                    "max_ms": round(longest * 1000, 1),
+                    "timeouts": timeouts,
+                    "errors": errors,
+                    "turn_cache_hits": hits,
+                }
+                for name, (count, total, timeouts, errors, hits, longest) in self._timings.items()
+            },
+        }
@@ -1,10 +1,14 @@
 from django.urls import path
-from .views import webhook_view, webchat_view
+from .views import WebhookView, WebchatView, HealthView, ReadinessView
 
 urlpatterns = [
     # Rota para o webhook do WhatsApp
-    path('webhook', webhook_view, name='webhook'),
+    path('webhook', WebhookView.as_view(), name='webhook'),
     
     # Nova rota para o webchat do site
-    path('webchat/', webchat_view, name='webchat'),
+    path('webchat/', WebchatView.as_view(), name='webchat'),
+
+    # Sondas do orquestrador: processo vivo / worker aquecido e aceitando tráfego
+    path('health', HealthView.as_view(), name='health'),
+    path('ready', ReadinessView.as_view(), name='ready'),
 ]
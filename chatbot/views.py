@@ -3,105 +3,186 @@
 import json
 import logging
 import re
-from asgiref.sync import async_to_sync
+from asgiref.sync import iscoroutinefunction
 
+from django.conf import settings
 from django.http import JsonResponse
-from rest_framework.decorators import api_view, authentication_classes, permission_classes
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework import status
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
+from channels.db import database_sync_to_async
 
-from .serializers import WebchatPayloadSerializer, WebhookPayloadSerializer, ChatbotResponseSerializer
+from .serializers import WebchatPayloadSerializer, WebhookPayloadSerializer, ChatbotResponseSerializer, extract_message_fields
 from .services import ChatbotService
+from .jobs import enqueue_webhook_job
+from .db_pool import pool_saturated
+from .ordering import UserLockTimeout
 
 logger = logging.getLogger(__name__)
 chatbot_service = ChatbotService()
 
-@swagger_auto_schema(
-    method='post',
-    request_body=WebchatPayloadSerializer,
-    responses={200: ChatbotResponseSerializer}
-)
-@api_view(['POST'])
-@authentication_classes([])
-@permission_classes([])
-def webchat_view(request):
-    serializer = WebchatPayloadSerializer(data=request.data)
-    if not serializer.is_valid():
-        logger.error("Erro de validação (Webchat): %s", serializer.errors)
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-
-    data = serializer.validated_data
-    session_id, message_text = data['session_id'], data['message']
-    user_id = f"webchat_{session_id}"
-    
-    try:
-        location_data = {"latitude": data['latitude'], "longitude": data['longitude']} if 'latitude' in data and 'longitude' in data else None
-        
-        response_text = async_to_sync(chatbot_service.process_message)(
-            user_id, message_text, "Visitante", 'webchat', location_data
-        )
-        
-        return Response({"response": response_text, "session_id": session_id}, status=status.HTTP_200_OK)
-
-    except Exception as e:
-        logger.exception(f"Erro ao processar webchat para user_id: {user_id}")
-        return Response(
-            {"response": "Desculpe, ocorreu um erro no nosso servidor."},
-            status=status.HTTP_500_INTERNAL_SERVER_ERROR
-        )
-
-@swagger_auto_schema(method='post', request_body=WebhookPayloadSerializer)
-@api_view(['POST'])
-@authentication_classes([])
-@permission_classes([])
-def webhook_view(request):
-    logger.info("Webhook recebido: %s", request.data)
-
-    # A lógica de validação agora está centralizada no serializer.
-    # A view apenas tenta validar e, se falhar, ignora o evento.
-    serializer = WebhookPayloadSerializer(data=request.data)
-    if not serializer.is_valid():
-        # Se a validação falhar, é porque não é uma mensagem que nos interessa.
-        # Retornamos 200 OK para que a API não continue a reenviar o webhook.
-        logger.warning("Payload inválido ou ignorado: %s", serializer.errors)
-        return Response({"status": "Evento ignorado ou inválido"}, status=status.HTTP_200_OK)
-
-    validated_data = serializer.validated_data
-    
-    try:
-        # O serializer já garantiu que 'data' é um dicionário (objeto da mensagem), não mais uma lista.
-        data_payload = validated_data.get('data', {})
-        
-        key_data = data_payload.get('key', {})
-        user_id = key_data.get('remoteJid')
+# Segundos sugeridos ao cliente (Retry-After) quando o banco está sem conexões livres
+# ou o usuário ainda está ocupado em outro worker.
+SATURATED_RETRY_AFTER = 2
+
+
+def retry_later_response(body: dict) -> Response:
+    """503 com Retry-After: o cliente (ou a Evolution API) tenta de novo em instantes."""
+    return Response(body, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": str(SATURATED_RETRY_AFTER)})
+
+
+def saturated_response(body: dict) -> Response:
+    chatbot_service.db.record_saturation()
+    return retry_later_response(body)
+
+
+class AsyncAPIView(APIView):
+    """
+    APIView cujos handlers são corrotinas executadas diretamente no event loop do ASGI.
+    O DRF só sabe despachar handlers síncronos, então reimplementamos o 'dispatch'
+    mantendo os mesmos ganchos (initial, handle_exception, finalize_response).
+    """
+    authentication_classes = []
+    permission_classes = []
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            # Sem autenticação/permissões/throttles de banco, 'initial' é só CPU.
+            self.initial(request, *args, **kwargs)
+
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(self, request.method.lower(), self.http_method_not_allowed)
+            else:
+                handler = self.http_method_not_allowed
+
+            if iscoroutinefunction(handler):
+                response = await handler(request, *args, **kwargs)
+            else:
+                response = handler(request, *args, **kwargs)
+                # 'http_method_not_allowed' e 'options' devolvem corrotinas em views assíncronas.
+                if hasattr(response, '__await__'):
+                    response = await response
+
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+
+class WebchatView(AsyncAPIView):
+
+    @swagger_auto_schema(
+        request_body=WebchatPayloadSerializer,
+        responses={200: ChatbotResponseSerializer}
+    )
+    async def post(self, request):
+        serializer = WebchatPayloadSerializer(data=request.data)
+        if not serializer.is_valid():
+            logger.error("Erro de validação (Webchat): %s", serializer.errors)
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        session_id, message_text = data['session_id'], data['message']
+        user_id = f"webchat_{session_id}"
         
-        push_name = data_payload.get('pushName', 'Utilizador')
-        message_data = data_payload.get('message', {})
-        message_text = ""
-        location_data = None
-
-        if 'conversation' in message_data and message_data.get('conversation'):
-            message_text = message_data['conversation']
-        elif 'extendedTextMessage' in message_data:
-            message_text = message_data.get('extendedTextMessage', {}).get('text', '')
-        elif 'locationMessage' in message_data:
-            loc_msg = message_data['locationMessage']
-            if 'degreesLatitude' in loc_msg and 'degreesLongitude' in loc_msg:
-                location_data = {"latitude": loc_msg['degreesLatitude'], "longitude": loc_msg['degreesLongitude']}
-        else:
-            logger.info(f"Tipo de mensagem não suportado recebido de {user_id}.")
-            return Response({"status": "Tipo de mensagem não suportado"}, status=status.HTTP_200_OK)
-
-        response_text = async_to_sync(chatbot_service.process_message)(
-            user_id, message_text, push_name, 'whatsapp', location_data
-        )
-
-        if response_text:
-            async_to_sync(chatbot_service.send_whatsapp_message)(user_id, response_text)
+        try:
+            location_data = {"latitude": data['latitude'], "longitude": data['longitude']} if 'latitude' in data and 'longitude' in data else None
+            
+            response_text = await chatbot_service.handle_message(
+                user_id, message_text, "Visitante", 'webchat', location_data
+            )
+            
+            return Response({"response": response_text, "session_id": session_id}, status=status.HTTP_200_OK)
+
+        except Exception as e:
+            if pool_saturated(e):
+                return saturated_response({"response": "Estamos com muitos acessos agora. Tente novamente em instantes.", "session_id": session_id})
+            if isinstance(e, UserLockTimeout):
+                return retry_later_response({"response": "Ainda estou respondendo a sua mensagem anterior. Tente novamente em instantes.", "session_id": session_id})
+            logger.exception(f"Erro ao processar webchat para user_id: {user_id}")
+            return Response(
+                {"response": "Desculpe, ocorreu um erro no nosso servidor."},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+
+class WebhookView(AsyncAPIView):
+
+    @swagger_auto_schema(request_body=WebhookPayloadSerializer)
+    async def post(self, request):
+        logger.info("Webhook recebido: %s", request.data)
+
+        # A lógica de validação agora está centralizada no serializer.
+        # A view apenas tenta validar e, se falhar, ignora o evento.
+        serializer = WebhookPayloadSerializer(data=request.data)
+        if not serializer.is_valid():
+            # Se a validação falhar, é porque não é uma mensagem que nos interessa.
+            # Retornamos 200 OK para que a API não continue a reenviar o webhook.
+            logger.warning("Payload inválido ou ignorado: %s", serializer.errors)
+            return Response({"status": "Evento ignorado ou inválido"}, status=status.HTTP_200_OK)
+
+        validated_data = serializer.validated_data
         
+        try:
+            # O serializer já garantiu que 'data' é um dicionário (objeto da mensagem), não mais uma lista.
+            data_payload = validated_data.get('data', {})
+            fields = extract_message_fields(data_payload)
+            if fields is None:
+                logger.info(f"Tipo de mensagem não suportado recebido de {data_payload.get('key', {}).get('remoteJid')}.")
+                return Response({"status": "Tipo de mensagem não suportado"}, status=status.HTTP_200_OK)
+
+            # Modo fast-ack: persiste o evento e confirma já; os workers fazem o resto.
+            if settings.WEBHOOK_FAST_ACK:
+                enqueued = await database_sync_to_async(enqueue_webhook_job)(data_payload)
+                return Response({"status": "enfileirado" if enqueued else "duplicado"}, status=status.HTTP_200_OK)
+
+            user_id, push_name, message_text, location_data = fields
+
+            await chatbot_service.handle_whatsapp_message(user_id, message_text, push_name, location_data)
+            
+            return Response({"status": "ok"}, status=status.HTTP_200_OK)
+        except Exception as e:
+            if pool_saturated(e):
+                return saturated_response({"error": "Banco de dados sem conexões livres."})
+            if isinstance(e, UserLockTimeout):
+                return retry_later_response({"error": "Mensagem anterior do usuário ainda em processamento."})
+            logger.exception(f"Erro interno ao processar webhook: {e}")
+            return Response({"error": "Erro interno do servidor."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class HealthView(AsyncAPIView):
+    """Liveness: o processo está de pé e o event loop responde."""
+
+    @swagger_auto_schema(auto_schema=None)
+    async def get(self, request):
         return Response({"status": "ok"}, status=status.HTTP_200_OK)
-    except Exception as e:
-        logger.exception(f"Erro interno ao processar webhook: {e}")
-        return Response({"error": "Erro interno do servidor."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class ReadinessView(AsyncAPIView):
+    """
+    Readiness: 200 só depois do aquecimento; 503 enquanto aquece, se ele falhou
+    ou durante o shutdown. Sem lifespan (ex.: runserver), a primeira sonda aquece.
+    """
+
+    @swagger_auto_schema(auto_schema=None)
+    async def get(self, request):
+        lifecycle = chatbot_service.lifecycle
+        if not lifecycle.ready and not lifecycle.draining:
+            await chatbot_service.warmup()
+        body = {
+            "status": "ready" if lifecycle.ready else ("draining" if lifecycle.draining else "warming_up"),
+            "warmup_ms": lifecycle.warmup_ms,
+        }
+        if lifecycle.warmup_errors:
+            body["errors"] = lifecycle.warmup_errors
+        code = status.HTTP_200_OK if lifecycle.ready else status.HTTP_503_SERVICE_UNAVAILABLE
+        return Response(body, status=code)
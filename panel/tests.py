@@ -1,3 +1,56 @@
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, connections
 from django.test import TestCase
 
-# Create your tests here.
+from campointeligente.db_routers import PIN_COOKIE, REPLICA_ALIAS
+from chatbot.models import Organizacao
+
+
+class ReplicaRoutingTests(TestCase):
+    """
+    Primário (banco de teste) e uma réplica SQLite separada e atrasada: o nome da
+    organização em cada um mostra de onde veio a leitura.
+    """
+
+    def setUp(self):
+        User.objects.create_superuser('root', 'root@example.com', 'senha')
+        # Alias criado só para o teste: fora de 'databases', e por isso fora das transações do TestCase.
+        connections.settings[REPLICA_ALIAS] = {**connections.settings[DEFAULT_DB_ALIAS], 'NAME': ':memory:'}
+        replica = connections[REPLICA_ALIAS]
+        replica.connect()
+        with replica.schema_editor() as editor:
+            editor.create_model(Organizacao)
+        Organizacao.objects.using(REPLICA_ALIAS).create(nome='Cooperativa')
+        # No primário, a mesma linha já com uma escrita que a réplica ainda não recebeu.
+        Organizacao.objects.create(nome='Cooperativa (primário)')
+
+    def tearDown(self):
+        connections[REPLICA_ALIAS].close()
+        del connections[REPLICA_ALIAS]
+        del connections.settings[REPLICA_ALIAS]
+
+    def login(self):
+        response = self.client.post(
+            '/api/v1/panel/login/', {'username': 'root', 'password': 'senha'}, content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def organizacoes(self):
+        return [org['nome'] for org in self.client.get('/api/v1/panel/organizacoes/').json()]
+
+    def test_session_writes_do_not_pin_reads_to_the_primary(self):
+        # O login grava a sessão e o last_login, que o painel não lê.
+        response = self.login()
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+        self.assertEqual(self.organizacoes(), ['Cooperativa'])
+
+    def test_write_to_a_panel_model_pins_reads_to_the_primary(self):
+        self.login()
+        response = self.client.post('/api/v1/panel/organizacoes/', {'nome': 'Nova'}, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertIn(PIN_COOKIE, response.cookies)
+        self.assertEqual(self.organizacoes(), ['Cooperativa (primário)', 'Nova', 'Organização Padrão'])
+
+        del self.client.cookies[PIN_COOKIE]
+        self.assertEqual(self.organizacoes(), ['Cooperativa'])
@@ -24,4 +24,7 @@ urlpatterns = [
     path('administradores/create/', views.administradores_create_view, name='api_administradores_create'),
     path('administradores/list/', views.administradores_list_view, name='api_administradores_list'),
     path('administradores/<int:pk>/', views.administrador_detail_view, name='api_administrador_detail'),
+
+    # Métricas operacionais do chatbot
+    path('metrics/', views.metrics_view, name='api_metrics'),
 ]
\ No newline at end of file
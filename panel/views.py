@@ -8,6 +8,8 @@ from django.utils.encoding import force_bytes, force_str
 from django.core.mail import send_mail
 from django.conf import settings
 
+from campointeligente.db_routers import replica_reads
+from chatbot import metrics
 from chatbot.models import Organizacao, Administrador
 from .serializers import OrganizacaoSerializer, AdministradorCreateSerializer, AdministradorReadOnlySerializer, AdministradorUpdateSerializer
 
@@ -186,6 +188,7 @@ def password_reset_confirm_view(request):
 @api_view(['GET', 'POST'])
 @authentication_classes([CsrfExemptSessionAuthentication, BasicAuthentication])
 @permission_classes([IsSuperUserOnly])
+@replica_reads
 def organizacoes_view(request):
     if request.method == 'GET':
         orgs = Organizacao.objects.all().order_by('nome')
@@ -215,6 +218,7 @@ def administradores_create_view(request):
 @api_view(['GET'])
 @authentication_classes([CsrfExemptSessionAuthentication, BasicAuthentication])
 @permission_classes([IsSuperUserOnly])
+@replica_reads
 def administradores_list_view(request):
     admins = Administrador.objects.all().order_by('nome')
     serializer = AdministradorReadOnlySerializer(admins, many=True)
@@ -223,6 +227,7 @@ def administradores_list_view(request):
 @api_view(['GET', 'PUT', 'PATCH', 'DELETE'])
 @authentication_classes([CsrfExemptSessionAuthentication])
 @permission_classes([IsSuperUserOnly])
+@replica_reads
 def organizacao_detail_view(request, pk):
     try:
         organizacao = Organizacao.objects.get(pk=pk)
@@ -245,11 +250,25 @@ def organizacao_detail_view(request, pk):
         organizacao.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+# --- VIEW DE MÉTRICAS OPERACIONAIS ---
+
+@api_view(['GET'])
+@authentication_classes([CsrfExemptSessionAuthentication, BasicAuthentication])
+@permission_classes([IsSuperUserOnly])
+@replica_reads
+def metrics_view(request):
+    """
+    Métricas operacionais do chatbot (fila de webhooks, workers, etc.).
+    Os valores em memória referem-se ao processo que atendeu a requisição.
+    """
+    return Response(metrics.snapshot())
+
 # --- NOVA VIEW PARA DETALHES, EDIÇÃO E EXCLUSÃO DE ADMINISTRADOR ---
 
 @api_view(['GET', 'PUT', 'PATCH', 'DELETE'])
 @authentication_classes([CsrfExemptSessionAuthentication])
 @permission_classes([IsSuperUserOnly])
+@replica_reads
 def administrador_detail_view(request, pk):
     try:
         administrador = Administrador.objects.get(pk=pk)